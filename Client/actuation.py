@@ -0,0 +1,110 @@
+"""
+Fixed rate actuation loop for the car. Commands from the server only move the targets, this loop ramps steering and
+throttle towards them at ACTUATION_RATE on its own thread, so network jitter never shows up as jerky steering.
+"""
+
+import threading
+import time
+
+# This is intentionally wrong, do not change or everything will burn!
+import client_cfg as cfg
+
+
+class ActuationLoop(threading.Thread):
+    def __init__(self, write_targets, debug, rate=cfg.ACTUATION_RATE):
+        """
+        :param write_targets: <Function> called with a dict of channel: pulse on every tick that changes something
+        :param debug: <Boolean> Debug mode (T/F)
+        :param rate: <Int> ticks per second
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.write_targets = write_targets
+        self.debug = debug
+        self.period = 1.0 / rate
+        self.max_steps = {
+            cfg.STEERING: cfg.STEERING_SLEW_RATE * self.period,
+            cfg.ESC: cfg.THROTTLE_SLEW_RATE * self.period
+        }
+        self.targets = {cfg.STEERING: cfg.CENTER, cfg.ESC: cfg.NEUTRAL}
+        self.current = dict(self.targets)
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.running = False
+
+        # Schedule jitter, lateness of each tick against its slot in seconds
+        self.ticks = 0
+        self.overruns = 0
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+
+    def set_targets(self, targets, immediate=False):
+        """
+        Sets new steering/throttle targets, clamped to the car's limits
+
+        :param targets: <Dict> channel: pulse
+        :param immediate: <Boolean> write the targets now instead of ramping towards them (e.g. to stop)
+        :return: <Int> 0 on success
+        """
+        with self.lock:
+            for channel, value in targets.items():
+                if channel == cfg.ESC:
+                    value = min(value, cfg.MAX_SPEED)
+                value = max(cfg.MAX_RIGHT, min(cfg.MAX_LEFT, value))
+                self.targets[channel] = value
+                if immediate:
+                    self.current[channel] = value
+
+        if immediate:
+            with self.write_lock:
+                self.write_targets(self.step())
+
+        return 0
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        next_tick = time.perf_counter()
+        while self.running:
+            with self.write_lock:
+                self.write_targets(self.step())
+
+            next_tick += self.period
+            now = time.perf_counter()
+            if now - next_tick > self.period:
+                # Fell more than a whole tick behind, don't try to catch up with a burst of writes
+                self.overruns += 1
+                next_tick = now
+            else:
+                time.sleep(max(0.0, next_tick - now))
+                self.record_jitter(time.perf_counter() - next_tick)
+
+    def step(self):
+        """
+        Moves every channel at most one tick's worth of slew towards its target
+
+        :return: <Dict> channel: pulse to write this tick
+        """
+        with self.lock:
+            for channel, target in self.targets.items():
+                error = target - self.current[channel]
+                max_step = self.max_steps[channel]
+                self.current[channel] += max(-max_step, min(max_step, error))
+            return {channel: int(round(value)) for channel, value in self.current.items()}
+
+    def record_jitter(self, lateness):
+        lateness = abs(lateness)
+        self.ticks += 1
+        self.total_jitter += lateness
+        if lateness > self.max_jitter:
+            self.max_jitter = lateness
+            if self.debug:
+                print('[ACTUATION] New max schedule jitter: {:.3f}ms'.format(lateness * 1000))
+
+    def jitter(self):
+        """
+        :return: <Tuple> mean jitter (s), max jitter (s), number of overrun ticks
+        """
+        mean = self.total_jitter / self.ticks if self.ticks else 0.0
+        return mean, self.max_jitter, self.overruns
@@ -0,0 +1,396 @@
+"""
+Asyncio version of the car client. Network receive, command execution, GPS ingestion and status transmission each
+run as their own task and only talk to each other through bounded queues, so a slow GPS read can never hold up the
+next steering command.
+"""
+
+import asyncio
+import time
+import traceback
+
+# This is intentionally wrong, do not change or everything will burn!
+import client_cfg as cfg
+from async_maestro import AsyncDevice
+from autonomy import Autopilot
+from actuation import ActuationLoop
+from gps_stream import GGA_PATTERN, SIMULATED_FIX, SIMULATED_FIX_INTERVAL, GPSStreamer
+from reconnect import reconnect_delay
+
+
+def put_latest(queue, item):
+    """
+    Queues an item without waiting, dropping the oldest entry if the queue is full
+
+    :param queue: <asyncio.Queue> bounded queue
+    :param item: item to queue
+    :return: <Int> 0 on success
+    """
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(item)
+
+    return 0
+
+
+class AsyncClient:
+    def __init__(self, debug, servo_attached, gps_attached):
+        self.debug = debug
+        self.servo_attached = servo_attached
+        self.gps_attached = gps_attached
+        self.loop = asyncio.get_event_loop()
+        self.reader = None
+        self.writer = None
+        self.running = False
+        self.session_token = None  # handed out by the server, lets it reattach us to our drone after a reconnect
+        self.latest_fix = None  # (timestamp, GGA sentence)
+        self.commands = asyncio.Queue(maxsize=cfg.COMMAND_QUEUE_SIZE)
+        self.outgoing = asyncio.Queue(maxsize=cfg.STATUS_QUEUE_SIZE)
+        self.pending_targets = {}  # channel: pulse, applied together once the command queue runs dry
+        self.command_seq = None  # sequence number of the command batch being received
+        self.applied_targets = {cfg.STEERING: cfg.CENTER, cfg.ESC: cfg.NEUTRAL}
+        self.unwritten_acks = []  # command batches handed to the actuation loop but not yet written to the Maestro
+        self.autopilot = Autopilot(self.server_tx, self.drive, debug, gps_attached)
+        self.servo = AsyncDevice(cfg.MAESTRO_CON_PORT, cfg.MAESTRO_SER_PORT, multi_target=cfg.MAESTRO_MULTI_TARGET)
+        self.actuation = None
+        if servo_attached and cfg.ACTUATION_RATE:
+            # The device belongs to the event loop, so the actuation thread hands its writes over to it
+            self.actuation = ActuationLoop(lambda targets: self.loop.call_soon_threadsafe(self.actuate, targets), debug)
+
+    def main(self):
+        """
+        Main executing function for client
+
+        :return: <Int> 0 on a clean shutdown
+        """
+        event_loop = asyncio.get_event_loop()
+        run = asyncio.ensure_future(self.run())
+        try:
+            event_loop.run_until_complete(run)
+        except KeyboardInterrupt:
+            event_loop.run_until_complete(self.shutdown(run))
+        finally:
+            event_loop.close()
+
+        return 0
+
+    @staticmethod
+    async def shutdown(run):
+        """
+        The interrupt came out of the loop with run() still waiting on the car's last command. Cancelling it runs its
+        cleanup, which has to happen while the loop is still running for the stop to reach the Maestro.
+
+        :param run: <Task> the client's run()
+        """
+        run.cancel()
+        try:
+            await run
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+
+    async def run(self):
+        self.running = True
+        if self.actuation:
+            self.actuation.start()
+
+        # Command execution and GPS ingestion outlive any one connection
+        background = [asyncio.ensure_future(self.execute_commands()), asyncio.ensure_future(self.ingest_gps())]
+        try:
+            while self.running:
+                await self.connect_to_server()
+                await self.serve_connection(background)
+        finally:
+            self.running = False
+            for task in background:
+                task.cancel()
+            if self.actuation:
+                # Its last tick may still be on the way, anything it queued after this is dropped by actuate
+                self.actuation.stop()
+                self.actuation.join()
+            # However the client ended, don't leave the Maestro holding the last throttle
+            self.autopilot.cancel()
+            if self.servo_attached:
+                self.write_targets({cfg.ESC: cfg.NEUTRAL, cfg.STEERING: cfg.CENTER})
+            self.servo.close()
+
+    async def serve_connection(self, background):
+        """
+        Runs the receive and transmit tasks until the connection drops or a background task finishes
+        """
+        tasks = [asyncio.ensure_future(self.receive()), asyncio.ensure_future(self.transmit_status())]
+        try:
+            done, pending = await asyncio.wait(tasks + background, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            # An overrun means no terminator within the reader's limit, the stream can't be split into messages anymore
+            print('[NETWORK] Socket Error: \n', traceback.format_exc())
+            self.center_steering_stop_car()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await self.flush_outgoing()
+            self.writer.close()
+
+    async def connect_to_server(self):
+        """
+        Connects to the server, cycling through HOST_PORTS with jittered backoff until one accepts. If the server gave us
+        a session before, asks it to resume that session.
+
+        :return: <Int> port connected on
+        """
+        attempt = 0
+        while True:
+            port = cfg.HOST_PORTS[attempt % len(cfg.HOST_PORTS)]
+            try:
+                self.reader, self.writer = await asyncio.open_connection(cfg.HOST_IP_FOF, port)
+                break
+            except OSError:
+                delay = reconnect_delay(attempt)
+                print('[NETWORK] Connection to port ' + str(port) + ' failed, retrying in {:.2f}s'.format(delay))
+                attempt += 1
+                await asyncio.sleep(delay)
+
+        print("Connected on port ", port, ". Ready to receive data.")
+        if self.session_token:
+            # Ahead of anything already queued, the server has to know who we are first
+            self.writer.write(bytearray('resume:' + self.session_token + '\\', 'utf-8'))
+
+        return port
+
+    async def receive(self):
+        """
+        Splits the socket stream into messages and queues them for execution. Blocks only when the command queue is
+        full, so control messages such as 'stop' are never dropped.
+        """
+        while self.running:
+            data = await self.reader.readuntil(b'\\')
+            message = data[:-1].decode('utf8')
+            if message:
+                self.print_debug_info(message)
+                await self.commands.put(message)
+
+    async def execute_commands(self):
+        while self.running:
+            message = await self.commands.get()
+            try:
+                await self.execute_data(message)
+            except (ValueError, IndexError):
+                print('[WARN] Ignoring malformed message: ' + message)
+            # A steering/throttle pair arrives together, so apply once everything received so far has been read
+            if self.commands.empty():
+                self.apply_pending_targets()
+
+    async def transmit_status(self):
+        while self.running:
+            data = await self.outgoing.get()
+            self.writer.write(bytearray(data + '\\', 'utf-8'))
+            await self.writer.drain()
+
+    async def flush_outgoing(self):
+        while not self.outgoing.empty():
+            self.writer.write(bytearray(self.outgoing.get_nowait() + '\\', 'utf-8'))
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+    async def ingest_gps(self):
+        """
+        Keeps the freshest GPS fix on hand. When streaming, fixes are pushed to the server at GPS_STREAM_RATE (or as
+        they arrive), otherwise the first fix and any fix the server asks for are sent. A GPS port that closes or can't
+        be opened is retried every GPS_REOPEN_DELAY seconds.
+        """
+        interval = 1.0 / cfg.GPS_STREAM_RATE if cfg.GPS_STREAM_RATE else 0.0
+        last_sent = None
+        gps_reader = None
+
+        while self.running:
+            try:
+                if self.gps_attached and gps_reader is None:
+                    gps_reader = await self.open_gps()
+                message = await self.read_fix(gps_reader)
+            except (EOFError, OSError) as e:
+                print('[GPS] Lost GPS port: ' + str(e) + ', reopening in ' + str(cfg.GPS_REOPEN_DELAY) + 's')
+                gps_reader = None
+                await asyncio.sleep(cfg.GPS_REOPEN_DELAY)
+                continue
+            self.latest_fix = (time.time(), message)
+            self.autopilot.on_fix(*self.latest_fix)
+            if last_sent is None or (cfg.GPS_STREAMING and self.latest_fix[0] - last_sent >= interval):
+                last_sent = self.latest_fix[0]
+                self.send_latest_fix()
+
+    @staticmethod
+    async def open_gps():
+        gps_reader = asyncio.StreamReader()
+        await asyncio.get_event_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(gps_reader),
+                                                          open(cfg.GPS_PORT, 'rb', buffering=0))
+        return gps_reader
+
+    @staticmethod
+    async def read_fix(gps_reader):
+        if gps_reader is None:
+            await asyncio.sleep(SIMULATED_FIX_INTERVAL)
+            return SIMULATED_FIX
+
+        while True:
+            line = await gps_reader.readline()
+            if not line:
+                raise EOFError('GPS port closed')
+            search = GGA_PATTERN.search(line.decode('ascii', 'ignore'))
+            if search:
+                return search.group(0)
+
+    def send_latest_fix(self):
+        if self.latest_fix:
+            self.server_tx(GPSStreamer.format_fix(*self.latest_fix))
+            if self.debug:
+                print('[GPS] ' + self.latest_fix[1])
+
+    def server_tx(self, data):
+        put_latest(self.outgoing, data)
+
+    def print_debug_info(self, message):
+        if self.debug:
+            print('[DEBUG] Recieved data from: ' +
+                  self.writer.get_extra_info('peername').__str__() +
+                  ': ' +
+                  message.__str__()
+                  )
+
+    def servo_ctl(self, servo_num, val):
+        """
+        Function to send signal to Maestro servo Device for execution
+
+        :param servo_num: <Int> 3 for speed, 5 for steering
+        :param val: <Int> qms pulse value for the servo to execute
+        :return: <Int> 0 on success
+        """
+        # Repeats are dropped by the Device's state cache, these only go out after a reset or serial error
+        with self.servo.batch():
+            self.servo.set_acceleration(cfg.STEERING, 50)
+            self.servo.set_acceleration(cfg.ESC, 100)
+
+            self.servo.set_target(servo_num, val)
+
+        return 0
+
+    def write_targets(self, targets):
+        with self.servo.batch():
+            self.servo.set_acceleration(cfg.STEERING, 50)
+            self.servo.set_acceleration(cfg.ESC, 100)
+            self.servo.set_channel_targets(targets)
+        self.applied_targets.update(targets)
+        acks, self.unwritten_acks = self.unwritten_acks, []
+        for seq in acks:
+            self.send_ack(seq)
+
+    def actuate(self, targets):
+        # Handed over from the actuation thread, which may tick once more after run() has stopped the car
+        if self.running:
+            self.write_targets(targets)
+
+    def drive(self, targets):
+        if self.actuation:
+            self.actuation.set_targets(targets)
+        elif self.servo_attached:
+            self.write_targets(targets)
+        else:
+            self.applied_targets.update(targets)
+
+    def apply_pending_targets(self):
+        """
+        Sends the steering and throttle targets gathered from the command queue to the Maestro together, in a single
+        serial write, or hands them to the actuation loop to ramp towards. Acknowledges the batch to the server once
+        the targets are on the Maestro.
+
+        :return: <Int> 0 on success
+        """
+        targets, self.pending_targets = self.pending_targets, {}
+        seq, self.command_seq = self.command_seq, None
+        if targets:
+            self.drive(targets)
+
+        # One ack per command batch, carrying what was last written to the Maestro. With the actuation loop that is the
+        # first step of the ramp, not the command itself.
+        if seq is not None:
+            if self.actuation:
+                # The actuation loop's next tick writes the first step towards the targets, write_targets acks then
+                self.unwritten_acks.append(seq)
+            else:
+                # Written above, or there is no Maestro to wait for
+                self.send_ack(seq)
+
+        return 0
+
+    def send_ack(self, seq):
+        self.server_tx('ack:{}:{:.3f}:{}:{}'.format(seq, time.time(), self.applied_targets[cfg.STEERING],
+                                                     self.applied_targets[cfg.ESC]))
+
+    async def execute_data(self, data):
+        """
+        Function to handle data processing and socket network disconnect
+
+        :param data: <String> data to be processed
+        :return: <Int> 0 on success
+        """
+        # Anything other than a servo target must not overtake the targets received before it
+        if not data[:1].isdigit():
+            self.apply_pending_targets()
+
+        if data == 'kill':
+            print('[DEBUG] Terminating Client')
+            self.center_steering_stop_car()
+            self.running = False
+        elif data == 'start':
+            self.center_steering_stop_car()
+            self.server_tx('status:started')
+        elif data == 'stop':
+            self.center_steering_stop_car()
+            print('[DEBUG] ***** Stopping')
+            self.server_tx('status:stopped')
+        elif data == 'gps':
+            self.send_latest_fix()
+        elif data.startswith('seq:'):
+            self.command_seq = int(data.split(':')[1])
+        elif data.startswith('session:'):
+            self.session_token = data.split(':')[1]
+        elif data.startswith('waypoints:'):
+            self.autopilot.load_waypoints(data)
+        elif data.startswith('heading:'):
+            self.autopilot.load_heading(data)
+        elif data == 'manual':
+            self.autopilot.cancel()
+        elif data == 'disconnect':
+            self.center_steering_stop_car()
+            print('[NETWORK] Disconnect')
+            self.server_tx('status:disconnecting')
+            await asyncio.sleep(5)
+            self.running = False
+        else:
+            tgt = int(data[0])
+            val = int(data[1:len(data)])
+
+            # Guard statement to protect servossy
+            if tgt == cfg.ESC and val > cfg.MAX_SPEED:
+                print('[WARN] Speed would exceed testing limits!')
+            elif self.autopilot.active:
+                print('[AUTONOMY] Ignoring servo command while driving autonomously')
+            elif cfg.MAX_RIGHT <= val <= cfg.MAX_LEFT:
+                self.pending_targets[tgt] = val
+
+        return 0
+
+    def center_steering_stop_car(self):
+        self.autopilot.cancel()
+        if self.actuation:
+            self.actuation.set_targets({cfg.ESC: cfg.NEUTRAL, cfg.STEERING: cfg.CENTER}, immediate=True)
+        elif self.servo_attached:
+            with self.servo.batch():
+                self.servo_ctl(cfg.ESC, cfg.NEUTRAL)
+                self.servo_ctl(cfg.STEERING, cfg.CENTER)
+
+
+if __name__ == "__main__":
+    client = AsyncClient(debug=True, servo_attached=True, gps_attached=True)
+    client.main()
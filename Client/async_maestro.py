@@ -0,0 +1,202 @@
+"""
+Asyncio transport for the Maestro. The TTL port's file descriptor is registered with the event loop: commands are
+written without blocking and every query returns a future that resolves once the Maestro's response has arrived, so
+servo I/O can share a loop with networking.
+"""
+
+import asyncio
+import collections
+import os
+import struct
+
+import maestro
+from maestro import log
+
+RESPONSE_TIMEOUT = 0.5  # s to wait for a query's response before giving up on it and resyncing
+RESYNC_TIME = 0.5  # s of input thrown away after a timeout, late responses to the lost query arrive within it
+
+
+class AsyncDevice(maestro.Device):
+    def __init__(self, con_port="/dev/ttyACM1", ser_port="/dev/ttyACM0", multi_target=False, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.out_buffer = bytearray()  # written to the port as fast as it will take it
+        self.in_buffer = bytearray()
+        self.pending_reads = collections.deque()  # (response size, future, decode), in the order queries were sent
+        self.resyncing = False
+        self.deferred_queries = []  # (response size, future, decode, command, timeout) held back while resyncing
+        self.writer_registered = False
+        maestro.Device.__init__(self, con_port, ser_port, timeout=0, multi_target=multi_target)
+        if self.isInitialized:
+            self.loop.add_reader(self.ser.fileno(), self.on_readable)
+            self.get_errors().add_done_callback(self.log_errors)
+
+    def check_errors(self):
+        # Device.__init__ checks before the port is registered with the loop, the flags are read once it is
+        pass
+
+    @staticmethod
+    def log_errors(future):
+        if future.exception():
+            log("Reading device error flags failed:", repr(future.exception()))
+        else:
+            log("Device error flags read (", future.result(), ") and cleared")
+
+    def close(self):
+        if self.isInitialized:
+            self.loop.remove_reader(self.ser.fileno())
+            self.loop.remove_writer(self.ser.fileno())
+            self.writer_registered = False
+            self.isInitialized = False
+        self.fail_pending_reads(ConnectionError('Maestro closed'))
+
+    ###########################################################################################################################
+    ## Non-blocking transport, replaces the blocking write in Device.send_buffer
+    def send_buffer(self):
+        if not self.cmd_buffer:
+            return
+        self.out_buffer.extend(self.cmd_buffer)
+        del self.cmd_buffer[:]
+        self.on_writable()
+
+    def on_writable(self):
+        try:
+            written = os.write(self.ser.fileno(), self.out_buffer)
+        except BlockingIOError:
+            written = 0
+        except OSError as e:
+            print(e)
+            log("Write to TTL Port failed, servo state cache cleared")
+            self.cache.invalidate()
+            del self.out_buffer[:]
+            self.fail_pending_reads(e)
+            written = 0
+        del self.out_buffer[:written]
+
+        if self.out_buffer and not self.writer_registered:
+            self.loop.add_writer(self.ser.fileno(), self.on_writable)
+            self.writer_registered = True
+        elif not self.out_buffer and self.writer_registered:
+            self.loop.remove_writer(self.ser.fileno())
+            self.writer_registered = False
+
+    def on_readable(self):
+        try:
+            data = os.read(self.ser.fileno(), 256)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # The port is gone (unplugged, EIO), leaving it registered would have the loop spin on it
+            print(e)
+            log("Read from TTL Port failed, Maestro closed")
+            self.fail_pending_reads(e)
+            self.close()
+            return
+
+        if self.resyncing or not self.pending_reads:
+            return  # Left over from a lost query, or nobody asked: nothing to line it up with
+        self.in_buffer.extend(data)
+        while self.pending_reads and len(self.in_buffer) >= self.pending_reads[0][0]:
+            size, future, decode = self.pending_reads.popleft()
+            response = bytes(self.in_buffer[:size])
+            del self.in_buffer[:size]
+            if not future.done():
+                future.set_result(decode(response))
+
+    def query(self, size, decode, *command, timeout=RESPONSE_TIMEOUT):
+        """
+        Sends a command that the Maestro answers with a fixed size response
+
+        :param size: <Int> number of response bytes
+        :param decode: <Function> turns the response bytes into the future's result
+        :param command: command bytes
+        :param timeout: <Float> seconds to wait for the response
+        :return: <Future> resolves to the decoded response
+        """
+        future = self.loop.create_future()
+        if not self.isInitialized:
+            future.set_result(None)
+            return future
+        if self.resyncing:
+            self.deferred_queries.append((size, future, decode, command, timeout))
+        else:
+            self.send_query(size, future, decode, command, timeout)
+
+        return future
+
+    def send_query(self, size, future, decode, command, timeout):
+        self.pending_reads.append((size, future, decode))
+        self.loop.call_later(timeout, self.expire, future)
+        self.write(*command)
+        self.send_buffer()
+
+    def expire(self, future):
+        if future.done():
+            return
+        # Responses come back in order, once one is lost the rest can't be lined up either. The lost response may still
+        # be on its way, so input is thrown away for RESYNC_TIME and new queries wait until it is over.
+        log("Maestro response timed out")
+        self.fail_pending_reads(asyncio.TimeoutError())
+        if not self.resyncing:
+            self.resyncing = True
+            self.loop.call_later(RESYNC_TIME, self.resync)
+
+    def resync(self):
+        self.resyncing = False
+        if not self.isInitialized:
+            return
+        self.ser.reset_input_buffer()
+        del self.in_buffer[:]
+        deferred, self.deferred_queries = self.deferred_queries, []
+        for size, future, decode, command, timeout in deferred:
+            if not future.done():
+                self.send_query(size, future, decode, command, timeout)
+
+    def fail_pending_reads(self, exception):
+        del self.in_buffer[:]
+        while self.pending_reads:
+            future = self.pending_reads.popleft()[1]
+            if not future.done():
+                future.set_exception(exception)
+        while self.deferred_queries:
+            future = self.deferred_queries.pop()[1]
+            if not future.done():
+                future.set_exception(exception)
+
+    ###########################################################################################################################
+    ## Queries, each returns a future instead of blocking on the response
+    def get_position(self, servo):
+        return self.query(2, lambda data: (data[0] | data[1] << 8) / 4, 0x90, servo)
+
+    def get_positions(self, servos, timeout=RESPONSE_TIMEOUT):
+        count = len(servos)
+        command = []
+        for s in servos:
+            command.extend((0x90, s))
+        return self.query(2 * count,
+                          lambda data: [position / 4 for position in struct.unpack('<' + str(count) + 'H', data)],
+                          command, timeout=timeout)
+
+    def get_moving_state(self):
+        return self.query(1, lambda data: data[0], 0x93)
+
+    def get_errors(self):
+        return self.query(2, self.decode_errors, 0xA1)
+
+    def decode_errors(self, data):
+        errors = data[0] | data[1] << 8
+        if errors:
+            # The Maestro may have sent servos to their error positions
+            self.cache.invalidate()
+        return errors
+
+    def set_speed(self, servo, speed):
+        # Same as Device.set_speed without the sleep after writing
+        if not self.isInitialized: log("Not initialized"); return
+        if not self.cache.changed(self.cache.speeds, servo, speed):
+            return
+        highbits, lowbits = divmod(speed, 32)
+        self.write(0x87, servo, lowbits << 2, highbits)
+
+    async def wait_until_at_target(self):
+        while await self.get_moving_state():
+            await asyncio.sleep(0.01)
@@ -0,0 +1,166 @@
+"""
+On-car autonomy. The server uploads a list of waypoints (or a heading to hold) once, then the car runs the stepped
+turning algorithm itself against its own GPS fixes and only reports progress and exceptions back, so a latency spike on
+the link no longer reaches the steering.
+
+Server -> car:  waypoints:<speed>:<x>,<y>;<x>,<y>;...
+                heading:<speed>:<heading>
+Car -> server:  progress:<waypoints reached>:<waypoints left>
+                progress:complete
+                exception:<description>
+"""
+
+import collections
+import math
+
+# This is intentionally wrong, do not change or everything will burn!
+import client_cfg as cfg
+import navigation
+
+
+class AutonomyData:
+    """
+    The part of the server's CarData the autopilot keeps track of
+    """
+
+    def __init__(self):
+        self.XPOS = 0.0
+        self.YPOS = 0.0
+        self.TGTXPOS = 0.0
+        self.TGTYPOS = 0.0
+        self.HEADING = 0.0
+        self.TURNANGLE = 0.0
+        self.SPEED = 0.0
+        self.INTERVAL_TIMER = 0.25
+
+
+class Autopilot:
+    def __init__(self, send, drive, debug, gps_connected):
+        """
+        :param send: <Function> sends a message to the server
+        :param drive: <Function> applies a dict of channel: pulse to the servos
+        :param debug: <Boolean> Debug mode (T/F)
+        :param gps_connected: <Boolean> parse real GGA sentences (T) or make up positions (F)
+        """
+        self.send = send
+        self.drive = drive
+        self.debug = debug
+        self.gps_connected = gps_connected
+        self.cardata = AutonomyData()
+        self.waypoints = collections.deque()
+        self.waypoints_reached = 0
+        self.target_heading = None
+        self.speed = 0.0
+        self.active = False
+        self.last_fix_time = None
+
+    def load_waypoints(self, data):
+        """
+        :param data: <String> waypoints:<speed>:<x>,<y>;<x>,<y>;...
+        :return: <Int> 0 on success
+        """
+        speed, points = data.split(':')[1:3]
+        self.waypoints = collections.deque([float(value) for value in point.split(',')] for point in points.split(';'))
+        self.waypoints_reached = 0
+        self.target_heading = None
+        self.speed = float(speed)
+        self.active = True
+        print('[AUTONOMY] Driving ' + str(len(self.waypoints)) + ' waypoints at ' + speed + 'm/s')
+
+        return 0
+
+    def load_heading(self, data):
+        """
+        :param data: <String> heading:<speed>:<heading>
+        :return: <Int> 0 on success
+        """
+        speed, heading = data.split(':')[1:3]
+        self.waypoints.clear()
+        self.target_heading = float(heading) % 360
+        self.speed = float(speed)
+        self.active = True
+        print('[AUTONOMY] Holding heading ' + heading + ' at ' + speed + 'm/s')
+
+        return 0
+
+    def cancel(self):
+        if self.active:
+            print('[AUTONOMY] Back to manual control')
+        self.active = False
+        self.waypoints.clear()
+        self.target_heading = None
+
+    def on_fix(self, timestamp, message):
+        """
+        Steers towards the current waypoint (or heading) from a fresh GPS fix
+
+        :param timestamp: <Float> time the fix was read
+        :param message: <String> GGA sentence
+        :return: <Int> 0 on success
+        """
+        if not self.active:
+            self.last_fix_time = None
+            return 0
+
+        try:
+            self.update_position(timestamp, message)
+            desired_heading = self.choose_heading()
+            if desired_heading is None:
+                return 0
+
+            turn_angle, speed_coefficient = navigation.choose_turn(self.cardata.HEADING, desired_heading)
+            self.cardata.TURNANGLE = turn_angle
+            self.cardata.SPEED = self.speed * speed_coefficient
+            # Expected heading once the turn is applied, until the next fix says otherwise
+            self.cardata.HEADING = (self.cardata.HEADING + turn_angle) % 360
+            self.drive({cfg.STEERING: navigation.turn_signal(turn_angle),
+                        cfg.ESC: navigation.speed_signal(self.cardata.SPEED)})
+        except (ValueError, IndexError) as e:
+            # A bad fix, keep the last command and wait for the next one
+            self.send('exception:' + self.describe(e))
+
+        return 0
+
+    def update_position(self, timestamp, message):
+        xpos, ypos = navigation.field_position(message, self.gps_connected)
+        moved = math.hypot(xpos - self.cardata.XPOS, ypos - self.cardata.YPOS)
+        if self.last_fix_time is not None:
+            self.cardata.INTERVAL_TIMER = timestamp - self.last_fix_time
+            # GPS only gives position, so take the heading from how we moved since the last fix
+            if moved > cfg.HEADING_MIN_DISTANCE:
+                self.cardata.HEADING = self.compass_heading(xpos - self.cardata.XPOS, ypos - self.cardata.YPOS)
+        self.last_fix_time = timestamp
+        self.cardata.XPOS = xpos
+        self.cardata.YPOS = ypos
+
+    def choose_heading(self):
+        """
+        :return: <Float> heading to steer for in degrees, None once the route is complete
+        """
+        if self.target_heading is not None:
+            return self.target_heading
+
+        while self.waypoints and math.hypot(self.waypoints[0][0] - self.cardata.XPOS,
+                                            self.waypoints[0][1] - self.cardata.YPOS) <= cfg.WAYPOINT_RADIUS:
+            self.waypoints.popleft()
+            self.waypoints_reached += 1
+            self.send('progress:' + str(self.waypoints_reached) + ':' + str(len(self.waypoints)))
+
+        if not self.waypoints:
+            self.drive({cfg.STEERING: cfg.CENTER, cfg.ESC: cfg.NEUTRAL})
+            self.send('progress:complete')
+            self.cancel()
+            return None
+
+        self.cardata.TGTXPOS, self.cardata.TGTYPOS = self.waypoints[0]
+        return self.compass_heading(self.cardata.TGTXPOS - self.cardata.XPOS, self.cardata.TGTYPOS - self.cardata.YPOS)
+
+    @staticmethod
+    def compass_heading(dx, dy):
+        # Same convention as the server's Turning.find_speed_components: 0 degrees is +y, 90 degrees is +x
+        return math.degrees(math.atan2(dx, dy)) % 360
+
+    @staticmethod
+    def describe(exception):
+        # ':' and '\' would break the message framing
+        return (type(exception).__name__ + ' ' + str(exception)).replace(':', ' ').replace('\\', '/')
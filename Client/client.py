@@ -1,39 +1,85 @@
 import re
 import socket
 import sys
+import threading
 import time
 import traceback
-import os
 
 # This is intentionally wrong, do not change or everything will burn!
 import client_cfg as cfg
 import maestro as maestro
+from actuation import ActuationLoop
+from autonomy import Autopilot
+from gps_stream import GPSStreamer
+from reconnect import reconnect_delay
 
 
 class Client:
     def __init__(self, debug, servo_attached, gps_attached):
         self.gps_attached = gps_attached
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.settimeout(0.1)
+        self.tx_lock = threading.Lock()
+        self.sock = None
+        self.session_token = None  # handed out by the server, lets it reattach us to our drone after a reconnect
+        # Opening the Maestro waits on its error flags, do that while the connection is being set up
+        self.servo = None
+        self.servo_error = None
+        servo_init = threading.Thread(target=self.open_servo, name='servo-init', daemon=True)
+        servo_init.start()
         self.connect_to_server()
-        print("Connected on port ", cfg.HOST_PORTS, ". Ready to receive data.")
-        self.servo = maestro.Device()
+        servo_init.join()
+        if self.servo_error:
+            raise self.servo_error
         self.debug = debug
         self.servo_attached = servo_attached
+        self.pending_targets = {}  # channel: pulse, gathered from one batch of messages
+        self.servo_lock = threading.RLock()  # the autopilot drives from the GPS thread, held across nested batches
+        self.actuation = None
+        if servo_attached and cfg.ACTUATION_RATE:
+            self.actuation = ActuationLoop(self.write_targets, debug)
+            self.actuation.start()
+        self.command_seq = None  # sequence number of the command batch being received
+        self.applied_targets = {cfg.STEERING: cfg.CENTER, cfg.ESC: cfg.NEUTRAL}
+        self.unwritten_acks = []  # command batches handed to the actuation loop but not yet written to the Maestro
+        self.autopilot = Autopilot(self.autopilot_tx, self.drive, debug, gps_attached)
+        # Always reading, the autopilot needs every fix. Fixes only go upstream on their own when streaming.
+        self.gps_streamer = GPSStreamer(self.server_tx if cfg.GPS_STREAMING else None, gps_attached, debug,
+                                        on_fix=self.autopilot.on_fix)
+
+    def open_servo(self):
+        # Runs on its own thread, hand any failure back to __init__ to raise there
+        try:
+            self.servo = maestro.Device(cfg.MAESTRO_CON_PORT, cfg.MAESTRO_SER_PORT,
+                                         multi_target=cfg.MAESTRO_MULTI_TARGET)
+        except Exception as e:
+            self.servo_error = e
 
     def connect_to_server(self):
-        connected = False
-        port_number = 0
-        while not connected:
+        """
+        Connects to the server, cycling through HOST_PORTS with jittered backoff until one accepts. If the server gave us
+        a session before, asks it to resume that session.
+
+        :return: <Int> port connected on
+        """
+        attempt = 0
+        while True:
+            port = cfg.HOST_PORTS[attempt % len(cfg.HOST_PORTS)]
             try:
-                self.sock.connect((cfg.HOST_IP_FOF, cfg.HOST_PORTS[port_number]))
-                connected = True
+                sock = socket.create_connection((cfg.HOST_IP_FOF, port), timeout=0.1)
+                break
             except socket.error:
-                port_number += 1
-                traceback.print_exc()
-                sys.exit(1)
+                delay = reconnect_delay(attempt)
+                print('[NETWORK] Connection to port ' + str(port) + ' failed, retrying in {:.2f}s'.format(delay))
+                attempt += 1
+                time.sleep(delay)
 
-        return cfg.HOST_PORTS[port_number]
+        with self.tx_lock:
+            self.sock = sock
+        self.rx_buffer = ''
+        print("Connected on port ", port, ". Ready to receive data.")
+        if self.session_token:
+            self.server_tx('resume:' + self.session_token)
+
+        return port
 
     def main(self):
         """
@@ -43,7 +89,9 @@ class Client:
             socket.error, TypeError, KeyboardInterrupt
         """
         #init gps transmit to server
-        self.get_gps()
+        self.gps_streamer.start()
+        if not cfg.GPS_STREAMING:
+            self.get_gps()
         while(True):
             try:
                 data = self.request_velocity_vector()
@@ -51,16 +99,19 @@ class Client:
                 if data:
                     data_array = self.separate_data(data)
                     self.execute_each_message(data_array)
-                    self.get_gps()
+                    if not cfg.GPS_STREAMING:
+                        self.get_gps()
                 else:
                     print('No data in socket')
             except TypeError:
-                print(traceback.print_exc())
+                traceback.print_exc()
                 self.sock.close()
                 sys.exit()
             except socket.error:
-                print('[NETWORK] Socket Error: \n', traceback.print_exc())
-                break
+                print('[NETWORK] Socket Error: \n', traceback.format_exc())
+                self.center_steering_stop_car()
+                self.sock.close()
+                self.connect_to_server()
             except KeyboardInterrupt:
                 self.execute_data('stop')
                 break
@@ -71,6 +122,7 @@ class Client:
             result = self.execute_data(message)
             if result == 404:
                 break
+        self.apply_pending_targets()
 
     def print_debug_info(self, message):
         if self.debug:
@@ -91,7 +143,15 @@ class Client:
         try:
             data = self.sock.recv(64).decode('utf8')
         except socket.timeout:
-            print('*')
+            return None
+        if not data:
+            raise socket.error('Server closed the connection')
+
+        # Waypoint uploads don't fit in one recv, hold back any partial message until the rest arrives
+        self.rx_buffer += data
+        end = self.rx_buffer.rfind('\\') + 1
+        data, self.rx_buffer = self.rx_buffer[:end], self.rx_buffer[end:]
+        return data
 
     @staticmethod
     def test_device():
@@ -129,7 +189,16 @@ class Client:
         return 0
 
     def server_tx(self, data):
-        self.sock.sendall(bytearray(data + '\\', 'utf-8'))
+        # The GPS streamer sends from its own thread
+        with self.tx_lock:
+            self.sock.sendall(bytearray(data + '\\', 'utf-8'))
+
+    def autopilot_tx(self, data):
+        # The autopilot reports from the GPS thread, a dropped link is for the main loop to notice and reconnect
+        try:
+            self.server_tx(data)
+        except socket.error:
+            print('[AUTONOMY] Could not report to the server: ' + data)
 
     def servo_ctl(self, servo_num, val):
         """
@@ -140,14 +209,69 @@ class Client:
         :return: <Int> 0 on success
         """
 
-        self.servo.set_acceleration(cfg.STEERING, 50)
-        self.servo.set_acceleration(cfg.ESC, 100)
+        # Repeats are dropped by the Device's state cache, these only go out after a reset or serial error
+        with self.servo_lock, self.servo.batch():
+            self.servo.set_acceleration(cfg.STEERING, 50)
+            self.servo.set_acceleration(cfg.ESC, 100)
 
-        self.servo.set_target(servo_num, val)
+            self.servo.set_target(servo_num, val)
         print('[DEBUG] Exiting servo_ctl function')
 
         return 0
 
+    def write_targets(self, targets):
+        with self.servo_lock:
+            with self.servo.batch():
+                self.servo.set_acceleration(cfg.STEERING, 50)
+                self.servo.set_acceleration(cfg.ESC, 100)
+                self.servo.set_channel_targets(targets)
+            self.applied_targets.update(targets)
+            acks, self.unwritten_acks = self.unwritten_acks, []
+
+        try:
+            for seq in acks:
+                self.send_ack(seq)
+        except socket.error:
+            pass  # called from the actuation thread, the main loop sees the connection drop and reconnects
+
+    def drive(self, targets):
+        if self.actuation:
+            self.actuation.set_targets(targets)
+        elif self.servo_attached:
+            self.write_targets(targets)
+        else:
+            self.applied_targets.update(targets)
+
+    def apply_pending_targets(self):
+        """
+        Sends the steering and throttle targets gathered from a batch of messages to the Maestro together, in a single
+        serial write, or hands them to the actuation loop to ramp towards. Acknowledges the batch to the server once
+        the targets are on the Maestro.
+
+        :return: <Int> 0 on success
+        """
+        targets, self.pending_targets = self.pending_targets, {}
+        seq, self.command_seq = self.command_seq, None
+        if targets:
+            self.drive(targets)
+
+        # One ack per command batch, carrying what was last written to the Maestro. With the actuation loop that is the
+        # first step of the ramp, not the command itself.
+        if seq is not None:
+            if self.actuation:
+                # The actuation loop's next tick writes the first step towards the targets, write_targets acks then
+                with self.servo_lock:
+                    self.unwritten_acks.append(seq)
+            else:
+                # Written above, or there is no Maestro to wait for
+                self.send_ack(seq)
+
+        return 0
+
+    def send_ack(self, seq):
+        self.server_tx('ack:{}:{:.3f}:{}:{}'.format(seq, time.time(), self.applied_targets[cfg.STEERING],
+                                                     self.applied_targets[cfg.ESC]))
+
     def execute_data(self, data):
         """
         Function to handle data processing and socket network disconnect
@@ -158,6 +282,10 @@ class Client:
         """
         # data = data[2:len(data)-1]
 
+        # Anything other than a servo target must not overtake the targets received before it
+        if not data[:1].isdigit():
+            self.apply_pending_targets()
+
         if data == 'kill':
             self.sock.close()
             print('[DEBUG] Terminating Client')
@@ -171,6 +299,16 @@ class Client:
             self.center_steering_stop_car()
             print('[DEBUG] ***** Stopping')
             self.server_tx('status:stopped')
+        elif data.startswith('seq:'):
+            self.command_seq = int(data.split(':')[1])
+        elif data.startswith('session:'):
+            self.session_token = data.split(':')[1]
+        elif data.startswith('waypoints:'):
+            self.autopilot.load_waypoints(data)
+        elif data.startswith('heading:'):
+            self.autopilot.load_heading(data)
+        elif data == 'manual':
+            self.autopilot.cancel()
         elif data == 'disconnect':
             self.center_steering_stop_car()
             print('[NETWORK] Disconnect')
@@ -181,29 +319,31 @@ class Client:
             tgt = int(data[0])
             val = int(data[1:len(data)])
 
-            self.server_tx('status:turn received')
-
             print("target: " + str(tgt) + "\nvalue: " + str(val))
 
             # Guard statement to protect servossy
             if tgt == cfg.ESC and val > cfg.MAX_SPEED:
                 print('[WARN] Speed would exceed testing limits!')
             else:
-                if cfg.MAX_RIGHT <= val <= cfg.MAX_LEFT:
-                    print('[SERVO] Entering servo_ctl function with value of: ' +
+                if self.autopilot.active:
+                    print('[AUTONOMY] Ignoring servo command while driving autonomously')
+                elif cfg.MAX_RIGHT <= val <= cfg.MAX_LEFT:
+                    print('[SERVO] Queueing target for channel ' + str(tgt) + ' with value of: ' +
                           str(val))
-                    if self.servo_attached:
-                        self.servo_ctl(tgt, val)
-                    self.server_tx('status:turn executed')
+                    self.pending_targets[tgt] = val
 
         print('[DEBUG] Exiting execute_data function')
 
         return 0
 
     def center_steering_stop_car(self):
-        if self.servo_attached:
-            self.servo_ctl(cfg.ESC, cfg.NEUTRAL)
-            self.servo_ctl(cfg.STEERING, cfg.CENTER)
+        self.autopilot.cancel()
+        if self.actuation:
+            self.actuation.set_targets({cfg.ESC: cfg.NEUTRAL, cfg.STEERING: cfg.CENTER}, immediate=True)
+        elif self.servo_attached:
+            with self.servo_lock, self.servo.batch():
+                self.servo_ctl(cfg.ESC, cfg.NEUTRAL)
+                self.servo_ctl(cfg.STEERING, cfg.CENTER)
 
     def get_gps(self):
         """
@@ -212,22 +352,12 @@ class Client:
         """
 
         if self.gps_attached:
-            #print('********************')
-            #file_buffer = open('/dev/ttyACM2', 'r')
-
-            #search = re.match('.GPGGA.\S*', file_buffer.readline())
-
-            #while not search:
-            #    search = re.match('.GPGGA.\S*', file_buffer.readline())
-            #    print('test')
-
-            #message = search.group(0)
-
-            os.system('grep --line-buffered -m 1 GGA /dev/ttyACM2 > gps.txt')
-            myfile = open('gps.txt', 'r')
-            message = myfile.read()
-            myfile.close()
-            message = message[:-1]
+            # The GPS streamer owns the port, report the freshest fix it has read
+            fix = self.gps_streamer.latest_fix
+            if fix is None:
+                print('[GPS] No fix yet')
+                return None
+            message = fix[1]
 
         else:
             message = "$GPGGA,172814.0,3723.46587704,N,12202.26957864,W,2,6,1.2,18.893, \
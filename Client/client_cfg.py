@@ -13,6 +13,12 @@ MAX_SPEED = 2000
 MAX_TURN_RADIUS = 30  # degrees
 MAXVELOCITY = 13.4  # m/s
 STEERING = 5
+MAESTRO_CON_PORT = '/dev/ttyACM1'
+MAESTRO_SER_PORT = '/dev/ttyACM0'
+MAESTRO_MULTI_TARGET = False  # Set Multiple Targets, Mini Maestro 12/18/24 only
+ACTUATION_RATE = 50  # Hz, fixed rate servo loop ramping towards the last command, 0 writes commands as they arrive
+STEERING_SLEW_RATE = 2000  # pulse units per second the steering target is ramped at
+THROTTLE_SLEW_RATE = 1000  # pulse units per second the throttle target is ramped at
 MIN_SPEED = 1580
 TURNDELAY = 30
 TURNDIAMETER = 1.5
@@ -26,6 +32,10 @@ HOST_IP = "0.0.0.0"
 HOST_IP_FOF = "192.168.0.125"  # <-- This is the internal IP on the machine running car_controller.py (ipconfig/ifconfig)
 HOST_PORTS = [8000, 8001, 8002]
 HOST = ''
+COMMAND_QUEUE_SIZE = 16  # async client: servo/control messages waiting to execute
+STATUS_QUEUE_SIZE = 32  # async client: status and gps messages waiting to be sent
+RECONNECT_BASE_DELAY = 0.1  # s, first reconnect backoff, doubles on every failed attempt
+RECONNECT_MAX_DELAY = 5.0  # s, backoff cap
 
 # GPS VALUES #
 ORIGIN = [0, 0]
@@ -36,6 +46,23 @@ CORNER_LONG = -81.046161
 ROTATION_ANGLE = -45
 RADIUS_OF_EARTH = 6378137  # m
 NOISE = 0.0000005
+GPS_PORT = '/dev/ttyACM2'
+GPS_STREAMING = False  # push fixes to the server on our own timer instead of after each command
+GPS_STREAM_RATE = 0  # Hz, 0 sends every fix at the receiver's native rate
+GPS_REOPEN_DELAY = 1.0  # s between attempts to reopen a GPS port that closed (async client)
+
+# AUTONOMY VALUES #
+WAYPOINT_RADIUS = 2.0  # m, a waypoint counts as reached inside this distance
+HEADING_MIN_DISTANCE = 0.5  # m the car has to move between fixes before its heading is updated
+# Stepped turning, as in server_cfg so the car steers the way the server would
+MAX_DEGREE_TURN = 50  # degrees of wheel turn across the whole steering range
+MIN_MOVE_SPEED = 1567  # ESC pulse the car starts moving at
+DEGREE_GRADIENT = (MAX_LEFT - MAX_RIGHT) / MAX_DEGREE_TURN
+VELOCITY_GRADIENT = (MAX_SPEED - NEUTRAL) / MAXVELOCITY
+TURN_ANGLES = (5, 10, 15)  # degrees of wheel turn for small, medium and large heading errors
+TURN_SPEED_COEFFICIENTS = (0.75, 0.50, 0.25)  # speed multiplier for each of those turns
+SMALL_TURN_TOLERANCE = 5  # degrees of heading error still handled with a small turn
+LARGE_TURN_TOLERANCE = 45  # degrees of heading error still handled with a medium turn
 
 # MOCK SIM VALUES #
 DIRCHANGEFACTOR = 0.25  # % chance of changing velocity input for testing
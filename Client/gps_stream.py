@@ -0,0 +1,124 @@
+"""
+Pushes GPS fixes from the car to the server on the car's own timer, so the server never has to ask for one.
+"""
+
+import re
+import threading
+import time
+
+# This is intentionally wrong, do not change or everything will burn!
+import client_cfg as cfg
+
+GGA_PATTERN = re.compile(r'\$..GGA,\S*')
+SIMULATED_FIX = "$GPGGA,172814.0,3723.46587704,N,12202.26957864,W,2,6,1.2,18.893,M,-25.669,M,2.0,0031*4F"
+SIMULATED_FIX_INTERVAL = 1.0  # s, mimics a 1Hz receiver when no GPS is attached
+
+
+class GPSStreamer:
+    def __init__(self, send, gps_attached, debug, rate=cfg.GPS_STREAM_RATE, port=cfg.GPS_PORT, on_fix=None):
+        """
+        :param send: <Function> called with each outgoing message, e.g. Client.server_tx. None only reads fixes.
+        :param gps_attached: <Boolean> read fixes from the GPS port (T) or send a canned fix (F)
+        :param debug: <Boolean> Debug mode (T/F)
+        :param rate: <Float> fixes per second to send, 0 sends every fix as soon as it is read
+        :param port: <String> serial device the GPS writes NMEA sentences to
+        :param on_fix: <Function> called with (timestamp, GGA sentence) for every fix read, e.g. Autopilot.on_fix
+        """
+        self.send = send
+        self.on_fix = on_fix
+        self.gps_attached = gps_attached
+        self.debug = debug
+        self.rate = rate
+        self.port = port
+        self.latest_fix = None  # (timestamp, GGA sentence)
+        self.sent_fix = None
+        self.running = False
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self.read_fixes, daemon=True)]
+        if self.rate and self.send:
+            self.threads.append(threading.Thread(target=self.publish_fixes, daemon=True))
+        for thread in self.threads:
+            thread.start()
+        if self.send:
+            print('[GPS] Streaming fixes at ' + (str(self.rate) + 'Hz' if self.rate else 'native rate'))
+
+    def stop(self):
+        self.running = False
+
+    def read_fixes(self):
+        """
+        Reads GGA sentences as fast as the receiver produces them and keeps the newest one
+
+        :return: <Int> 0 once stopped
+        """
+        for message in self.gga_sentences():
+            if not self.running:
+                break
+            fix = (time.time(), message)
+            with self.lock:
+                self.latest_fix = fix
+            if self.on_fix:
+                self.on_fix(*fix)
+            if not self.rate:
+                self.send_fix()
+
+        return 0
+
+    def publish_fixes(self):
+        """
+        Sends the newest fix at the configured rate, skipping ticks where no new fix has arrived
+
+        :return: <Int> 0 once stopped
+        """
+        interval = 1.0 / self.rate
+        next_tick = time.time()
+        while self.running:
+            self.send_fix()
+            next_tick += interval
+            time.sleep(max(0.0, next_tick - time.time()))
+
+        return 0
+
+    def send_fix(self):
+        if not self.send:
+            return
+        with self.lock:
+            fix = self.latest_fix
+            if fix is None or fix is self.sent_fix:
+                return
+            self.sent_fix = fix
+
+        timestamp, message = fix
+        try:
+            self.send(self.format_fix(timestamp, message))
+        except OSError:
+            return  # Link is down, the client is reconnecting and a newer fix will follow
+        if self.debug:
+            print('[GPS] ' + message)
+
+    @staticmethod
+    def format_fix(timestamp, message):
+        """
+        Builds the gps message sent upstream, the server keeps whichever fix has the newest timestamp
+
+        :param timestamp: <Float> time.time() at which the fix was read
+        :param message: <String> GGA sentence
+        :return: <String> gps:<GGA sentence>:<timestamp>
+        """
+        return 'gps:' + message + ':' + '{:.3f}'.format(timestamp)
+
+    def gga_sentences(self):
+        if not self.gps_attached:
+            while True:
+                yield SIMULATED_FIX
+                time.sleep(SIMULATED_FIX_INTERVAL)
+
+        with open(self.port, 'r') as gps_port:
+            for line in gps_port:
+                search = GGA_PATTERN.search(line)
+                if search:
+                    yield search.group(0)
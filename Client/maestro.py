@@ -46,6 +46,8 @@
 # (C) 2010 Juhapekka Piiroinen
 #          Brian Wu
 ############################################################################################
+import contextlib
+import struct
 import time
 
 import serial
@@ -56,14 +58,43 @@ def log(*msgline):
         print(msg)
 
 
+###########################################################################################################################
+## Servo state cache
+# Remembers the last target, speed and acceleration written to each channel so that commands which would not change
+# anything on the Maestro are never sent. Anything that may have moved the servos behind our back (serial errors, error
+# flags, go home, reconnecting) must invalidate it.
+class ServoStateCache(object):
+    def __init__(self):
+        self.targets = {}
+        self.speeds = {}
+        self.accelerations = {}
+
+    def invalidate(self):
+        self.targets.clear()
+        self.speeds.clear()
+        self.accelerations.clear()
+
+    @staticmethod
+    def changed(table, channel, value):
+        # Records the value and returns True if it differs from what the channel was last set to
+        if table.get(channel) == value:
+            return False
+        table[channel] = value
+        return True
+
+
 class Device(object):
     def __init__(self, con_port="/dev/ttyACM1", ser_port="/dev/ttyACM0",
-                 timeout=1):  # /dev/ttyACM0  and   /dev/ttyACM1  for Linux
+                 timeout=1, multi_target=False):  # /dev/ttyACM0  and   /dev/ttyACM1  for Linux
         ############################
         # lets introduce and init the main variables
         self.con = None
         self.ser = None
         self.isInitialized = False
+        self.multi_target = multi_target  # Set Multiple Targets is only on the Mini Maestro 12, 18 and 24
+        self.cache = ServoStateCache()
+        self.cmd_buffer = bytearray()  # commands waiting to go out in the next serial write
+        self.batch_depth = 0
 
         ############################
         # lets connect the TTL Port
@@ -102,26 +133,76 @@ class Device(object):
 
         self.isInitialized = (self.con is not None and self.ser is not None)
         if self.isInitialized:
-            err_flags = self.get_errors()
-            log("Device error flags read (", err_flags, ") and cleared")
+            self.check_errors()
         log("Device initialized:", self.isInitialized)
 
+    def check_errors(self):
+        err_flags = self.get_errors()
+        log("Device error flags read (", err_flags, ") and cleared")
+
     ###########################################################################################################################
     ## common write function for handling all write related tasks
+    # Command bytes are appended to a reusable buffer and sent with a single serial write, or held until the end of the
+    # enclosing batch() block.
     def write(self, *data):
         if not self.isInitialized: log("Not initialized"); return
-        if not self.ser.writable():
-            log("Device not writable")
-            return
         for d in data:
             if type(d) is list:
                 # Handling for writing to multiple servos at same time
-                for li in d:
-                    self.ser.write(bytes([li]))
+                self.cmd_buffer.extend(d)
             else:
-                self.ser.write(bytes([d]))
+                self.cmd_buffer.append(d)
+
+        if not self.batch_depth:
+            self.send_buffer()
 
-        self.ser.flush()
+    def send_buffer(self):
+        if not self.cmd_buffer:
+            return
+        if not self.ser.writable():
+            log("Device not writable")
+            self.cache.invalidate()
+            del self.cmd_buffer[:]
+            return
+        try:
+            self.ser.write(self.cmd_buffer)
+            self.ser.flush()
+        except serial.serialutil.SerialException as e:
+            print(e)
+            log("Write to TTL Port failed, servo state cache cleared")
+            self.reconnect()
+        finally:
+            del self.cmd_buffer[:]
+
+    ###########################################################################################################################
+    ## Batch several commands into one serial transaction
+    # with device.batch():
+    #     device.set_target(5, 1500)
+    #     device.set_target(3, 1600)
+    # Blocks may be nested, everything goes out when the outermost one exits.
+    @contextlib.contextmanager
+    def batch(self):
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth and self.isInitialized:
+                self.send_buffer()
+
+    ###########################################################################################################################
+    ## Reopen the TTL port after it has dropped out. Nothing we cached about the channels can be trusted afterwards.
+    def reconnect(self):
+        self.cache.invalidate()
+        if not self.ser:
+            return
+        try:
+            self.ser.close()
+            self.ser.open()
+            log("Link to TTL Port -", self.ser.port, "- reopened")
+        except serial.serialutil.SerialException as e:
+            print(e)
+            log("Link to TTL Port -", self.ser.port, "- failed!")
 
     ###########################################################################################################################
     ## Go Home
@@ -134,6 +215,7 @@ class Device(object):
     def go_home(self):
         if not self.isInitialized: log("Not initialized"); return
         self.write(0xA2)
+        self.cache.targets.clear()
 
     ###########################################################################################################################
     ## Set Target
@@ -150,6 +232,8 @@ class Device(object):
             return
         # time.sleep(0.0001)
         value = int(value) * 4
+        if not self.cache.changed(self.cache.targets, servo, value):
+            return
         log("servo: {} value: {}".format(servo, value))
         commandByte = 0x84
         commandByte2 = 0xaa + 0x0c + 0x04
@@ -162,11 +246,13 @@ class Device(object):
         if angle > 180 or angle < 0:
             angle = 90
         byteone = int(254 * angle / 180)
+        self.cache.targets.pop(servo, None)
         self.write(0xFF, servo, byteone)
 
     def setRotation(self, servo, angle):
         if angle > 254 or angle < 0:
             angle = 127
+        self.cache.targets.pop(servo, None)
         self.write(0xFF, servo, angle)
 
     ##########################################################################################################################
@@ -182,20 +268,45 @@ class Device(object):
     # Source: http://www.pololu.com/docs/pdf/0J40/maestro.pdf
     def set_targets(self, num_targets, start_channel, values):
         if not self.isInitialized: log("Not initialized"); return
+        if type(start_channel) is list:
+            start_channel = min(start_channel)
+
         result = []
         for k in range(num_targets):
-            print("K=", values[k])
-            highbits, lowbits = divmod(values[k], 32)
-            # lowbits = values[k] & 0x7F
-            # highbits = (values[k] >> 7) & 0x7F
-
-            result.append(lowbits)
-            result.append(highbits)
+            value = int(values[k]) * 4
+            result.append(value & 0x7F)
+            result.append((value >> 7) & 0x7F)
+            self.cache.targets[start_channel + k] = value
+
+        self.write(0x9F, num_targets, start_channel, result)
+
+    ## Set the targets of any channels at once
+    # targets is a dict of channel: target. Only channels whose target changed are sent. When the Maestro supports Set
+    # Multiple Targets they go out as one frame covering the block between the lowest and highest changed channel, with
+    # the channels in between held at their cached targets. Otherwise (or if a channel in between has never been set) they
+    # are sent as individual Set Target commands in a single serial write.
+    def set_channel_targets(self, targets):
+        if not self.isInitialized: log("Not initialized"); return
+        changed = [channel for channel in sorted(targets) if self.cache.targets.get(channel) != int(targets[channel]) * 4]
+        if not changed:
+            return
 
-        if type(start_channel) is list:
-            start_channel = min(start_channel)
+        block = []
+        for channel in range(changed[0], changed[-1] + 1):
+            if channel in targets:
+                block.append(int(targets[channel]))
+            elif channel in self.cache.targets:
+                block.append(self.cache.targets[channel] // 4)
+            else:
+                block = None
+                break
 
-        self.write(0x9F, num_targets, start_channel, lowbits, highbits, lowbits, highbits)
+        with self.batch():
+            if self.multi_target and block is not None:
+                self.set_targets(len(block), changed[0], block)
+            else:
+                for channel in changed:
+                    self.set_target(channel, targets[channel])
 
     ###########################################################################################################################
     ## Set Speed
@@ -216,6 +327,8 @@ class Device(object):
     # Source: http://www.pololu.com/docs/pdf/0J40/maestro.pdf
     def set_speed(self, servo, speed):
         if not self.isInitialized: log("Not initialized"); return
+        if not self.cache.changed(self.cache.speeds, servo, speed):
+            return
         highbits, lowbits = divmod(speed, 32)
         self.write(0x87, servo, lowbits << 2, highbits)
         time.sleep(0.1)
@@ -225,13 +338,15 @@ class Device(object):
         index = 0
         for s in servos:
             if type(speeds) is list:
-                highbits, lowbits = divmod(speeds[index], 32)
-                self.write(0x87, s, lowbits << 2, highbits)
+                if self.cache.changed(self.cache.speeds, s, speeds[index]):
+                    highbits, lowbits = divmod(speeds[index], 32)
+                    self.write(0x87, s, lowbits << 2, highbits)
                 # log("MULTI: channel %s; speed %s"%(s,speeds[index]))
                 index += 1
             elif type(speeds) is int:
-                highbits, lowbits = divmod(speeds, 32)
-                self.write(0x87, s, lowbits << 2, highbits)
+                if self.cache.changed(self.cache.speeds, s, speeds):
+                    highbits, lowbits = divmod(speeds, 32)
+                    self.write(0x87, s, lowbits << 2, highbits)
                 # log("SINGLE: channel %s; speed %s"%(s,speeds))
             else:
                 log("Set Speed: <Type> Error")
@@ -254,6 +369,8 @@ class Device(object):
     # Source: http://www.pololu.com/docs/pdf/0J40/maestro.pdf
     def set_acceleration(self, servo, acceleration):
         if not self.isInitialized: log("Not initialized"); return
+        if not self.cache.changed(self.cache.accelerations, servo, acceleration):
+            return
         highbits, lowbits = divmod(acceleration, 32)
         self.write(0x89, servo, lowbits << 2, highbits)
 
@@ -302,6 +419,7 @@ class Device(object):
         # command = chr(0xaa) + chr(0x0c)+chr(0x10)+chr(servo)
         self.write(0x90, servo)
         # self.write(0xAA, 0x0C, 0x10, servo)
+        self.send_buffer()
 
         data = self.ser.read(2)
         if data:
@@ -309,19 +427,33 @@ class Device(object):
         else:
             return None
 
-    def get_positions(self, servos):
+    ## Get the positions of several channels in one round trip
+    # Every Get Position query goes out in a single write and all 2*N response bytes are read back in one go, bounded by
+    # timeout (the port's timeout if not given). Channels whose response did not arrive in time are returned as None.
+    def get_positions(self, servos, timeout=None):
         if not self.isInitialized: log("Not initialized"); return None
-        result = []
-        for s in servos:
-            self.write(0x90, servos)
-            data = self.ser.read(2)
-            if data:
-                result.append((int(data[0]) + (int(data[1]) << 8)) / 4)
-            else:
-                result.append(None)
+        with self.batch():
+            for s in servos:
+                self.write(0x90, s)
+
+        data = self.read_response(2 * len(servos), timeout)
+        answered = len(data) // 2
+        result = [position / 4 for position in struct.unpack_from('<' + str(answered) + 'H', data)]
+        result.extend([None] * (len(servos) - answered))
 
         return result
 
+    def read_response(self, size, timeout=None):
+        # pyserial's read returns as soon as size bytes are in, or with whatever arrived once the timeout expires
+        if timeout is None:
+            return self.ser.read(size)
+        port_timeout = self.ser.timeout
+        self.ser.timeout = timeout
+        try:
+            return self.ser.read(size)
+        finally:
+            self.ser.timeout = port_timeout
+
     ###########################################################################################################################    
     ## Get Moving State
     # Compact protocol: 0x93
@@ -338,6 +470,7 @@ class Device(object):
             log("Not initialized")
             return None
         self.write(0x93)
+        self.send_buffer()
         data = self.ser.read(1)
         if data:
             return data[0]
@@ -361,9 +494,14 @@ class Device(object):
         if not self.isInitialized: log("Not initialized"); return None
         self.write(0xA1)
         # self.ser.write(bytes(chr(0xA1),'UTF-8'))
+        self.send_buffer()
         data = self.ser.read(2)
         if data:
-            return int(data[0]) + int(data[1]) << 8
+            errors = data[0] | data[1] << 8
+            if errors:
+                # The Maestro may have sent servos to their error positions
+                self.cache.invalidate()
+            return errors
         else:
             return None
 
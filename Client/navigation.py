@@ -0,0 +1,120 @@
+"""
+The field projection and stepped turning maths the autopilot runs on the car. These are the pieces of the server's
+gps_ops and stepped_turning that the car needs, kept here so the client doesn't depend on the server's code or
+configuration. The constants they use live in client_cfg and have to stay in step with server_cfg.
+"""
+
+import math
+import random
+
+# This is intentionally wrong, do not change or everything will burn!
+import client_cfg as cfg
+
+
+def parse_gga(message):
+    """
+    :param message: <String> GGA sentence
+    :return: <List> decimal latitude and longitude
+    """
+    fields = message.split(',')
+    latitude = int(fields[2][:2]) + float(fields[2][2:]) / 60
+    if fields[3] == 'S':
+        latitude = -latitude
+    longitude = int(fields[4][:3]) + float(fields[4][3:]) / 60
+    if fields[5] == 'W':
+        longitude = -longitude
+
+    return [latitude, longitude]
+
+
+def project(lat, lon):
+    """
+    Mercator projection rotated onto the field, before scaling
+
+    :return: <List> raw x, y
+    """
+    radlat = math.radians(lat)
+    x = math.radians(lon) - math.radians(cfg.ORIGIN_LONGITUDE)
+    y = math.log(math.tan(radlat) + (1 / math.cos(radlat)))
+    rotation = math.radians(cfg.ROTATION_ANGLE)
+
+    return [x * math.cos(rotation) - y * math.sin(rotation), y * math.cos(rotation) + x * math.sin(rotation)]
+
+
+def gps_to_field(lat, lon):
+    """
+    :return: <List> x, y on the field in meters, the same as the server's scale_xy(gps_to_xy(lat, lon))
+    """
+    x, y = project(lat, lon)
+    corner_x, corner_y = project(cfg.CORNER_LAT, cfg.CORNER_LONG)
+
+    return [x / (corner_x / cfg.LENGTH_X), y / (corner_y / cfg.LENGTH_Y)]
+
+
+def field_position(message, gps_connected):
+    """
+    :param message: <String> GGA sentence
+    :param gps_connected: <Boolean> parse the sentence (T) or make up a position on the field (F)
+    :return: <List> x, y on the field in meters
+    """
+    if not gps_connected:
+        return [random.randint(0, cfg.LENGTH_X), random.randint(0, cfg.LENGTH_Y)]
+
+    return gps_to_field(*parse_gga(message))
+
+
+def angular_difference(heading_1, heading_2):
+    """
+    :return: <Float> heading_2 - heading_1 in degrees, between -180 and 180
+    """
+    difference = heading_2 - heading_1
+    if difference >= 180:
+        difference -= 360
+    elif difference <= -180:
+        difference += 360
+
+    return difference
+
+
+def choose_turn(current_heading, desired_heading):
+    """
+    Stepped turning: a small, medium or large wheel angle (and slower speed) depending on how far off the heading is
+
+    :return: <Tuple> wheel angle in degrees, positive to the right, and the speed coefficient to go with it
+    """
+    difference = angular_difference(current_heading, desired_heading)
+    if abs(difference) <= 0.1:
+        return 0, 1
+    if abs(difference) <= cfg.SMALL_TURN_TOLERANCE:
+        step = 0
+    elif abs(difference) <= cfg.LARGE_TURN_TOLERANCE:
+        step = 1
+    else:
+        step = 2
+    turn_angle = cfg.TURN_ANGLES[step] if difference >= 0 else -cfg.TURN_ANGLES[step]
+
+    return turn_angle, cfg.TURN_SPEED_COEFFICIENTS[step]
+
+
+def turn_signal(angle):
+    """
+    :param angle: <Float> wheel angle in degrees, positive to the right
+    :return: <Int> steering pulse
+    """
+    if angle < -180 or angle > 180:
+        raise ValueError('wheel angle out of range: ' + str(angle))
+
+    signal = int(round(cfg.CENTER - angle * cfg.DEGREE_GRADIENT))
+
+    return min(max(signal, cfg.MAX_RIGHT), cfg.MAX_LEFT)
+
+
+def speed_signal(speed):
+    """
+    :param speed: <Float> m/s
+    :return: <Int> ESC pulse
+    """
+    if speed == 0:
+        return cfg.NEUTRAL
+
+    return min(round(cfg.MIN_MOVE_SPEED + speed * cfg.VELOCITY_GRADIENT), cfg.MAX_SPEED)
@@ -0,0 +1,17 @@
+"""
+Reconnect policy shared by the threaded and asyncio car clients
+"""
+
+import random
+
+import client_cfg as cfg
+
+
+def reconnect_delay(attempt):
+    """
+    Exponential backoff with full jitter, so a fleet that lost Wi-Fi together doesn't reconnect in lockstep
+
+    :param attempt: <Int> number of failed attempts so far
+    :return: <Float> seconds to wait before the next attempt
+    """
+    return random.uniform(0, min(cfg.RECONNECT_MAX_DELAY, cfg.RECONNECT_BASE_DELAY * 2 ** attempt))
@@ -4,10 +4,17 @@ Purpose: To provide functions with which to control data_handling.py
 """
 
 import asyncio
+import uuid
+from timeit import default_timer as timer
 
 import server_cfg as cfg
+from dashboard import Fleet
 from data_handling import Drone
 from gps_ops import GPSCalculations as GPS
+from plot_renderer import close_shared_renderer
+from traffic_log import CONNECT, DISCONNECT, INBOUND, RecordingTransport, TrafficRecorder
+from velocity_channel import VelocityChannel
+from velocity_service import VelocityService, VelocityStore, VelocitySubscriber
 
 
 class CarController:
@@ -32,10 +39,31 @@ class CarController:
     def run_server(event_loop, debug, plot_points, gps_connected):
 
         servers = []
+        fleet = Fleet()
+        sessions = SessionRegistry(event_loop, cfg.SESSION_GRACE_PERIOD, on_expire=fleet.remove)
+        velocity_store = None
+        velocity_service = None
+        velocity_subscription = None
+        recorder = None
+        # One mapping of the joystick's table, shared by every drone
+        velocity_channel = VelocityChannel(cfg.VELOCITY_CHANNEL_PATH) if cfg.VELOCITY_CHANNEL_PATH else None
+        if cfg.TRAFFIC_LOG_PATH:
+            recorder = TrafficRecorder(cfg.TRAFFIC_LOG_PATH)
+            recorder.flush_every(event_loop, cfg.TRAFFIC_LOG_FLUSH_INTERVAL)
+        if cfg.VELOCITY_SERVICE_PORT or cfg.VELOCITY_STREAM_SOURCE:
+            velocity_store = VelocityStore()
+        if cfg.VELOCITY_SERVICE_PORT:
+            velocity_service = VelocityService(velocity_store, debug, fleet)
+            event_loop.run_until_complete(velocity_service.start('', cfg.VELOCITY_SERVICE_PORT))
+        if cfg.VELOCITY_STREAM_SOURCE:
+            # Changes are pushed into the store as they happen, drones never wait on the network for a vector
+            subscriber = VelocitySubscriber(velocity_store, cfg.VELOCITY_STREAM_SOURCE, debug)
+            velocity_subscription = asyncio.ensure_future(subscriber.run())
 
         for i in range(cfg.NUM_DRONES):
             coroutine = event_loop.create_server(
-                lambda: ServerClientProtocol(debug, plot_points, gps_connected),
+                lambda slot=i: ServerClientProtocol(debug, plot_points, gps_connected, sessions, slot, velocity_store,
+                                                    fleet=fleet, recorder=recorder, velocity_channel=velocity_channel),
                 '192.168.0.105',
                 8000 + i
             )
@@ -51,17 +79,103 @@ class CarController:
         for j, server in enumerate(servers):
             server.close()
             event_loop.run_until_complete(server.wait_closed())
+        if velocity_service:
+            event_loop.run_until_complete(velocity_service.close())
+        if velocity_subscription:
+            velocity_subscription.cancel()
+        close_shared_renderer()
+        if recorder:
+            recorder.close()
+        if velocity_channel:
+            velocity_channel.close()
+
+
+class SessionRegistry:
+    """
+    Keeps each car's Drone alive for a grace period after its connection drops, so a car that reconnects with its
+    session token picks up where it left off instead of starting over with fresh CarData
+    """
+
+    def __init__(self, event_loop, grace_period, on_expire=None):
+        """
+        :param event_loop: <asyncio.AbstractEventLoop> loop the grace periods are timed on
+        :param grace_period: <Float> seconds a dropped car has to resume its session
+        :param on_expire: <Function> called with the drone of each session that expires
+        """
+        self.event_loop = event_loop
+        self.grace_period = grace_period
+        self.on_expire = on_expire
+        self.sessions = {}  # token: [drone, owning protocol, expiry handle]
+
+    def open(self, drone, owner):
+        token = uuid.uuid4().hex[:16]
+        self.sessions[token] = [drone, owner, None]
+        return token
+
+    def resume(self, token, owner):
+        """
+        Hands a session over to a new connection
+
+        :param token: <String> token the car was given
+        :param owner: <ServerClientProtocol> the new connection
+        :return: <Drone> the session's drone, None if the token is unknown or has expired
+        """
+        session = self.sessions.get(token)
+        if session is None:
+            return None
+        if session[2]:
+            session[2].cancel()
+        session[1] = owner
+        session[2] = None
+        return session[0]
+
+    def detach(self, token, owner):
+        """
+        Starts the grace period of a session whose connection dropped
+
+        :return: <Boolean> False if owner no longer held the session, the car having already resumed it elsewhere
+        """
+        session = self.sessions.get(token)
+        # The car may already have resumed on a new connection before the old one was noticed dropping
+        if session is None or session[1] is not owner:
+            return False
+        session[1] = None
+        session[2] = self.event_loop.call_later(self.grace_period, self.expire, token)
+        return True
+
+    def close(self, token):
+        session = self.sessions.pop(token, None)
+        if session and session[2]:
+            session[2].cancel()
+
+    def expire(self, token):
+        session = self.sessions.get(token)
+        if session and session[1] is None:
+            print('Session expired for drone: ', session[0].drone_id)
+            del self.sessions[token]
+            if self.on_expire:
+                self.on_expire(session[0])
 
 
 class ServerClientProtocol(asyncio.Protocol):
-    def __init__(self, debug, plot_points, gps_connected):
+    def __init__(self, debug, plot_points, gps_connected, sessions=None, slot=0, velocity_store=None, clock=timer,
+                 fleet=None, recorder=None, velocity_channel=None):
         self.transport = None
         self.drone_instance = None
         self.debug = debug
         self.plot_points = plot_points
         self.gps_connected = gps_connected
+        self.sessions = sessions
+        self.session_token = None
+        self.slot = slot  # index of the port the car connected on, picks its joystick's velocity vector
+        self.velocity_store = velocity_store
+        self.clock = clock
+        self.fleet = fleet  # drones shown on the dashboard
+        self.recorder = recorder  # TrafficRecorder logging this connection's traffic
+        self.velocity_channel = velocity_channel  # joystick's shared memory table, not read if None
         self.id = None
-        self.gps = GPS(debug)
+        self.rx_buffer = ''  # text after the last message terminator, a message TCP split that the rest of comes later
+        self.gps = GPS(debug, gps_connected)
         if self.debug:
             print("******INITIALIZED SERVER******")
 
@@ -69,13 +183,66 @@ class ServerClientProtocol(asyncio.Protocol):
         peername = transport.get_extra_info('peername')
         print('Connection from: ', peername)
         self.id = peername[1]  # port
+        if self.recorder:
+            self.recorder.record(self.id, CONNECT, str(self.slot).encode('utf-8'))
+            transport = RecordingTransport(transport, self.recorder, self.id)
         self.transport = transport
-        self.drone_instance = Drone(self.plot_points, self.debug, self.id, self.transport, self.gps_connected)
+        self.drone_instance = Drone(self.plot_points, self.debug, self.id, self.transport, self.gps_connected,
+                                    self.slot, self.velocity_store, self.clock, self.velocity_channel)
+        if self.recorder:
+            self.drone_instance.velocity_log = self.transport.record_velocity
+        if self.fleet is not None:
+            self.fleet.attach(self.drone_instance)
+        if self.sessions:
+            self.session_token = self.sessions.open(self.drone_instance, self)
+            self.drone_instance.connection.client_tx('session:' + self.session_token)
+
+    def connection_lost(self, exc):
+        print('Connection lost from drone: ', self.id)
+        if self.recorder:
+            self.recorder.record(self.transport.drone_id, DISCONNECT)
+            self.recorder.flush()
+        if self.sessions and self.session_token:
+            if self.sessions.detach(self.session_token, self) and self.fleet is not None:
+                self.fleet.detach(self.drone_instance)
+        elif self.fleet is not None:
+            self.fleet.remove(self.drone_instance)
+
+    def resume_session(self, token):
+        """
+        Reattaches this connection to the drone of a session the car held before reconnecting
+
+        :param token: <String> session token sent by the car
+        :return: <Boolean> True if the session was resumed
+        """
+        drone = self.sessions.resume(token, self) if self.sessions else None
+        if drone is None:
+            print('Unknown or expired session, keeping new drone: ', self.id)
+            return False
+
+        self.sessions.close(self.session_token)
+        if self.fleet is not None:
+            self.fleet.remove(self.drone_instance)
+            self.fleet.attach(drone)
+        self.session_token = token
+        self.drone_instance = drone
+        self.id = drone.drone_id
+        drone.connection.transport = self.transport
+        if self.recorder:
+            drone.velocity_log = self.transport.record_velocity
+        drone.connection.reset_sent_signals()
+        drone.connection.client_tx('session:' + token)
+        print('Resumed session for drone: ', self.id)
+        return True
 
     def data_received(self, data):
-        data = str(data)
-        data = self.remove_bytes_array_denotors(data)
-        data_array = data.split('\\')
+        if self.recorder:
+            self.recorder.record(self.transport.drone_id, INBOUND, data)
+        # Streamed fixes and acks share the socket, hold back any partial message until the rest arrives
+        self.rx_buffer += data.decode('utf-8', 'replace')
+        end = self.rx_buffer.rfind('\\') + 1
+        data, self.rx_buffer = self.rx_buffer[:end], self.rx_buffer[end:]
+        data_array = data.split('\\')[:-1]
         if self.debug:
             print("Received Data: ", data)
 
@@ -89,15 +256,36 @@ class ServerClientProtocol(asyncio.Protocol):
             if message[0] == 'status':
                 print('Vehicle status: ', message[1])
 
+            elif message[0] == 'ack':
+                try:
+                    seq, car_time = int(message[1]), float(message[2])
+                    steering, throttle = int(message[3]), int(message[4])
+                except (ValueError, IndexError):
+                    print('Dropping malformed ack from drone ', self.id, ': ', message)
+                    continue
+                self.drone_instance.connection.acks.acknowledge(seq, car_time, steering, throttle)
+
             elif message[0] == 'gps':
                 if self.debug:
                     pass
                     print("Received GPS message: ", message[1])
 
+                # Streamed fixes carry the time they were read on the car, only keep the freshest one
+                if len(message) > 2:
+                    try:
+                        fix_time = float(message[2])
+                    except ValueError:
+                        print('Dropping GPS fix with a malformed time from drone ', self.id, ': ', message)
+                        continue
+                    if fix_time <= self.drone_instance.cardata.FIX_TIME:
+                        if self.debug:
+                            print("Discarding stale GPS fix from: ", fix_time)
+                        continue
+                    self.drone_instance.cardata.FIX_TIME = fix_time
+
                 try:
                     gps_data = self.gps.parse_gps_msg(message[1])
-                    self.drone_instance.cardata.XPOS = gps_data[0]
-                    self.drone_instance.cardata.YPOS = gps_data[1]
+                    self.drone_instance.cardata.update_position(gps_data[0], gps_data[1])
 
                     self.drone_instance.message_passing.post_gps_data(gps_data, self.id)
                     if self.debug:
@@ -109,14 +297,18 @@ class ServerClientProtocol(asyncio.Protocol):
                     self.drone_instance.cardata.XPOS = 222
                     self.drone_instance.cardata.YPOS = 222
 
+            elif message[0] == 'progress':
+                self.drone_instance.update_autonomy_progress(message[1:])
+
+            elif message[0] == 'exception':
+                print('Vehicle exception from drone ', self.id, ': ', message[1])
+
+            elif message[0] == 'resume':
+                self.resume_session(message[1])
+
             elif message[0] == 'request':
                 self.drone_instance.drone()
 
-    @staticmethod
-    def remove_bytes_array_denotors(data):
-        data = data[2:-1]
-        return data
-
 
 if __name__ == "__main__":
     car_controller = CarController()
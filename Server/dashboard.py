@@ -0,0 +1,155 @@
+"""
+Live fleet dashboard served by the velocity service, for watching the drones from any browser without a display on the
+ground station.
+
+GET DASHBOARD_ADDRESS         -> the dashboard page, which draws the field and every drone's track itself
+GET DASHBOARD_STREAM_ADDRESS  -> Server-Sent Events: the whole fleet once, then at most DASHBOARD_RATE times a second
+                                 only the fields that changed, {"<drone id>": {field: value}} with null for a drone
+                                 that is gone
+"""
+
+import server_cfg as cfg
+
+
+class Fleet:
+    """
+    Drones currently known to the server, for the dashboard. The connections attach their drone when a car connects or
+    resumes and detach it when the connection drops.
+    """
+
+    def __init__(self):
+        self.drones = {}  # drone id: [drone, connected]
+
+    def attach(self, drone):
+        self.drones[str(drone.drone_id)] = [drone, True]
+
+    def detach(self, drone):
+        entry = self.drones.get(str(drone.drone_id))
+        if entry and entry[0] is drone:
+            entry[1] = False
+
+    def connected_drone(self, drone_id):
+        """
+        :return: <Drone> the drone with this id if its car is connected, None otherwise
+        """
+        entry = self.drones.get(str(drone_id))
+        return entry[0] if entry and entry[1] else None
+
+    def remove(self, drone):
+        entry = self.drones.get(str(drone.drone_id))
+        if entry and entry[0] is drone:
+            del self.drones[str(drone.drone_id)]
+
+    def snapshot(self):
+        """
+        :return: <Dict> drone id: status fields, rounded so noise below display precision doesn't count as a change
+        """
+        fleet = {}
+        for drone_id, (drone, connected) in self.drones.items():
+            cardata = drone.cardata
+            acks = drone.connection.acks
+            fleet[drone_id] = {
+                "xpos": round(cardata.XPOS, 2),
+                "ypos": round(cardata.YPOS, 2),
+                "heading": round(cardata.HEADING, 1),
+                "speed": round(cardata.SPEED, 2),
+                "turn_angle": round(cardata.TURNANGLE, 1),
+                "connected": connected,
+                "autonomous": drone.autonomous,
+                "waypoints_left": drone.waypoints_left,
+                "acked": acks.acked,
+                "dropped": acks.dropped,
+                "latency": round(acks.mean_latency, 4)
+            }
+        return fleet
+
+
+def delta(previous, current):
+    """
+    :param previous: <Dict> snapshot last sent
+    :param current: <Dict> snapshot now
+    :return: <Dict> drone id: fields that changed, None for drones no longer in current. Empty if nothing changed.
+    """
+    changes = {}
+    for drone_id, status in current.items():
+        before = previous.get(drone_id, {})
+        changed = {field: value for field, value in status.items() if before.get(field) != value}
+        if changed:
+            changes[drone_id] = changed
+    for drone_id in previous:
+        if drone_id not in current:
+            changes[drone_id] = None
+    return changes
+
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Drone fleet</title>
+<style>
+body { font-family: sans-serif; margin: 1em; }
+canvas { border: 1px solid #888; }
+td, th { padding: 0 0.6em; text-align: right; }
+.lost { color: #aaa; }
+</style>
+</head>
+<body>
+<canvas id="field"></canvas>
+<table><thead><tr><th>drone</th><th>x</th><th>y</th><th>heading</th><th>speed</th><th>turn</th><th>mode</th>
+<th>acked</th><th>dropped</th><th>latency</th></tr></thead><tbody id="status"></tbody></table>
+<script>
+var LENGTH_X = %(length_x)s, LENGTH_Y = %(length_y)s, TRACK = %(track_length)s, SCALE = 6;
+var COLORS = ['#1f77b4', '#d62728', '#2ca02c', '#ff7f0e', '#9467bd', '#8c564b', '#e377c2', '#17becf'];
+var canvas = document.getElementById('field'), context = canvas.getContext('2d');
+canvas.width = LENGTH_X * SCALE;
+canvas.height = LENGTH_Y * SCALE;
+var fleet = {}, tracks = {}, dirty = false;
+
+new EventSource('%(stream)s').onmessage = function (event) {
+    var changes = JSON.parse(event.data);
+    for (var id in changes) {
+        if (changes[id] === null) { delete fleet[id]; delete tracks[id]; continue; }
+        var drone = fleet[id] = Object.assign(fleet[id] || {}, changes[id]);
+        if ('xpos' in changes[id] || 'ypos' in changes[id]) {
+            var track = tracks[id] = tracks[id] || [];
+            track.push([drone.xpos, drone.ypos]);
+            if (track.length > TRACK) track.shift();
+        }
+    }
+    if (!dirty) { dirty = true; requestAnimationFrame(draw); }
+};
+
+function draw() {
+    dirty = false;
+    context.clearRect(0, 0, canvas.width, canvas.height);
+    var rows = '', i = 0;
+    for (var id in fleet) {
+        var drone = fleet[id], track = tracks[id] || [], color = COLORS[i++ %% COLORS.length];
+        context.strokeStyle = context.fillStyle = color;
+        context.beginPath();
+        track.forEach(function (point, n) {
+            context[n ? 'lineTo' : 'moveTo'](point[0] * SCALE, canvas.height - point[1] * SCALE);
+        });
+        context.stroke();
+        context.fillRect(drone.xpos * SCALE - 3, canvas.height - drone.ypos * SCALE - 3, 6, 6);
+        rows += '<tr class="' + (drone.connected ? '' : 'lost') + '" style="color:' + color + '"><td>' + id +
+            '</td><td>' + drone.xpos + '</td><td>' + drone.ypos + '</td><td>' + drone.heading + '</td><td>' +
+            drone.speed + '</td><td>' + drone.turn_angle + '</td><td>' +
+            (drone.autonomous ? 'auto, ' + drone.waypoints_left + ' left' : 'manual') + '</td><td>' + drone.acked +
+            '</td><td>' + drone.dropped + '</td><td>' + drone.latency + '</td></tr>';
+    }
+    document.getElementById('status').innerHTML = rows;
+}
+</script>
+</body>
+</html>
+"""
+
+
+def page():
+    """
+    :return: <Bytes> the dashboard page
+    """
+    return (PAGE % {"length_x": cfg.LENGTH_X, "length_y": cfg.LENGTH_Y, "track_length": cfg.PLOT_TRACK_LENGTH,
+                    "stream": cfg.DASHBOARD_STREAM_ADDRESS}).encode('utf-8')
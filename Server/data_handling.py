@@ -1,19 +1,19 @@
 # 12 turn, max power 40.24 watts @ 7772 RPM
 
+import collections
 import json
 import math
+import os
 import sys
+import time
 import traceback
-import requests
 from timeit import default_timer as timer
-import matplotlib.pyplot as plt
 
 import gps_ops as gps
 import server_cfg as cfg
+from plot_renderer import shared_renderer
 from stepped_turning import Turning
 
-BUFFERSIZE = 50
-
 
 class CarData:
     """
@@ -25,12 +25,15 @@ class CarData:
         self.LONG = 0.0
         self.XPOS = 10.0
         self.YPOS = 15.0
+        self.HEADING_XPOS = self.XPOS  # where the heading was last taken from the track
+        self.HEADING_YPOS = self.YPOS
         self.TGTXPOS = 0.0
         self.TGTYPOS = 0.0
         self.HEADING = 0.0
         self.TURNANGLE = 0.0
         self.SPEED = 0.0
         self.DIST_TRAVELED = 0.0
+        self.FIX_TIME = 0.0
         self.ID = drone_id
         self.INTERVAL_TIMER = 0.25
         if debug:
@@ -39,22 +42,41 @@ class CarData:
     def update_last_interval_time(self, new_time):
         self.INTERVAL_TIMER = new_time
 
+    def update_position(self, xpos, ypos):
+        """
+        Moves the drone to a new fix. Once it has covered HEADING_MIN_TRAVEL since the last heading update its heading
+        is taken from the track between the two, so the heading the turns are worked out from follows the real car.
+        """
+        dx, dy = xpos - self.HEADING_XPOS, ypos - self.HEADING_YPOS
+        if math.hypot(dx, dy) >= cfg.HEADING_MIN_TRAVEL:
+            self.HEADING = math.degrees(math.atan2(dx, dy)) % 360
+            self.HEADING_XPOS, self.HEADING_YPOS = xpos, ypos
+        self.XPOS = xpos
+        self.YPOS = ypos
+
 
 class Drone:
-    def __init__(self, plot_points, debug, drone_number, transport, gps_connected):
+    def __init__(self, plot_points, debug, drone_number, transport, gps_connected, slot=0, velocity_store=None,
+                 clock=timer, velocity_channel=None):
         if debug:
             print("\n******BEGINNING INITIALIZATION******")
         self.debug = debug
         self.plot_points = plot_points
         self.gps_connected = gps_connected
         self.drone_id = drone_number
-        self.connection = CarConnection(debug, transport)
+        self.slot = slot  # row of the joystick's velocity table this drone follows
+        self.clock = clock  # returns seconds, a simulation can swap in a virtual clock
+        self.connection = CarConnection(debug, transport, clock)
         self.turning = Turning(debug)
-        self.message_passing = ServerMessagePassing(debug)
+        self.message_passing = ServerMessagePassing(debug, velocity_store, velocity_channel)
         if self.plot_points:
             self.plotting = Plotting(debug)
         self.gps_calculations = gps.GPSCalculations(debug, self.gps_connected)
         self.cardata = CarData(debug, self.drone_id)
+        self.telemetry = None  # opened on the first tick, a drone replaced by a resumed session never needs one
+        self.velocity_log = None  # called with the velocity vector read on each tick while the traffic is recorded
+        self.autonomous = False  # the car is driving an uploaded route itself
+        self.waypoints_left = 0
         if debug:
             print("******FINISHED INITIALIZATION******")
 
@@ -64,20 +86,29 @@ class Drone:
         drones.
         :return: Nothing
         """
+        if self.autonomous:
+            if self.debug:
+                print("Drone: ", self.drone_id, " driving autonomously, ", self.waypoints_left, " waypoints left")
+            return
+
         try:
             if self.debug:
                 print("\n")
             print("Drone: ", self.drone_id, " executing turn")
 
-            start_time = timer()
+            start_time = self.clock()
 
-            self.gps_calculations.request_gps_fix(self.connection)
+            if not cfg.GPS_STREAMING:
+                self.gps_calculations.request_gps_fix(self.connection)
             # self.message_passing.post_gps_data(self.cardata)
             velocity_vector = self.execute_turn()
+            if self.telemetry is None:
+                self.telemetry = self.open_telemetry()
+            self.telemetry.append_cardata(time.time(), self.cardata)
             if self.plot_points:
                 self.plotting.plot_car_path(self.cardata, self.drone_id, velocity_vector)
 
-            stop_time = timer()
+            stop_time = self.clock()
 
             self.cardata.update_last_interval_time(
                 (((stop_time - start_time) * 0.75) + (self.cardata.INTERVAL_TIMER * 0.25)) / 2)
@@ -86,9 +117,68 @@ class Drone:
             self.connection.client_tx('disconnect')
             sys.exit()
 
+    def open_telemetry(self):
+        """
+        :return: <TelemetryBuffer> this drone's history, in its own file under TELEMETRY_DIR if there is one, so a later
+            car on the same slot starts a history of its own instead of continuing this one
+        """
+        # numpy takes a while to import, so it is loaded with the first drone rather than with the server
+        from telemetry import TelemetryBuffer
+        telemetry_path = None
+        if cfg.TELEMETRY_DIR:
+            telemetry_path = os.path.join(cfg.TELEMETRY_DIR, 'slot_{}_{}_{}.telemetry'.format(
+                self.slot, time.strftime('%Y%m%d-%H%M%S'), self.drone_id))
+        return TelemetryBuffer(path=telemetry_path)
+
+    def upload_waypoints(self, waypoints, speed):
+        """
+        Hands the car a route to drive with its own GPS. The server stops steering it until the route is complete or
+        take_manual_control is called.
+
+        :param waypoints: <List> [x, y] positions in field coordinates
+        :param speed: <Float> speed to drive the route at in m/s
+        :return: Nothing
+        """
+        self.autonomous = True
+        self.waypoints_left = len(waypoints)
+        self.connection.client_tx('waypoints:{:.2f}:'.format(speed) +
+                                  ';'.join('{:.2f},{:.2f}'.format(x, y) for x, y in waypoints))
+
+    def hold_heading(self, heading, speed):
+        """
+        Has the car hold a compass heading on its own until take_manual_control is called
+
+        :param heading: <Float> degrees, 0 is +y
+        :param speed: <Float> m/s
+        :return: Nothing
+        """
+        self.autonomous = True
+        self.waypoints_left = 0
+        self.connection.client_tx('heading:{:.2f}:{:.2f}'.format(speed, heading))
+
+    def take_manual_control(self):
+        self.autonomous = False
+        self.connection.client_tx('manual')
+
+    def update_autonomy_progress(self, progress):
+        """
+        :param progress: <List> ['complete'] or [waypoints reached, waypoints left] as reported by the car
+        :return: Nothing
+        """
+        if progress[0] == 'complete':
+            print("Drone: ", self.drone_id, " finished its route")
+            self.autonomous = False
+            self.waypoints_left = 0
+        else:
+            self.waypoints_left = int(progress[1])
+            if self.debug:
+                print("Drone: ", self.drone_id, " reached waypoint ", progress[0], ", ", progress[1], " left")
+
     def execute_turn(self):
-        velocity_vector = self.message_passing.get_velocity_data()
-        desired_heading = self.turning.calculate_desired_heading(self.cardata)
+        velocity_vector = self.message_passing.get_velocity_data(self.slot)
+        if self.velocity_log:
+            self.velocity_log(velocity_vector)
+        desired_heading = self.turning.calculate_desired_heading(self.cardata, velocity_vector)
         self.turning.find_vehicle_speed(self.cardata, velocity_vector)
         turn_data = self.turning.initialize_turn_data(self.cardata, desired_heading)
         turn_data = self.turning.stepped_turning_algorithm(turn_data)
@@ -100,11 +190,26 @@ class Drone:
 
 class ServerMessagePassing:
 
-    def __init__(self, debug):
+    def __init__(self, debug, velocity_store=None, velocity_channel=None):
         self.debug = debug
+        self.velocity_store = velocity_store  # set when the velocity service runs in this process
+        self.velocity_channel = velocity_channel  # the joystick's VelocityChannel, opened once by run_server
+        self.http_session = None
         if self.debug:
             print('******INITIALIZED API SERVER CONNECTION******')
 
+    @property
+    def session(self):
+        """
+        requests is only needed without a local velocity source and takes a while to import, so it is loaded, and the
+        session opened, on first use
+        :return: <requests.Session> keeps the connection to the simulation server alive between ticks
+        """
+        if self.http_session is None:
+            import requests
+            self.http_session = requests.Session()
+        return self.http_session
+
     def post_gps_data(self, gps_data, drone_id):
         """
         Uses aiohttp to post gps data from a webserver
@@ -112,22 +217,44 @@ class ServerMessagePassing:
         :param drone_id: drone id
         :return: true if successful
         """
+        if self.velocity_store and cfg.VELOCITY_SERVICE_PORT:
+            # Served to the simulator by our own velocity service
+            self.velocity_store.post_gps(gps_data, drone_id)
+            return True
+
         gps_data_dict = {"xpos": gps_data[0], "ypos": gps_data[1], "id": drone_id}
         #       with aiohttp.ClientSession() as session:
         #           with session.post(
-        response = requests.post(cfg.SERVER_BASE_ADDRESS + cfg.SERVER_POST_ADDRESS, json=gps_data_dict)
+        response = self.session.post(cfg.SERVER_BASE_ADDRESS + cfg.SERVER_POST_ADDRESS, json=gps_data_dict)
         if self.debug:
             print(response.status_code)
             print(response.text)
 
-    def get_velocity_data(self):
+    def get_velocity_data(self, slot=0):
         """
-        Uses aiohttp to get velocity data for the car from a webserver
-        :return:
+        Gets velocity data for the car from a local source, or from a webserver if there is none. Of the local sources
+        the joystick's shared memory channel wins for the slots it drives, as long as it is still publishing; every
+        other slot follows what was posted to or streamed into the in-process velocity service, and is stopped if
+        nothing was.
+        :param slot: <Int> drone slot
+        :return: <List> x and y velocity
         """
+        if self.velocity_channel or self.velocity_store:
+            velocity_vector = None
+            if self.velocity_channel:
+                version, velocity_vectors, timestamp, driven = self.velocity_channel.read()
+                if slot in driven and time.time() - timestamp <= cfg.VELOCITY_CHANNEL_TIMEOUT:
+                    velocity_vector = velocity_vectors[slot]
+            if velocity_vector is None:
+                posted = self.velocity_store.velocity(slot) if self.velocity_store else None
+                velocity_vector = posted[0] if posted else [0.0, 0.0]
+            if self.debug:
+                print("New velocity vector: ", velocity_vector)
+            return velocity_vector
+
         #       with aiohttp.ClientSession() as session:
         #           response = session.get(cfg.SERVER_BASE_ADDRESS + cfg.SERVER_GET_ADDRESS)
-        response = requests.get(cfg.SERVER_BASE_ADDRESS + cfg.SERVER_GET_ADDRESS)
+        response = self.session.get(cfg.SERVER_BASE_ADDRESS + cfg.SERVER_GET_ADDRESS, params={"id": slot})
         if self.debug:
             print(response.status_code)
             print("New velocity vector: ", response.text)
@@ -145,51 +272,93 @@ class ServerMessagePassing:
 
 class Plotting:
     def __init__(self, debug):
-        plt.figure(num=1, figsize=(6, 8))
-        plt.ion()
-        self.xpos = []
-        self.ypos = []
+        # Every drone draws into the one renderer process, matplotlib never loads or blocks in the server
+        self.renderer = shared_renderer(debug)
         self.debug = debug
         if self.debug:
             print('******INITIALIZED PLOTTING******')
 
     def plot_car_path(self, cardata, dronename, velocity_vector):
-        if math.sqrt(velocity_vector[0] ** 2 + velocity_vector[1] ** 2) != 0:
-            pause_interval = cardata.INTERVAL_TIMER
-        else:
-            pause_interval = 1e-6  # <-- This is a starter to the program
-        if self.debug:
-            print("Pause Interval: " + str(pause_interval))
-        if len(self.xpos) > BUFFERSIZE:
-            self.xpos.pop(0)
-            self.ypos.pop(0)
-        self.xpos.append(cardata.XPOS)
-        self.ypos.append(cardata.YPOS)
-
-        print("xpos: ", self.xpos)
-        print("ypos: ", self.ypos)
-
-        plt.clf()
-        plt.title(dronename)
-        if not self.debug:
-            plt.axis([0.0, cfg.LENGTH_X, 0.0, cfg.LENGTH_Y])
-        plt.plot(self.xpos, self.ypos, 'k-')
-        plt.grid(True)
+        plotted = self.renderer.plot(dronename, cardata.XPOS, cardata.YPOS)
         if self.debug:
             print('Calculated Tgt Pos: ', cardata.TGTXPOS, cardata.TGTYPOS)
             print('Calculated XY Pos: ', cardata.XPOS, cardata.YPOS)
-            # print('Interval Time: ', interval_time)
+            if not plotted:
+                print('Plot renderer behind, position dropped')
             print('')
-        plt.pause(pause_interval)
+
+
+class AckTracker:
+    """
+    Numbers each command sent to a car and matches the car's acks against them, measuring command to actuation latency
+    and counting commands the car never applied
+    """
+
+    def __init__(self, debug, clock=timer):
+        self.debug = debug
+        self.clock = clock
+        self.next_seq = 0
+        self.outstanding = collections.OrderedDict()  # seq: time sent
+        self.acked = 0
+        self.dropped = 0
+        self.last_latency = 0.0
+        self.mean_latency = 0.0
+        self.max_latency = 0.0
+        self.last_applied = None  # (car timestamp, steering, throttle) from the newest ack
+
+    def next_sequence(self):
+        seq = self.next_seq
+        self.next_seq += 1
+        self.outstanding[seq] = self.clock()
+        if len(self.outstanding) > cfg.ACK_WINDOW:
+            self.outstanding.popitem(last=False)
+            self.dropped += 1
+        return seq
+
+    def acknowledge(self, seq, car_time, steering, throttle):
+        """
+        :param seq: <Int> sequence number of the command batch the car applied
+        :param car_time: <Float> car's clock when it was applied
+        :param steering: <Int> steering pulse the car is now on
+        :param throttle: <Int> throttle pulse the car is now on
+        :return: <Float> seconds from sending the command to its ack arriving, None for an unknown or repeated ack
+        """
+        sent_time = self.outstanding.pop(seq, None)
+        if sent_time is None:
+            return None
+
+        # Acks come back in order, anything older still outstanding was lost on the way
+        for old_seq in [old_seq for old_seq in self.outstanding if old_seq < seq]:
+            del self.outstanding[old_seq]
+            self.dropped += 1
+
+        self.last_latency = self.clock() - sent_time
+        self.acked += 1
+        self.mean_latency += (self.last_latency - self.mean_latency) / self.acked
+        self.max_latency = max(self.max_latency, self.last_latency)
+        self.last_applied = (car_time, steering, throttle)
+        if self.debug:
+            print("Ack ", seq, " latency: ", self.last_latency, " dropped so far: ", self.dropped)
+        return self.last_latency
 
 
 class CarConnection:
-    def __init__(self, debug, transport):
+    def __init__(self, debug, transport, clock=timer):
         self.debug = debug
         self.transport = transport
+        self.last_turn_signal = None
+        self.last_speed_signal = None
+        self.acks = AckTracker(debug, clock)
         if debug:
             print('******INITIALIZED CONNECTION*******')
 
+    def reset_sent_signals(self):
+        """
+        Forget which signals the car already has, so the next turn is sent in full (e.g. after a reconnect)
+        """
+        self.last_turn_signal = None
+        self.last_speed_signal = None
+
     def client_tx(self, data):
         if self.debug:
             print("ABOUT TO SEND: ", data)
@@ -202,8 +371,16 @@ class CarConnection:
         if self.debug:
             print("ABOUT TO SEND TURN SIGNAL: " + str(cfg.STEERING) + str(turn_signal))
             print("AND STEERING SIGNAL: " + str(cfg.ESC) + str(speed_signal))
-        self.client_tx(str(cfg.STEERING) + str(turn_signal))
-        self.client_tx(str(cfg.ESC) + str(speed_signal))
+        # The car holds its last pulse, so only resend signals that changed
+        if turn_signal == self.last_turn_signal and speed_signal == self.last_speed_signal:
+            return
+        self.client_tx('seq:' + str(self.acks.next_sequence()))
+        if turn_signal != self.last_turn_signal:
+            self.client_tx(str(cfg.STEERING) + str(turn_signal))
+            self.last_turn_signal = turn_signal
+        if speed_signal != self.last_speed_signal:
+            self.client_tx(str(cfg.ESC) + str(speed_signal))
+            self.last_speed_signal = speed_signal
 
 
 class DebugOutput:
@@ -108,6 +108,27 @@ class GPSCalculations:
 
         return xy
 
+    def xy_to_gps(self, x, y):
+        """
+        Inverse of scale_xy(gps_to_xy(lat, lon)), turns a position on the field back into a latitude and longitude
+
+        :param x: <Float> scaled x value
+        :param y: <Float> scaled y value
+        :return: <Array> two element array consisting of decimal latitude and longitude
+        """
+        self.set_xy_ratio()
+
+        rot_x = x * X_RATIO + BASE_X
+        rot_y = y * Y_RATIO + BASE_Y
+
+        raw_x = rot_x * math.cos(math.radians(cfg.ROTATION_ANGLE)) + rot_y * math.sin(math.radians(cfg.ROTATION_ANGLE))
+        raw_y = rot_y * math.cos(math.radians(cfg.ROTATION_ANGLE)) - rot_x * math.sin(math.radians(cfg.ROTATION_ANGLE))
+
+        lat = math.degrees(math.atan(math.sinh(raw_y)))
+        lon = math.degrees(raw_x) + cfg.ORIGIN_LONGITUDE
+
+        return [lat, lon]
+
     def scale_xy(self, xy):
         """
         Scales xy values to proper size based on length and width of field
@@ -0,0 +1,143 @@
+"""
+Plots every drone's track on one figure from a separate process, so drawing never holds up the control loop.
+
+Drones hand their positions to the renderer through a bounded queue and never wait on it: when the renderer falls behind
+the newest positions are dropped rather than the control loop blocked. The renderer draws at most PLOT_FRAME_RATE
+frames a second and blits only the tracks over a cached background instead of redrawing the whole figure.
+"""
+
+import collections
+import multiprocessing
+import queue
+import time
+
+import server_cfg as cfg
+
+shared = None
+
+
+class PlotRenderer:
+    def __init__(self, debug, frame_rate=cfg.PLOT_FRAME_RATE, track_length=cfg.PLOT_TRACK_LENGTH):
+        """
+        :param debug: <Boolean> Debug mode (T/F), debug mode lets the axes follow the tracks off the field
+        :param frame_rate: <Float> frames per second drawn at most
+        :param track_length: <Int> positions kept for each drone's track
+        """
+        self.debug = debug
+        self.positions = multiprocessing.Queue(cfg.PLOT_QUEUE_SIZE)
+        self.process = multiprocessing.Process(target=render, args=(self.positions, debug, frame_rate, track_length),
+                                               name='plot-renderer', daemon=True)
+        self.dropped = 0
+
+    def start(self):
+        self.process.start()
+        if self.debug:
+            print('******STARTED PLOT RENDERER******')
+
+    def plot(self, drone_name, xpos, ypos):
+        """
+        Queues a position for the drone's track, never blocks
+
+        :return: <Boolean> False if the renderer was behind and the position was dropped
+        """
+        try:
+            self.positions.put_nowait((str(drone_name), xpos, ypos))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self.positions.put(None, timeout=1)
+                self.process.join(1)
+            except queue.Full:
+                pass
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        self.positions.close()
+
+
+def shared_renderer(debug):
+    """
+    :return: <PlotRenderer> the one renderer every drone in this process plots into, started on first use
+    """
+    global shared
+    if shared is None:
+        shared = PlotRenderer(debug)
+        shared.start()
+    return shared
+
+
+def close_shared_renderer():
+    global shared
+    if shared is not None:
+        shared.close()
+        shared = None
+
+
+def render(positions, debug, frame_rate, track_length):
+    """
+    Renderer process main loop, runs until it is sent None or the figure is closed
+
+    :param positions: <multiprocessing.Queue> (drone name, x, y) from the drones
+    """
+    # Only the renderer process pays for importing matplotlib
+    import matplotlib.pyplot as plt
+
+    figure, axes = plt.subplots(num=1, figsize=(6, 8))
+    axes.set_title('Drones')
+    axes.set_xlim(0.0, cfg.LENGTH_X)
+    axes.set_ylim(0.0, cfg.LENGTH_Y)
+    axes.grid(True)
+    plt.show(block=False)
+    figure.canvas.draw()
+    background = figure.canvas.copy_from_bbox(axes.bbox)
+
+    tracks = collections.OrderedDict()  # drone name: (deque of x, deque of y, line)
+    frame_interval = 1.0 / frame_rate
+    last_frame = 0.0
+    changed = False
+
+    while plt.fignum_exists(figure.number):
+        try:
+            position = positions.get(timeout=frame_interval)
+            while True:
+                if position is None:
+                    plt.close(figure)
+                    return
+                drone_name, xpos, ypos = position
+                if drone_name not in tracks:
+                    line, = axes.plot([], [], '-', label=drone_name, animated=True)
+                    tracks[drone_name] = (collections.deque(maxlen=track_length),
+                                          collections.deque(maxlen=track_length), line)
+                    axes.legend(loc='upper right')
+                    figure.canvas.draw()
+                    background = figure.canvas.copy_from_bbox(axes.bbox)
+                tracks[drone_name][0].append(xpos)
+                tracks[drone_name][1].append(ypos)
+                changed = True
+                position = positions.get_nowait()
+        except queue.Empty:
+            pass
+
+        now = time.perf_counter()
+        if changed and now - last_frame >= frame_interval:
+            if debug:
+                # The field is fixed, only rescale (and redraw everything) when following tracks off it
+                for xs, ys, line in tracks.values():
+                    line.set_data(xs, ys)
+                axes.relim()
+                axes.autoscale_view()
+                figure.canvas.draw()
+                background = figure.canvas.copy_from_bbox(axes.bbox)
+            figure.canvas.restore_region(background)
+            for xs, ys, line in tracks.values():
+                line.set_data(xs, ys)
+                axes.draw_artist(line)
+            figure.canvas.blit(axes.bbox)
+            last_frame = now
+            changed = False
+        figure.canvas.flush_events()
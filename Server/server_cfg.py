@@ -18,6 +18,55 @@ NUM_DRONES = 3
 ESC = 3
 STEERING = 5
 
+# STEPPED TURNING
+TURN_ANGLES = (5, 10, 15)  # degrees of wheel turn for small, medium and large heading errors
+TURN_SPEED_COEFFICIENTS = (0.75, 0.50, 0.25)  # speed multiplier for each of those turns
+SMALL_TURN_TOLERANCE = 5  # degrees of heading error still handled with a small turn
+LARGE_TURN_TOLERANCE = 45  # degrees of heading error still handled with a medium turn
+
+# SESSIONS
+SESSION_GRACE_PERIOD = 30  # s a dropped car has to reconnect and get its drone state back
+
+# ACKS
+ACK_WINDOW = 64  # commands awaiting an ack before the oldest is written off as dropped
+
+# GPS
+GPS_STREAMING = False  # cars push timestamped fixes on their own, so don't request one every turn
+HEADING_MIN_TRAVEL = 0.5  # m between fixes before the heading is taken from the track, less is mostly GPS noise
+
+# JOYSTICK
+VELOCITY_CHANNEL_PATH = '/dev/shm/velocity_vectors'  # shared memory written by joystick_input, None to not use it
+VELOCITY_CHANNEL_TIMEOUT = 0.5  # s without a publish before the joystick is taken to be gone and its slots released
+
+# VELOCITY SERVICE
+VELOCITY_SERVICE_PORT = 8080  # in-process HTTP service for the simulator and remote joysticks, None to disable
+VELOCITY_SERVICE_KEEPALIVE = 30  # s an idle keep-alive connection is held open
+VELOCITY_SERVICE_MAX_BODY = 65536  # bytes
+VELOCITY_STREAM_ADDRESS = '/velocity_stream'
+VELOCITY_STREAM_SOURCE = None  # ('host', port) of a remote velocity service to follow instead of polling SERVER below
+VELOCITY_STREAM_RETRY = 1.0  # s between attempts to resubscribe
+VELOCITY_STREAM_KEEPALIVE = 1.0  # s without a change before every slot is sent down the stream again
+VELOCITY_STREAM_TIMEOUT = 3.0  # s of silence before a followed stream is taken as lost and its slots stopped
+DASHBOARD_ADDRESS = '/dashboard'  # live fleet dashboard page, served by the velocity service
+DASHBOARD_STREAM_ADDRESS = '/dashboard/events'
+DASHBOARD_RATE = 5  # updates per second streamed to each dashboard at most
+DASHBOARD_KEEPALIVE = 15  # s between comments sent to an idle dashboard so proxies keep the stream open
+AUTONOMY_ADDRESS = '/autonomy'  # POST a route or heading for a connected drone to drive on its own
+
+# TELEMETRY
+TELEMETRY_CAPACITY = 36000  # ticks of history kept per drone, 2.5 hours at 4 Hz
+TELEMETRY_DIR = None  # directory for each drone's memory mapped history, kept in memory only if None
+
+# TRAFFIC LOG
+TRAFFIC_LOG_PATH = None  # file every message to and from the cars is appended to, see traffic_log.py. None to not record
+TRAFFIC_LOG_BUFFER = 1 << 16  # bytes of log buffered before they are written out
+TRAFFIC_LOG_FLUSH_INTERVAL = 1.0  # s between flushes of the log buffer, at most this much is lost in a crash
+
+# PLOTTING
+PLOT_FRAME_RATE = 10  # frames per second the renderer process draws at most
+PLOT_TRACK_LENGTH = 50  # positions kept for each drone's track
+PLOT_QUEUE_SIZE = 256  # positions waiting for the renderer before new ones are dropped
+
 # TODO Change this on getting server information from customer
 # SIMULATION SERVER
 SERVER_BASE_ADDRESS = 'http://localhost/cgi-bin'
@@ -15,8 +15,20 @@ import server_cfg as cfg
 
 
 class Turning:
-    def __init__(self, debug):
+    def __init__(self, debug, turn_angles=cfg.TURN_ANGLES, speed_coefficients=cfg.TURN_SPEED_COEFFICIENTS,
+                 small_turn_tolerance=cfg.SMALL_TURN_TOLERANCE, large_turn_tolerance=cfg.LARGE_TURN_TOLERANCE):
+        """
+        :param debug: <Boolean> Debug mode (T/F)
+        :param turn_angles: <Tuple> degrees of wheel turn for small, medium and large heading errors
+        :param speed_coefficients: <Tuple> speed multiplier for each of those turns
+        :param small_turn_tolerance: <Float> largest heading error in degrees handled with a small turn
+        :param large_turn_tolerance: <Float> largest heading error in degrees handled with a medium turn
+        """
         self.debug = debug
+        self.turn_angles = tuple(turn_angles)
+        self.speed_coefficients = tuple(speed_coefficients)
+        self.small_turn_tolerance = small_turn_tolerance
+        self.large_turn_tolerance = large_turn_tolerance
         if self.debug:
             print('******INITIALIZED TURNING*******')
 
@@ -80,8 +92,8 @@ class Turning:
         :param speed_coefficients:
         :return:
         """
-        tolerance_for_small_turn = 5
-        tolerance_for_large_turn = 45
+        tolerance_for_small_turn = self.small_turn_tolerance
+        tolerance_for_large_turn = self.large_turn_tolerance
 
         if self.check_if_within_heading(current_heading, desired_heading, tolerance=tolerance_for_small_turn):
             # print("\nWithin 5 degrees")
@@ -102,9 +114,9 @@ class Turning:
         :param desired_heading:
         :return:
         """
-        left_turns = (-5, -10, -15)
-        right_turns = (5, 10, 15)
-        speed_coefficients = (0.75, 0.50, 0.25)
+        left_turns = tuple(-angle for angle in self.turn_angles)
+        right_turns = self.turn_angles
+        speed_coefficients = self.speed_coefficients
 
         if self.check_right_turn(current_heading, desired_heading):
             chosen_direction = right_turns
@@ -183,7 +195,7 @@ class Turning:
         :return:
         """
         no_turn = 0
-        if not self.check_if_within_heading(car_data["speed"], car_data["desired_heading"], tolerance=0.1):
+        if not self.check_if_within_heading(car_data["current_heading"], car_data["desired_heading"], tolerance=0.1):
             car_data["turning_angle"], speed_coefficient = self.choose_wheel_turn_angle_and_direction(
                 car_data["current_heading"], car_data["desired_heading"])
         else:
@@ -209,9 +221,10 @@ class Turning:
 
     @staticmethod
     def apply_turn_to_cardata(cardata, turn_data):
+        # HEADING is left alone, it only ever comes from the GPS track (CarData.update_position). The wheel angle isn't a
+        # heading change, predicting one from it would steer the next tick off a heading the car never had.
         cardata.DIST_TRAVELED = turn_data["distance_travelled"]
         cardata.TURNANGLE = turn_data["turning_angle"]
-        cardata.HEADING = turn_data["final_heading"]
         cardata.SPEED = turn_data["speed"]
         cardata.TGTXPOS = turn_data["advanced_x_position"]
         cardata.TGTYPOS = turn_data["advanced_y_position"]
@@ -233,10 +246,18 @@ class Turning:
         }
         return turn_data
 
-    def calculate_desired_heading(self, cardata):
-        desired_heading = math.atan2((cardata.TGTYPOS - cardata.YPOS), (cardata.TGTXPOS - cardata.XPOS))
+    def calculate_desired_heading(self, cardata, velocity_vector):
+        """
+        :param cardata: <CarData> drone state
+        :param velocity_vector: <List> x and y velocity asked of the car
+        :return: <Float> compass heading of the velocity vector in degrees, 0 is +y and 90 is +x. The current heading
+            if the car is asked to stand still.
+        """
+        if not any(velocity_vector):
+            return cardata.HEADING
+        desired_heading = math.degrees(math.atan2(velocity_vector[0], velocity_vector[1])) % 360
         if self.debug:
-            print('Last Angle Orientation: ', math.degrees(desired_heading))
+            print('Desired heading: ', desired_heading)
         return desired_heading
 
     def gen_turn_signal(self, angle):
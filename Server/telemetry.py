@@ -0,0 +1,103 @@
+"""
+Fixed capacity telemetry history for a drone: wall clock timestamp, position, heading, speed and turn angle at every
+control tick.
+
+Records live in a NumPy ring buffer, so appending costs the same however long the mission runs and the oldest records are
+overwritten once it is full. Given a path the buffer is a memory mapped file instead: every append lands in the page
+cache right away, a crash loses nothing, and reopening the file carries on from where the last run stopped.
+
+File layout: capacity <int64>, records appended <int64>, then capacity records of RECORD.
+"""
+
+import os
+
+import numpy as np
+
+import server_cfg as cfg
+
+FIELDS = ('time', 'xpos', 'ypos', 'heading', 'speed', 'turn_angle')
+RECORD = np.dtype([(field, '<f8') for field in FIELDS])
+HEADER = np.dtype('<i8')
+HEADER_SIZE = 2 * HEADER.itemsize
+
+
+class TelemetryBuffer:
+    def __init__(self, capacity=cfg.TELEMETRY_CAPACITY, path=None):
+        """
+        :param capacity: <Int> records kept, the oldest are overwritten beyond that
+        :param path: <String> file to back the buffer with, opened and continued if it exists. Memory only if None.
+        """
+        self.path = path
+        if path is None:
+            self.header = np.zeros(2, dtype=HEADER)
+            self.records = np.zeros(capacity, dtype=RECORD)
+        else:
+            if not os.path.exists(path):
+                with open(path, 'wb') as backing:
+                    backing.truncate(HEADER_SIZE + capacity * RECORD.itemsize)
+            self.header = np.memmap(path, dtype=HEADER, mode='r+', shape=(2,))
+            if self.header[0] not in (0, capacity):
+                raise ValueError('{} holds {} records, not {}'.format(path, self.header[0], capacity))
+            self.records = np.memmap(path, dtype=RECORD, mode='r+', offset=HEADER_SIZE, shape=(capacity,))
+        self.header[0] = capacity
+        self.capacity = capacity
+
+    @property
+    def count(self):
+        """
+        :return: <Int> records ever appended, including those since overwritten
+        """
+        return int(self.header[1])
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, xpos, ypos, heading, speed, turn_angle):
+        count = self.count
+        self.records[count % self.capacity] = (timestamp, xpos, ypos, heading, speed, turn_angle)
+        self.header[1] = count + 1  # only counted once the record is complete
+
+    def append_cardata(self, timestamp, cardata):
+        """
+        :param timestamp: <Float> time.time() of the tick
+        :param cardata: <CarData> drone state after the tick
+        """
+        self.append(timestamp, cardata.XPOS, cardata.YPOS, cardata.HEADING, cardata.SPEED, cardata.TURNANGLE)
+
+    def window(self, last=None):
+        """
+        :param last: <Int> number of most recent records, all that are kept if None
+        :return: <numpy.ndarray> RECORD array, oldest first. A copy, later appends don't change it.
+        """
+        size = len(self) if last is None else min(last, len(self))
+        end = self.count % self.capacity
+        start = end - size
+        if start >= 0:
+            return self.records[start:end].copy()
+        return np.concatenate((self.records[start:], self.records[:end]))
+
+    def since(self, timestamp):
+        """
+        :param timestamp: <Float> earliest time to return
+        :return: <numpy.ndarray> RECORD array of the kept records at or after timestamp, oldest first
+        """
+        records = self.window()
+        return records[np.searchsorted(records['time'], timestamp):]
+
+    def latest(self):
+        """
+        :return: <numpy.void> most recent record, None if there is none
+        """
+        if not self.count:
+            return None
+        return self.records[(self.count - 1) % self.capacity].copy()
+
+    def flush(self):
+        if self.path is not None:
+            self.records.flush()
+            self.header.flush()
+
+    def close(self):
+        self.flush()
+        if self.path is not None:
+            del self.records, self.header
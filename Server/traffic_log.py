@@ -0,0 +1,290 @@
+"""
+Records the traffic between the server and its cars to a compact binary log, and replays a log back into the server, so
+a failure seen in the field can be reproduced at the desk.
+
+The log starts with MAGIC, followed by one record per event: RECORD header (timestamp, drone id, kind, payload length)
+and the payload. Inbound payloads are the bytes as data_received got them, outbound ones as they were written to the
+transport, connects carry the drone's slot and velocity records the VECTOR the drone read on a control tick. Records go
+through a large write buffer, so recording costs a struct pack and a memory copy per message; the server flushes it
+every TRAFFIC_LOG_FLUSH_INTERVAL seconds and whenever a car disconnects.
+
+    python3 traffic_log.py traffic.log [speed]     speed is a multiple of real time, 'max' to not wait at all
+
+A replay feeds the recorded inbound traffic to fresh ServerClientProtocols through ReplayTransports and reports how the
+server's answers compare to what was recorded. Each drone reads back the velocity vectors it read when recorded, in the
+same order, and never the joystick's shared memory channel. Sessions are handed out again with new tokens, a car's
+resume: message is translated to the token the replay gave it and grace periods run on the recorded time, so a car
+that reconnected gets its drone back, or not, just as it did in the field.
+"""
+
+import collections
+import contextlib
+import heapq
+import io
+import itertools
+import re
+import socket
+import struct
+import sys
+import time
+
+import server_cfg as cfg
+from velocity_service import VelocityStore
+
+MAGIC = b'DRONETRAFFIC1\n'
+RECORD = struct.Struct('<dIBI')
+INBOUND = 0
+OUTBOUND = 1
+CONNECT = 2
+DISCONNECT = 3
+VELOCITY = 4
+VECTOR = struct.Struct('<dd')  # xvel, yvel
+SESSION_MESSAGE = re.compile(br'session:([0-9a-f]*)\\')  # tokens are random, left out when comparing a replay
+RESUME_MESSAGE = re.compile(br'resume:([0-9a-f]*)\\')
+
+
+class TrafficRecorder:
+    def __init__(self, path, buffer_size=cfg.TRAFFIC_LOG_BUFFER):
+        """
+        :param path: <String> log to append to, started with MAGIC if new
+        :param buffer_size: <Int> bytes buffered before they are written out
+        """
+        self.path = path
+        self.log = open(path, 'ab', buffering=buffer_size)
+        if self.log.tell() == 0:
+            self.log.write(MAGIC)
+        self.flush_timer = None
+
+    def record(self, drone_id, kind, payload=b''):
+        self.log.write(RECORD.pack(time.time(), drone_id, kind, len(payload)))
+        self.log.write(payload)
+
+    def flush(self):
+        self.log.flush()
+
+    def flush_every(self, event_loop, interval):
+        """
+        Flushes now and then every interval seconds on the event loop until closed, so a crash loses at most that much
+        """
+        self.flush()
+        self.flush_timer = event_loop.call_later(interval, self.flush_every, event_loop, interval)
+
+    def close(self):
+        if self.flush_timer:
+            self.flush_timer.cancel()
+        self.log.close()
+
+
+class RecordingTransport:
+    """
+    Wraps a connection's transport, recording everything written to the car before passing it on
+    """
+
+    def __init__(self, transport, recorder, drone_id):
+        self.transport = transport
+        self.recorder = recorder
+        self.drone_id = drone_id
+
+    def write(self, data):
+        self.recorder.record(self.drone_id, OUTBOUND, bytes(data))
+        self.transport.write(data)
+
+    def record_velocity(self, velocity_vector):
+        self.recorder.record(self.drone_id, VELOCITY, VECTOR.pack(*velocity_vector))
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+def read_log(path):
+    """
+    :param path: <String> log written by a TrafficRecorder
+    :return: <Generator> (timestamp, drone id, kind, payload) in the order recorded. A record cut short by a crash ends
+        the log.
+    """
+    with open(path, 'rb') as log:
+        if log.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a traffic log')
+        while True:
+            header = log.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, drone_id, kind, length = RECORD.unpack(header)
+            payload = log.read(length)
+            if len(payload) < length:
+                return
+            yield timestamp, drone_id, kind, payload
+
+
+class ReplayTransport:
+    """
+    Stands in for a car's connection during a replay, keeping what the server sends
+    """
+
+    socket = socket  # CarConnection.client_tx catches transport.socket.error
+
+    def __init__(self, drone_id):
+        self.drone_id = drone_id
+        self.written = []
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def get_extra_info(self, name, default=None):
+        return ('replay', self.drone_id) if name == 'peername' else default
+
+    def close(self):
+        pass
+
+
+class RecordedVelocities(VelocityStore):
+    """
+    The replay's velocity source: each read of a slot moves it on to the next vector recorded for it, and the slot keeps
+    its last vector once they run out
+    """
+
+    def __init__(self):
+        VelocityStore.__init__(self)
+        self.recorded = collections.defaultdict(collections.deque)  # slot: vectors not read yet
+
+    def queue(self, slot, velocity_vector):
+        self.recorded[slot].append(velocity_vector)
+
+    def velocity(self, slot):
+        if self.recorded[slot]:
+            self.set_velocity(slot, *self.recorded[slot].popleft())
+        return VelocityStore.velocity(self, slot)
+
+
+class RecordedTimer:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class RecordedTimers:
+    """
+    Stands in for the event loop the replay's SessionRegistry times grace periods on, timers fire once the recorded time
+    has passed them
+    """
+
+    def __init__(self, clock):
+        """
+        :param clock: <Function> returns the recorded time the replay has reached
+        """
+        self.clock = clock
+        self.timers = []  # heap of (when, order scheduled, RecordedTimer)
+        self.order = itertools.count()
+
+    def call_later(self, delay, callback, *args):
+        timer = RecordedTimer(self.clock() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.when, next(self.order), timer))
+        return timer
+
+    def run_due(self):
+        while self.timers and self.timers[0][0] <= self.clock():
+            timer = heapq.heappop(self.timers)[2]
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+
+def replay(path, speed=1.0, quiet=True):
+    """
+    Feeds a log's inbound traffic back into the server with the recorded timing
+
+    :param path: <String> log written by a TrafficRecorder
+    :param speed: <Float> multiple of real time to replay at, None as fast as possible
+    :param quiet: <Boolean> swallow everything the server prints
+    :return: <Dict> drone id: {"inbound": messages fed, "recorded": bytes the server sent when recorded,
+        "replayed": bytes it sent this time, "matches": whether the two are the same apart from session tokens}
+    """
+    # Imported here so car_controller can import the recorder without a cycle
+    from car_controller import ServerClientProtocol, SessionRegistry
+
+    velocity_store = RecordedVelocities()  # also keeps the replay off the network
+    recorded_time = [0.0]
+    timers = RecordedTimers(lambda: recorded_time[0])
+    sessions = SessionRegistry(timers, cfg.SESSION_GRACE_PERIOD)
+    tokens = {}  # session token handed out when recorded: the one handed out for the same session in the replay
+    pending = None  # (drone id, payload) of an inbound record held back until the vectors read handling it are queued
+    protocols = {}
+    transports = {}
+    results = {}
+    start = None
+    output = io.StringIO() if quiet else sys.stdout
+
+    def replay_token(match):
+        return b'resume:' + tokens.get(match.group(1), match.group(1)) + b'\\'
+
+    def feed(drone_id, payload):
+        if drone_id in protocols:
+            protocols[drone_id].data_received(RESUME_MESSAGE.sub(replay_token, payload))
+            results[drone_id]["inbound"] += 1
+
+    with contextlib.redirect_stdout(output):
+        for timestamp, drone_id, kind, payload in read_log(path):
+            if start is None:
+                start = (timestamp, time.perf_counter())
+            if speed:
+                delay = (timestamp - start[0]) / speed - (time.perf_counter() - start[1])
+                if delay > 0:
+                    time.sleep(delay)
+            recorded_time[0] = timestamp
+
+            # The vectors a drone read and what it sent are recorded after the inbound message that made it do so
+            if kind == VELOCITY:
+                if drone_id in protocols:
+                    velocity_store.queue(protocols[drone_id].drone_instance.slot, list(VECTOR.unpack(payload)))
+                continue
+            if kind == OUTBOUND:
+                if drone_id in results:
+                    results[drone_id]["recorded"].append(payload)
+                if drone_id in protocols:
+                    # The first token sent on a connection is the one it opened, later ones confirm a resume
+                    for token in SESSION_MESSAGE.findall(payload):
+                        tokens.setdefault(token, protocols[drone_id].session_token.encode('ascii'))
+                continue
+            if pending:
+                feed(*pending)
+                pending = None
+            timers.run_due()
+
+            if kind == CONNECT:
+                protocol = ServerClientProtocol(False, False, True, sessions, slot=int(payload or 0),
+                                                velocity_store=velocity_store, clock=lambda: recorded_time[0])
+                transports.setdefault(drone_id, ReplayTransport(drone_id))
+                protocol.connection_made(transports[drone_id])
+                protocols[drone_id] = protocol
+                results.setdefault(drone_id, {"inbound": 0, "recorded": []})
+            elif drone_id not in protocols:
+                continue  # the log began mid connection
+            elif kind == INBOUND:
+                pending = (drone_id, payload)
+            elif kind == DISCONNECT:
+                protocols.pop(drone_id).connection_lost(None)
+        if pending:
+            feed(*pending)
+
+    for drone_id, result in results.items():
+        result["recorded"] = b''.join(result["recorded"])
+        result["replayed"] = b''.join(transports[drone_id].written)
+        result["matches"] = (SESSION_MESSAGE.sub(b'', result["replayed"]) ==
+                             SESSION_MESSAGE.sub(b'', result["recorded"]))
+    return results
+
+
+if __name__ == "__main__":
+    replay_speed = 1.0
+    if len(sys.argv) > 2:
+        replay_speed = None if sys.argv[2] == 'max' else float(sys.argv[2])
+    started = time.perf_counter()
+    for replayed_drone, replay_result in sorted(replay(sys.argv[1], replay_speed).items()):
+        print("Drone {}: {} inbound messages, {} bytes sent, {} recorded, {}".format(
+            replayed_drone, replay_result["inbound"], len(replay_result["replayed"]), len(replay_result["recorded"]),
+            "same as recorded" if replay_result["matches"] else "DIFFERS from recording"))
+    print("Replayed in {:.2f}s".format(time.perf_counter() - started))
@@ -0,0 +1,392 @@
+"""
+In-process HTTP service for exchanging velocity vectors and GPS positions with the simulator, replacing the CGI scripts.
+It runs on car_controller's event loop and answers from memory, over keep-alive connections.
+
+GET  SERVER_GET_ADDRESS?id=<slot>   -> {"xvel": .., "yvel": ..}
+POST SERVER_GET_ADDRESS             <- {"xvel": .., "yvel": .., "id": <slot>}, or a list of them
+POST SERVER_POST_ADDRESS            <- {"xpos": .., "ypos": .., "id": <drone id>}
+GET  SERVER_POST_ADDRESS            -> {"<drone id>": {"xpos": .., "ypos": .., "id": ..}, ...}
+GET  VELOCITY_STREAM_ADDRESS        -> chunked stream of {"xvel": .., "yvel": .., "id": <slot>} lines, every slot
+                                       once, then each change as it is posted and every slot again after
+                                       VELOCITY_STREAM_KEEPALIVE seconds without one
+GET  DASHBOARD_ADDRESS              -> live fleet dashboard, see dashboard.py
+POST AUTONOMY_ADDRESS               <- {"id": <drone id>, "speed": .., "waypoints": [[x, y], ...]} to drive a route,
+                                       {"id": .., "speed": .., "heading": ..} to hold a heading or
+                                       {"id": .., "manual": true} to hand the drone back to the velocity vectors
+
+A server without a velocity source of its own subscribes to another one's stream with VelocitySubscriber, which keeps
+the latest vector for each slot in its local store, so control ticks never wait on the network. The keepalive resends
+refresh those vectors; a stream that goes quiet for VELOCITY_STREAM_TIMEOUT is dropped and the slots it fed stopped.
+Run this module on its own to host a standalone velocity source for the simulator to post into.
+"""
+
+import asyncio
+import json
+import time
+import urllib.parse
+
+import dashboard
+import server_cfg as cfg
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large'}
+
+
+class VelocityStore:
+    """
+    Latest velocity vector for each drone slot and latest position of each drone, shared by the HTTP service and the
+    drones running in the same process
+    """
+
+    def __init__(self):
+        self.vectors = {}  # slot: ([xvel, yvel], time posted)
+        self.positions = {}  # drone id: {"xpos", "ypos", "id"}
+        self.subscriptions = []
+
+    def set_velocity(self, slot, xvel, yvel):
+        velocity_vector = [float(xvel), float(yvel)]
+        posted = self.vectors.get(slot)
+        self.vectors[slot] = (velocity_vector, time.time())
+        if posted is None or posted[0] != velocity_vector:
+            for subscription in self.subscriptions:
+                subscription.push(slot, velocity_vector)
+
+    def subscribe(self):
+        """
+        :return: <Subscription> receives every slot's current vector and then each change
+        """
+        subscription = Subscription()
+        for slot, posted in self.vectors.items():
+            subscription.push(slot, posted[0])
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.remove(subscription)
+
+    def velocity(self, slot):
+        """
+        :param slot: <Int> drone slot
+        :return: <Tuple> [xvel, yvel] and the time it was posted, None if nothing was posted for the slot
+        """
+        return self.vectors.get(slot)
+
+    def post_gps(self, gps_data, drone_id):
+        self.positions[str(drone_id)] = {"xpos": gps_data[0], "ypos": gps_data[1], "id": drone_id}
+
+
+class Subscription:
+    """
+    Changes waiting to go out to one stream. Only the newest vector per slot is kept, so a slow subscriber gets the
+    latest values rather than a backlog.
+    """
+
+    def __init__(self):
+        self.pending = {}  # slot: [xvel, yvel]
+        self.changed = asyncio.Event()
+
+    def push(self, slot, velocity_vector):
+        self.pending[slot] = velocity_vector
+        self.changed.set()
+
+    async def changes(self, timeout=None):
+        """
+        :param timeout: <Float> seconds to wait for a change at most, forever if None
+        :return: <Dict> slot: [xvel, yvel] changed since the last call, waits until there is at least one. Empty if the
+            timeout passed first.
+        """
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.changed.clear()
+        pending, self.pending = self.pending, {}
+        return pending
+
+
+class VelocityService:
+    def __init__(self, store, debug, fleet=None):
+        """
+        :param store: <VelocityStore> data served and updated by the service
+        :param debug: <Boolean> Debug mode (T/F)
+        :param fleet: <Fleet> drones shown on the dashboard, no dashboard if None
+        """
+        self.store = store
+        self.debug = debug
+        self.fleet = fleet
+        self.server = None
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        print("Velocity service on : ", self.server.sockets[0].getsockname())
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves requests on one connection until the client closes it, asks to, or goes quiet for
+        VELOCITY_SERVICE_KEEPALIVE seconds
+        """
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), cfg.VELOCITY_SERVICE_KEEPALIVE)
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    self.respond(writer, 400, {"error": "malformed request line"}, False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    self.respond(writer, 400, {"error": "malformed content-length"}, False)
+                    break
+                if length > cfg.VELOCITY_SERVICE_MAX_BODY:
+                    self.respond(writer, 413, {"error": "body too large"}, False)
+                    break
+                body = (await reader.readexactly(length)) if length else b''
+
+                if method == 'GET' and target == cfg.VELOCITY_STREAM_ADDRESS:
+                    await self.stream_velocities(writer)
+                    break
+                if method == 'GET' and target == cfg.DASHBOARD_STREAM_ADDRESS and self.fleet is not None:
+                    await self.stream_dashboard(writer)
+                    break
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' and (version != 'HTTP/1.0' or connection == 'keep-alive')
+
+                if method == 'GET' and target == cfg.DASHBOARD_ADDRESS and self.fleet is not None:
+                    self.respond_body(writer, 200, dashboard.page(), 'text/html; charset=utf-8', keep_alive)
+                else:
+                    status, response = self.route(method, target, body)
+                    self.respond(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def stream_velocities(self, writer):
+        """
+        Pushes velocity changes down a chunked response, one JSON line per chunk, until the subscriber goes away. When
+        nothing changes for VELOCITY_STREAM_KEEPALIVE seconds every slot is sent again (an empty line if there are
+        none), so the subscriber can tell a quiet stream from a dead one.
+        """
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: application/x-ndjson\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n')
+        subscription = self.store.subscribe()
+        if self.debug:
+            print("Velocity stream subscriber connected")
+        try:
+            while True:
+                changes = await subscription.changes(cfg.VELOCITY_STREAM_KEEPALIVE)
+                if not changes:
+                    changes = {slot: posted[0] for slot, posted in self.store.vectors.items()}
+                    if not changes:
+                        writer.write(b'1\r\n\n\r\n')
+                for slot, velocity_vector in changes.items():
+                    line = json.dumps({"xvel": velocity_vector[0], "yvel": velocity_vector[1], "id": slot}) + '\n'
+                    line = line.encode('utf-8')
+                    writer.write('{:x}\r\n'.format(len(line)).encode('latin-1') + line + b'\r\n')
+                await writer.drain()
+        finally:
+            self.store.unsubscribe(subscription)
+
+    async def stream_dashboard(self, writer):
+        """
+        Sends the fleet as Server-Sent Events, the whole fleet first and then only what changed, at most DASHBOARD_RATE
+        times a second, until the dashboard goes away
+        """
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/event-stream\r\n'
+                     b'Cache-Control: no-cache\r\n'
+                     b'Connection: keep-alive\r\n\r\n')
+        if self.debug:
+            print("Dashboard connected")
+        sent = {}
+        idle = 0.0
+        while True:
+            fleet = self.fleet.snapshot()
+            changes = dashboard.delta(sent, fleet)
+            if changes:
+                writer.write(('data: ' + json.dumps(changes, separators=(',', ':')) + '\n\n').encode('utf-8'))
+                sent = fleet
+                idle = 0.0
+            elif idle >= cfg.DASHBOARD_KEEPALIVE:
+                writer.write(b': keep-alive\n\n')
+                idle = 0.0
+            await writer.drain()
+            await asyncio.sleep(1.0 / cfg.DASHBOARD_RATE)
+            idle += 1.0 / cfg.DASHBOARD_RATE
+
+    def route(self, method, target, body):
+        """
+        :return: <Tuple> HTTP status and the JSON serializable response
+        """
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+        if self.debug:
+            print("Velocity service: ", method, target)
+
+        try:
+            if url.path == cfg.SERVER_GET_ADDRESS:
+                if method == 'GET':
+                    return 200, self.get_velocity(int(query.get('id', ['0'])[0]))
+                if method == 'POST':
+                    return 200, self.post_velocity(json.loads(body.decode('utf-8')))
+            elif url.path == cfg.AUTONOMY_ADDRESS and self.fleet is not None:
+                if method == 'POST':
+                    return self.command_autonomy(json.loads(body.decode('utf-8')))
+            elif url.path == cfg.SERVER_POST_ADDRESS:
+                if method == 'GET':
+                    return 200, self.store.positions
+                if method == 'POST':
+                    gps_data = json.loads(body.decode('utf-8'))
+                    self.store.post_gps([gps_data["xpos"], gps_data["ypos"]], gps_data["id"])
+                    return 200, {"status": "ok"}
+            else:
+                return 404, {"error": "unknown path " + url.path}
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {"error": str(e)}
+
+        return 405, {"error": "method not allowed"}
+
+    def get_velocity(self, slot):
+        posted = self.store.velocity(slot)
+        velocity_vector = posted[0] if posted else [0.0, 0.0]
+        return {"xvel": velocity_vector[0], "yvel": velocity_vector[1]}
+
+    def post_velocity(self, data):
+        for vector in data if isinstance(data, list) else [data]:
+            self.store.set_velocity(int(vector.get("id", 0)), vector["xvel"], vector["yvel"])
+        return {"status": "ok"}
+
+    def command_autonomy(self, data):
+        """
+        :param data: <Dict> drone id and the route, heading or manual control it is to switch to
+        :return: <Tuple> HTTP status and the JSON serializable response
+        """
+        drone = self.fleet.connected_drone(data["id"])
+        if drone is None:
+            return 404, {"error": "no connected drone " + str(data["id"])}
+        if "waypoints" in data:
+            waypoints = [(float(x), float(y)) for x, y in data["waypoints"]]
+            if not waypoints:
+                return 400, {"error": "empty route"}
+            drone.upload_waypoints(waypoints, float(data["speed"]))
+        elif "heading" in data:
+            drone.hold_heading(float(data["heading"]), float(data["speed"]))
+        elif data.get("manual"):
+            drone.take_manual_control()
+        else:
+            return 400, {"error": "expected waypoints, heading or manual"}
+        return 200, {"status": "ok"}
+
+    @staticmethod
+    def respond(writer, status, response, keep_alive):
+        VelocityService.respond_body(writer, status, json.dumps(response).encode('utf-8'), 'application/json',
+                                     keep_alive)
+
+    @staticmethod
+    def respond_body(writer, status, body, content_type, keep_alive):
+        head = ('HTTP/1.1 {} {}\r\n'
+                'Content-Type: {}\r\n'
+                'Content-Length: {}\r\n'
+                'Connection: {}\r\n\r\n').format(status, REASONS[status], content_type, len(body),
+                                                 'keep-alive' if keep_alive else 'close')
+        writer.write(head.encode('latin-1') + body)
+
+
+class VelocitySubscriber:
+    def __init__(self, store, address, debug):
+        """
+        Follows another velocity service's stream and keeps its vectors in the local store
+
+        :param store: <VelocityStore> local store the drones read
+        :param address: <Tuple> ('host', port) of the velocity service to subscribe to
+        :param debug: <Boolean> Debug mode (T/F)
+        """
+        self.store = store
+        self.address = address
+        self.debug = debug
+        self.streamed = set()  # slots the stream has set in the local store
+
+    async def run(self):
+        """
+        Stays subscribed, reconnecting after VELOCITY_STREAM_RETRY seconds whenever the stream drops. Runs until
+        cancelled.
+        """
+        while True:
+            try:
+                await self.follow_stream()
+            except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                print("Velocity stream from ", self.address, " lost: ", repr(e))
+            self.stop_streamed()
+            await asyncio.sleep(cfg.VELOCITY_STREAM_RETRY)
+
+    def stop_streamed(self):
+        """
+        Stops every slot the lost stream was driving, rather than leaving the drones on its last vectors
+        """
+        for slot in self.streamed:
+            self.store.set_velocity(slot, 0.0, 0.0)
+        self.streamed.clear()
+
+    async def follow_stream(self):
+        reader, writer = await asyncio.open_connection(*self.address)
+        try:
+            writer.write('GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(cfg.VELOCITY_STREAM_ADDRESS,
+                                                                          self.address[0]).encode('latin-1'))
+            status = (await reader.readline()).split()
+            if len(status) < 2 or status[1] != b'200':
+                raise ValueError('velocity stream refused: ' + repr(status))
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            print("Subscribed to velocity stream from ", self.address)
+
+            buffer = b''
+            while True:
+                size_line = await asyncio.wait_for(reader.readline(), cfg.VELOCITY_STREAM_TIMEOUT)
+                size = int(size_line.split(b';')[0] or b'0', 16)
+                if not size:
+                    raise ValueError('velocity stream ended')
+                buffer += (await reader.readexactly(size + 2))[:-2]
+                *lines, buffer = buffer.split(b'\n')
+                for line in filter(None, lines):
+                    vector = json.loads(line.decode('utf-8'))
+                    self.store.set_velocity(int(vector["id"]), vector["xvel"], vector["yvel"])
+                    self.streamed.add(int(vector["id"]))
+                    if self.debug:
+                        print("Streamed velocity vector: ", vector)
+        finally:
+            writer.close()
+
+
+if __name__ == "__main__":
+    event_loop = asyncio.get_event_loop()
+    service = VelocityService(VelocityStore(), False)
+    event_loop.run_until_complete(service.start('', cfg.VELOCITY_SERVICE_PORT))
+    try:
+        event_loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    event_loop.run_until_complete(service.close())
+    event_loop.close()
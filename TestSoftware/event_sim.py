@@ -0,0 +1,319 @@
+"""
+Discrete-event simulation of the whole control loop. The server's own ServerClientProtocol, Drone, Turning and
+GPSCalculations run against simulated cars over an in-memory transport, with every delay (link latency, GPS rate, the
+car's control requests) scheduled on a virtual clock instead of slept through. An hour long multi-car mission replays in
+seconds and, for a given seed, always produces the same result.
+
+    sim = Simulation(num_cars=3, seed=1)
+    results = sim.run(3600)
+"""
+
+import contextlib
+import heapq
+import io
+import math
+import random
+import socket
+import sys
+import time
+
+import server_cfg as cfg
+from car_controller import ServerClientProtocol
+from gps_ops import GPSCalculations
+from stepped_turning import Turning
+from fake_devices import gga_sentence
+from velocity_service import VelocityStore
+
+WHEELBASE = 0.33  # m, 1/10 scale car
+LINK_LATENCY = 0.005  # s each way
+LINK_JITTER = 0.002  # s, uniformly random extra latency
+CONTROL_INTERVAL = 0.25  # s between the car's requests for a new turn
+COMPUTE_TIME = 0.01  # s the server takes to handle a message, its replies leave this much later, see MemoryTransport
+VELOCITY_INTERVAL = 0.5  # s between updates from the velocity source
+GPS_NOISE = 0.0  # m, standard deviation of the simulated fixes
+
+
+class VirtualClock:
+    """
+    Event queue and the simulation's notion of time. Handlers run in time order, ties in the order they were scheduled.
+
+    Code under test that times itself (Drone's turn interval, ack latency) reads the clock through time(), which only
+    ever reports the time of the event being handled.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.events = []
+        self.scheduled = 0
+        self.processed = 0
+
+    def time(self):
+        return self.now
+
+    def schedule(self, delay, callback, *args):
+        self.scheduled += 1
+        heapq.heappush(self.events, (self.now + delay, self.scheduled, callback, args))
+
+    def run(self, until):
+        """
+        :param until: <Float> virtual time to stop at
+        :return: <Int> number of events processed
+        """
+        while self.events and self.events[0][0] <= until:
+            event_time, _, callback, args = heapq.heappop(self.events)
+            self.now = max(self.now, event_time)
+            callback(*args)
+            self.processed += 1
+        self.now = max(self.now, until)
+        return self.processed
+
+
+class MemoryTransport:
+    """
+    Stands in for the asyncio transport the server writes to, delivering to a simulated car after the link latency.
+    Handling a message takes no virtual time, so the server's cost is modelled here: everything it writes leaves
+    compute_time after the event that made it write.
+    """
+
+    socket = socket  # CarConnection.client_tx catches transport.socket.error
+
+    def __init__(self, clock, deliver, peername, rng, compute_time=0.0):
+        self.clock = clock
+        self.deliver = deliver
+        self.peername = peername
+        self.rng = rng
+        self.compute_time = compute_time
+        self.closed = False
+
+    def write(self, data):
+        if not self.closed:
+            self.clock.schedule(self.compute_time + link_delay(self.rng), self.deliver, bytes(data))
+
+    def get_extra_info(self, name, default=None):
+        return self.peername if name == 'peername' else default
+
+    def close(self):
+        self.closed = True
+
+
+def link_delay(rng):
+    return LINK_LATENCY + rng.uniform(0, LINK_JITTER)
+
+
+class SimulatedCar:
+    def __init__(self, clock, protocol, rng, start=(10.0, 15.0), heading=0.0, gps_rate=0):
+        """
+        A car that speaks the client's protocol: applies each batch of servo targets and acks it, answers GPS requests,
+        asks for a new turn every CONTROL_INTERVAL and drives the pulses it was given with a bicycle model.
+
+        :param clock: <VirtualClock>
+        :param protocol: <ServerClientProtocol> the server side of this car's connection
+        :param rng: <Random> link jitter and GPS noise
+        :param start: <Tuple> x, y on the field in meters
+        :param heading: <Float> compass heading in degrees, 0 is +y and 90 is +x
+        :param gps_rate: <Float> fixes per second to stream, 0 only answers the server's requests
+        """
+        self.clock = clock
+        self.protocol = protocol
+        self.rng = rng
+        self.gps = GPSCalculations(False, True)
+        self.xpos, self.ypos = start
+        self.heading = heading
+        self.steering = cfg.CENTER
+        self.throttle = cfg.NEUTRAL
+        self.moved_at = 0.0
+        self.pending_targets = {}
+        self.command_seq = None
+        self.connected = True
+        self.track = []  # (time, x, y, heading) at every fix
+
+        self.clock.schedule(CONTROL_INTERVAL, self.request_turn)
+        if gps_rate:
+            self.gps_period = 1.0 / gps_rate
+            self.clock.schedule(self.gps_period, self.stream_fix)
+
+    def send(self, message):
+        if self.connected:
+            self.clock.schedule(link_delay(self.rng), self.protocol.data_received,
+                                bytes(message + '\\', 'utf-8'))
+
+    def receive(self, data):
+        for message in data.decode('utf-8').split('\\'):
+            if message:
+                self.execute(message)
+        self.apply_pending_targets()
+
+    def execute(self, message):
+        if not message[:1].isdigit():
+            self.apply_pending_targets()
+
+        if message.startswith('seq:'):
+            self.command_seq = int(message.split(':')[1])
+        elif message == 'gps':
+            self.send('gps:' + self.fix())
+        elif message in ('start', 'stop'):
+            self.drive({cfg.STEERING: cfg.CENTER, cfg.ESC: cfg.NEUTRAL})
+        elif message in ('kill', 'disconnect'):
+            self.drive({cfg.STEERING: cfg.CENTER, cfg.ESC: cfg.NEUTRAL})
+            self.connected = False
+        elif message[:1].isdigit():
+            self.pending_targets[int(message[0])] = int(message[1:])
+
+    def apply_pending_targets(self):
+        if self.pending_targets:
+            self.drive(self.pending_targets)
+            self.pending_targets = {}
+        if self.command_seq is not None:
+            self.send('ack:{}:{:.3f}:{}:{}'.format(self.command_seq, self.clock.now, self.steering, self.throttle))
+            self.command_seq = None
+
+    def drive(self, targets):
+        self.move()
+        self.steering = targets.get(cfg.STEERING, self.steering)
+        self.throttle = targets.get(cfg.ESC, self.throttle)
+
+    def move(self):
+        """
+        Brings the position up to the current time, driving an arc at the current pulses since the last update
+        """
+        dt = self.clock.now - self.moved_at
+        self.moved_at = self.clock.now
+        speed = 0.0
+        if self.throttle > cfg.MIN_MOVE_SPEED:
+            speed = min(self.throttle - cfg.MIN_MOVE_SPEED, cfg.MAX_SPEED) / cfg.VELOCITY_GRADIENT
+        if not dt or not speed:
+            return
+
+        # Pulses below center steer right, the way Turning.gen_turn_signal generates them
+        wheel_angle = (cfg.CENTER - self.steering) / cfg.DEGREE_GRADIENT
+        yaw_rate = speed * math.tan(math.radians(wheel_angle)) / WHEELBASE
+        heading = math.radians(self.heading)
+        if abs(yaw_rate) < 1e-9:
+            self.xpos += speed * dt * math.sin(heading)
+            self.ypos += speed * dt * math.cos(heading)
+        else:
+            new_heading = heading + yaw_rate * dt
+            radius = speed / yaw_rate
+            self.xpos += radius * (math.cos(heading) - math.cos(new_heading))
+            self.ypos += radius * (math.sin(new_heading) - math.sin(heading))
+            self.heading = math.degrees(new_heading) % 360
+
+    def fix(self):
+        self.move()
+        self.track.append((self.clock.now, self.xpos, self.ypos, self.heading))
+        xpos = self.xpos + self.rng.gauss(0, GPS_NOISE) if GPS_NOISE else self.xpos
+        ypos = self.ypos + self.rng.gauss(0, GPS_NOISE) if GPS_NOISE else self.ypos
+        lat, lon = self.gps.xy_to_gps(xpos, ypos)
+        return gga_sentence(self.clock.now, lat, lon)
+
+    def request_turn(self):
+        if not self.connected:
+            return
+        self.send('request:velocity')
+        self.clock.schedule(CONTROL_INTERVAL, self.request_turn)
+
+    def stream_fix(self):
+        if not self.connected:
+            return
+        self.send('gps:' + self.fix() + ':{:.3f}'.format(self.clock.now))
+        self.clock.schedule(self.gps_period, self.stream_fix)
+
+
+class Simulation:
+    def __init__(self, num_cars=1, seed=0, velocity_script=None, gps_rate=0, compute_time=COMPUTE_TIME, starts=None,
+                 turning_params=None):
+        """
+        :param num_cars: <Int> cars to simulate, each on its own drone slot
+        :param seed: <Int> seeds link jitter, GPS noise and the default velocity script
+        :param velocity_script: <Function> (time, slot) -> [xvel, yvel] sampled every VELOCITY_INTERVAL, a random walk
+            like mock_sim_inputs.gen_random_vector if None
+        :param gps_rate: <Float> fixes per second the cars stream, 0 has the server request one every turn
+        :param compute_time: <Float> virtual seconds the server takes to answer a message
+        :param starts: <List> (x, y, heading) each car starts at, cars line up along y = 15 heading north if None
+        :param turning_params: <Dict> keyword arguments for the drones' Turning, server_cfg's if None
+        """
+        self.rng = random.Random(seed)
+        self.clock = VirtualClock()
+        self.velocity_store = VelocityStore()
+        self.velocity_script = velocity_script or self.random_velocity
+        self.vectors = {}
+        self.cars = []
+        self.protocols = []
+
+        for slot in range(num_cars):
+            protocol = ServerClientProtocol(False, False, True, slot=slot, velocity_store=self.velocity_store,
+                                            clock=self.clock.time)
+            xpos, ypos, heading = starts[slot] if starts else (10.0 + 5 * slot, 15.0, 0.0)
+            car = SimulatedCar(self.clock, protocol, self.rng, gps_rate=gps_rate, start=(xpos, ypos), heading=heading)
+            protocol.connection_made(MemoryTransport(self.clock, car.receive, ('sim', 9000 + slot), self.rng,
+                                                     compute_time))
+            if turning_params:
+                protocol.drone_instance.turning = Turning(False, **turning_params)
+            self.protocols.append(protocol)
+            self.cars.append(car)
+
+        self.clock.schedule(0.0, self.update_velocities)
+
+    def random_velocity(self, now, slot):
+        vector = self.vectors.get(slot)
+        if vector is None or self.rng.random() < 0.25:
+            vector = [self.rng.uniform(-cfg.MAX_VELOCITY, cfg.MAX_VELOCITY),
+                      self.rng.uniform(-cfg.MAX_VELOCITY, cfg.MAX_VELOCITY)]
+        # Turn back at the edges of the field, as mock_sim_inputs.simulate_cars bounces off them
+        car = self.cars[slot]
+        if car.xpos < 0 or car.xpos > cfg.LENGTH_X:
+            vector[0] = abs(vector[0]) if car.xpos < 0 else -abs(vector[0])
+        if car.ypos < 0 or car.ypos > cfg.LENGTH_Y:
+            vector[1] = abs(vector[1]) if car.ypos < 0 else -abs(vector[1])
+        self.vectors[slot] = vector
+        return vector
+
+    def update_velocities(self):
+        for slot in range(len(self.cars)):
+            xvel, yvel = self.velocity_script(self.clock.now, slot)
+            self.velocity_store.set_velocity(slot, xvel, yvel)
+        self.clock.schedule(VELOCITY_INTERVAL, self.update_velocities)
+
+    def run(self, duration, quiet=True):
+        """
+        :param duration: <Float> virtual seconds to simulate
+        :param quiet: <Boolean> swallow everything the server prints
+        :return: <Dict> events processed, wall clock time taken and per car results
+        """
+        start = time.perf_counter()
+        output = io.StringIO() if quiet else sys.stdout
+        with contextlib.redirect_stdout(output):
+            events = self.clock.run(self.clock.now + duration)
+
+        return {
+            "events": events,
+            "virtual_time": self.clock.now,
+            "wall_time": time.perf_counter() - start,
+            "cars": [self.car_results(car, protocol) for car, protocol in zip(self.cars, self.protocols)]
+        }
+
+    @staticmethod
+    def car_results(car, protocol):
+        acks = protocol.drone_instance.connection.acks
+        return {
+            "track": car.track,
+            "position": (car.xpos, car.ypos),
+            "heading": car.heading,
+            "commands": acks.next_seq,
+            "acked": acks.acked,
+            "dropped": acks.dropped,
+            "mean_latency": acks.mean_latency,
+            "max_latency": acks.max_latency
+        }
+
+
+if __name__ == "__main__":
+    simulation = Simulation(num_cars=3, seed=1)
+    results = simulation.run(3600)
+    print("Simulated {:.0f}s in {:.2f}s, {} events".format(results["virtual_time"], results["wall_time"],
+                                                         results["events"]))
+    for slot, car in enumerate(results["cars"]):
+        print("Car {}: at ({:.1f}, {:.1f}) heading {:.1f}, {} commands, {} acked, {} dropped, "
+              "latency mean {:.4f}s max {:.4f}s".format(slot, car["position"][0], car["position"][1], car["heading"],
+                                                       car["commands"], car["acked"], car["dropped"],
+                                                       car["mean_latency"], car["max_latency"]))
@@ -0,0 +1,363 @@
+"""
+Simulated Maestro and GPS for running the car client without hardware. Each device sits on the master side of a pty
+pair and the client opens the slave side exactly as it would /dev/ttyACM0-2, so the whole serial path (pyserial, the
+Maestro protocol, NMEA parsing) runs for real.
+
+    PYTHONPATH=Server:Client python3 TestSoftware/fake_devices.py
+
+prints the ports to put in client_cfg (MAESTRO_CON_PORT, MAESTRO_SER_PORT, GPS_PORT).
+"""
+
+import math
+import os
+import select
+import threading
+import time
+import tty
+
+import client_cfg as cfg
+# The fake GPS reports positions through the server's own field projection
+from gps_ops import GPSCalculations
+
+# Data bytes following each compact protocol command byte, 0x9F depends on its count byte
+COMMAND_SIZES = {
+    0x84: 3,  # Set Target
+    0x87: 3,  # Set Speed
+    0x89: 3,  # Set Acceleration
+    0x90: 1,  # Get Position
+    0x93: 0,  # Get Moving State
+    0x9F: 2,  # Set Multiple Targets
+    0xA1: 0,  # Get Errors
+    0xA2: 0,  # Go Home
+    0xFF: 2,  # Mini SSC
+}
+BAUD_INDICATION = 0xAA
+SERIAL_PROTOCOL_ERROR = 0x0010
+MAESTRO_UPDATE_PERIOD = 0.02  # s, the Maestro updates its outputs every 20ms
+MAESTRO_CHANNELS = 6
+
+
+def open_pty():
+    """
+    :return: <Tuple> master fd, slave fd, slave device path
+    """
+    master, slave = os.openpty()
+    # No echo, no line buffering, no CR/NL translation, just bytes
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+
+def nmea_checksum(sentence):
+    """
+    :param sentence: <String> everything between '$' and '*'
+    :return: <String> two hex digit checksum
+    """
+    checksum = 0
+    for char in sentence:
+        checksum ^= ord(char)
+    return '{:02X}'.format(checksum)
+
+
+def gga_sentence(timestamp, lat, lon):
+    """
+    Builds a GGA sentence in the same layout as the car's receiver
+
+    :param timestamp: <Float> time.time() of the fix
+    :param lat: <Float> decimal latitude
+    :param lon: <Float> decimal longitude
+    :return: <String> $GPGGA,...*checksum
+    """
+    lat_deg, lat_min = divmod(round(abs(lat) * 60, 8), 60)
+    lon_deg, lon_min = divmod(round(abs(lon) * 60, 8), 60)
+    fields = [
+        'GPGGA',
+        time.strftime('%H%M%S', time.gmtime(timestamp)) + '.{:d}'.format(int(timestamp * 10) % 10),
+        '{:02d}{:011.8f}'.format(int(lat_deg), lat_min), 'N' if lat >= 0 else 'S',
+        '{:03d}{:011.8f}'.format(int(lon_deg), lon_min), 'E' if lon >= 0 else 'W',
+        '2', '6', '1.2', '18.893', 'M', '-25.669', 'M', '2.0', '0031'
+    ]
+    sentence = ','.join(fields)
+    return '$' + sentence + '*' + nmea_checksum(sentence)
+
+
+class FakeMaestro(threading.Thread):
+    def __init__(self, multi_target=False, channels=MAESTRO_CHANNELS):
+        """
+        Emulates a Maestro in USB Dual Port mode: the command port swallows anything written to it, the TTL port speaks
+        the compact protocol.
+
+        :param multi_target: <Boolean> accept Set Multiple Targets (Mini Maestro 12/18/24) or reject it (Micro Maestro 6)
+        :param channels: <Int> number of servo channels
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.multi_target = multi_target
+        self.channels = channels
+        self.con_master, self.con_slave, self.con_port = open_pty()
+        self.ser_master, self.ser_slave, self.ser_port = open_pty()
+
+        # Per channel state in quarter microseconds, like the Maestro itself. Position 0 means the output is off.
+        self.targets = [0] * channels
+        self.positions = [0.0] * channels
+        self.velocities = [0.0] * channels
+        self.speeds = [0] * channels
+        self.accelerations = [0] * channels
+        self.errors = 0
+        self.frame = bytearray()
+        self.lock = threading.Lock()
+        self.running = False
+
+        # Counters for benchmarks
+        self.bytes_received = 0
+        self.commands_received = 0
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        last_update = time.perf_counter()
+        while self.running:
+            readable = select.select([self.con_master, self.ser_master], [], [], MAESTRO_UPDATE_PERIOD)[0]
+            if self.con_master in readable:
+                os.read(self.con_master, 1024)
+            if self.ser_master in readable:
+                response = self.feed(os.read(self.ser_master, 1024))
+                if response:
+                    os.write(self.ser_master, response)
+
+            now = time.perf_counter()
+            if now - last_update >= MAESTRO_UPDATE_PERIOD:
+                self.update(now - last_update)
+                last_update = now
+
+    def feed(self, data):
+        """
+        Decodes compact protocol bytes, frames may be split across calls
+
+        :param data: <Bytes> bytes written by the client
+        :return: <Bytes> responses to any queries among them
+        """
+        response = bytearray()
+        with self.lock:
+            self.bytes_received += len(data)
+            for byte in data:
+                if not self.frame:
+                    if byte == BAUD_INDICATION:
+                        continue
+                    if not self.is_command(byte):
+                        self.errors |= SERIAL_PROTOCOL_ERROR
+                        continue
+                elif byte & 0x80 and self.frame[0] != 0xFF:
+                    # A command byte where data was expected, the previous command is lost
+                    self.errors |= SERIAL_PROTOCOL_ERROR
+                    del self.frame[:]
+                    if not self.is_command(byte):
+                        continue
+
+                self.frame.append(byte)
+                if len(self.frame) == self.frame_size():
+                    response.extend(self.execute(bytes(self.frame)))
+                    del self.frame[:]
+
+        return bytes(response)
+
+    def is_command(self, byte):
+        return byte in COMMAND_SIZES and (byte != 0x9F or self.multi_target)
+
+    def frame_size(self):
+        if self.frame[0] == 0x9F and len(self.frame) >= 2:
+            return 3 + 2 * self.frame[1]
+        return 1 + COMMAND_SIZES[self.frame[0]]
+
+    def execute(self, frame):
+        """
+        :param frame: <Bytes> one complete command
+        :return: <Bytes> the Maestro's response, empty for commands that don't answer
+        """
+        self.commands_received += 1
+        command = frame[0]
+        if command != 0xA2 and len(frame) > 1 and frame[1] >= self.channels and command != 0x9F:
+            self.errors |= SERIAL_PROTOCOL_ERROR
+            return b''
+
+        if command == 0x84:
+            self.set_target(frame[1], frame[2] | frame[3] << 7)
+        elif command == 0x87:
+            self.speeds[frame[1]] = frame[2] | frame[3] << 7
+        elif command == 0x89:
+            self.accelerations[frame[1]] = frame[2] | frame[3] << 7
+        elif command == 0x9F:
+            count, start = frame[1], frame[2]
+            if start + count > self.channels:
+                self.errors |= SERIAL_PROTOCOL_ERROR
+                return b''
+            for k in range(count):
+                self.set_target(start + k, frame[3 + 2 * k] | frame[4 + 2 * k] << 7)
+        elif command == 0xFF:
+            # Mini SSC, 0-254 across the default 1000-2000us range
+            self.set_target(frame[1], int(4 * (1000 + 1000 * min(frame[2], 254) / 254)))
+        elif command == 0xA2:
+            for channel in range(self.channels):
+                self.targets[channel] = 0
+                self.positions[channel] = 0.0
+                self.velocities[channel] = 0.0
+        elif command == 0x90:
+            position = int(round(self.positions[frame[1]]))
+            return bytes([position & 0xFF, position >> 8 & 0xFF])
+        elif command == 0x93:
+            return bytes([int(self.is_moving())])
+        elif command == 0xA1:
+            errors, self.errors = self.errors, 0
+            return bytes([errors & 0xFF, errors >> 8 & 0xFF])
+
+        return b''
+
+    def set_target(self, channel, target):
+        self.targets[channel] = target
+        if not self.positions[channel] or not target:
+            # Outputs that were off start at their target, 0 turns the output off
+            self.positions[channel] = float(target)
+            self.velocities[channel] = 0.0
+
+    def is_moving(self):
+        return any(abs(position - target) >= 1 for position, target in zip(self.positions, self.targets))
+
+    def update(self, dt):
+        """
+        Moves every output towards its target within its speed and acceleration limits
+
+        :param dt: <Float> seconds since the last update
+        """
+        with self.lock:
+            for channel in range(self.channels):
+                error = self.targets[channel] - self.positions[channel]
+                if not error:
+                    continue
+                speed, acceleration = self.speeds[channel], self.accelerations[channel]
+                if not speed and not acceleration:
+                    self.positions[channel] = float(self.targets[channel])
+                    continue
+
+                # Speed is in (0.25us)/(10ms), acceleration in (0.25us)/(10ms)/(80ms)
+                max_velocity = speed * 100.0 if speed else float('inf')
+                velocity = self.velocities[channel]
+                if acceleration:
+                    rate = acceleration * 100.0 / 0.08
+                    # Speed up, but never so much that we can't slow down before the target
+                    velocity = min(velocity + rate * dt, max_velocity, math.sqrt(2 * rate * abs(error)))
+                else:
+                    velocity = max_velocity
+
+                step = min(abs(error), velocity * dt)
+                self.positions[channel] += math.copysign(step, error)
+                self.velocities[channel] = velocity if step < abs(error) else 0.0
+
+    def position(self, channel):
+        """
+        :param channel: <Int> servo channel
+        :return: <Float> current output in microseconds
+        """
+        with self.lock:
+            return self.positions[channel] / 4
+
+    def close(self):
+        self.stop()
+        if self.is_alive():
+            # Let the select in run() return before its descriptors go away
+            self.join()
+        for fd in (self.con_master, self.con_slave, self.ser_master, self.ser_slave):
+            os.close(fd)
+
+
+class FakeGPS(threading.Thread):
+    def __init__(self, rate=1.0, start=(0.0, 0.0), heading=0.0, speed=0.0, maestro=None):
+        """
+        Writes GGA sentences for a car moving across the field
+
+        :param rate: <Float> fixes per second
+        :param start: <Tuple> starting x, y on the field in meters
+        :param heading: <Float> starting compass heading in degrees, 0 is +y and 90 is +x
+        :param speed: <Float> m/s, used while no maestro is given
+        :param maestro: <FakeMaestro> if given, speed and turning follow its ESC and steering outputs
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.period = 1.0 / rate
+        self.xpos, self.ypos = start
+        self.heading = heading
+        self.speed = speed
+        self.turn_rate = 0.0  # degrees per second, only used without a maestro
+        self.maestro = maestro
+        self.gps = GPSCalculations(False, True)
+        self.master, self.slave, self.port = open_pty()
+        self.fixes_sent = 0
+        self.running = False
+
+    def stop(self):
+        self.running = False
+
+    def steer(self, speed, turn_rate=0.0):
+        """
+        :param speed: <Float> m/s
+        :param turn_rate: <Float> degrees per second, positive turns right
+        """
+        self.speed = speed
+        self.turn_rate = turn_rate
+
+    def run(self):
+        self.running = True
+        next_tick = time.perf_counter()
+        while self.running:
+            self.move(self.period)
+            self.write_fix()
+            next_tick += self.period
+            time.sleep(max(0.0, next_tick - time.perf_counter()))
+
+    def move(self, dt):
+        speed, turn_rate = self.speed, self.turn_rate
+        if self.maestro:
+            speed, turn_rate = self.motion_from_servos()
+        self.heading = (self.heading + turn_rate * dt) % 360
+        self.xpos += speed * dt * math.sin(math.radians(self.heading))
+        self.ypos += speed * dt * math.cos(math.radians(self.heading))
+
+    def motion_from_servos(self):
+        """
+        :return: <Tuple> speed in m/s and turn rate in degrees per second from the fake Maestro's outputs
+        """
+        throttle = self.maestro.position(cfg.ESC) or cfg.NEUTRAL
+        steering = self.maestro.position(cfg.STEERING) or cfg.CENTER
+        speed = 0.0
+        if throttle >= cfg.MIN_SPEED:
+            speed = (throttle - cfg.MIN_SPEED) / cfg.SPDSCALE
+        # Full lock drives a circle of TURNDIAMETER, a higher pulse steers left
+        lock = (cfg.CENTER - steering) / (cfg.MAX_LEFT - cfg.CENTER)
+        turn_rate = math.degrees(speed / (cfg.TURNDIAMETER / 2)) * lock
+        return speed, turn_rate
+
+    def write_fix(self):
+        lat, lon = self.gps.xy_to_gps(self.xpos, self.ypos)
+        os.write(self.master, bytes(gga_sentence(time.time(), lat, lon) + '\r\n', 'ascii'))
+        self.fixes_sent += 1
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+if __name__ == "__main__":
+    maestro = FakeMaestro(multi_target=cfg.MAESTRO_MULTI_TARGET)
+    gps = FakeGPS(maestro=maestro)
+    maestro.start()
+    gps.start()
+    print('MAESTRO_CON_PORT = ' + repr(maestro.con_port))
+    print('MAESTRO_SER_PORT = ' + repr(maestro.ser_port))
+    print('GPS_PORT = ' + repr(gps.port))
+    try:
+        while True:
+            time.sleep(1)
+            print('steering: {:.1f} throttle: {:.1f} x: {:.2f} y: {:.2f} heading: {:.1f}'.format(
+                maestro.position(cfg.STEERING), maestro.position(cfg.ESC), gps.xpos, gps.ypos, gps.heading))
+    except KeyboardInterrupt:
+        maestro.close()
+        gps.close()
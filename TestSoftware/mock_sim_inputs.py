@@ -1,8 +1,14 @@
+import collections
 import math
 import random
 
+import numpy as np
+
 from Client import client_cfg as cfg
 
+# positions (steps + 1, cars, 2), velocities (steps, cars, 2), headings, turn angles and speeds (steps, cars)
+Trajectories = collections.namedtuple('Trajectories', 'positions velocities headings turn_angles speeds')
+
 
 def gen_random_vector():
     """
@@ -94,3 +100,104 @@ def calc_xy(vx, vy, curx, cury, heading):
             0.5 * math.sin(math.radians(heading)) * cfg.ACCELERATION * (cfg.UPDATE_INTERVAL ** 2.0))
 
     return [curx + xdistance, cury + ydistance]
+
+
+def simulate_cars(num_cars, steps, targets=None, start=None, seed=None):
+    """
+    Monte Carlo engine, steps thousands of independent cars at once with the same motion model as update_pos/calc_xy.
+    Without targets every car keeps its velocity input and changes it to a random one (gen_random_vector) with
+    DIRCHANGEFACTOR probability each step. With targets every car drives at up to MAXVELOCITY towards its own target
+    (gen_targeted_vector) and stops on it. Cars bounce off the edges of the LENGTH_X by LENGTH_Y field.
+
+    :param num_cars: <Int> number of cars
+    :param steps: <Int> number of UPDATE_INTERVAL steps
+    :param targets: <Array> (num_cars, 2) or (2,) target positions, None for random inputs
+    :param start: <Array> (num_cars, 2) starting positions, uniformly random on the field if None
+    :param seed: <Int> random seed, for repeatable runs
+    :return: <Trajectories> float32 arrays
+    """
+    rng = np.random.RandomState(seed)
+    dt = cfg.UPDATE_INTERVAL
+    field = np.array([cfg.LENGTH_X, cfg.LENGTH_Y], dtype=np.float64)
+
+    position = rng.uniform(0, 1, (num_cars, 2)) * field if start is None else np.array(start, dtype=np.float64)
+    position = np.broadcast_to(position, (num_cars, 2)).copy()
+    if targets is not None:
+        targets = np.broadcast_to(np.asarray(targets, dtype=np.float64), (num_cars, 2))
+    velocity = rng.uniform(-cfg.MAXVELOCITY, cfg.MAXVELOCITY, (num_cars, 2))
+    heading = np.zeros(num_cars)
+
+    trajectories = Trajectories(
+        positions=np.empty((steps + 1, num_cars, 2), dtype=np.float32),
+        velocities=np.empty((steps, num_cars, 2), dtype=np.float32),
+        headings=np.empty((steps, num_cars), dtype=np.float32),
+        turn_angles=np.empty((steps, num_cars), dtype=np.float32),
+        speeds=np.empty((steps, num_cars), dtype=np.float32)
+    )
+    trajectories.positions[0] = position
+
+    for step in range(steps):
+        if targets is None:
+            change = rng.uniform(0, 1, num_cars) < cfg.DIRCHANGEFACTOR
+            velocity[change] = rng.uniform(-cfg.MAXVELOCITY, cfg.MAXVELOCITY, (np.count_nonzero(change), 2))
+        else:
+            velocity = targeted_vectors(position, targets)
+
+        # Same as calc_xy, accelerating along the direction of travel
+        speed = np.hypot(velocity[:, 0], velocity[:, 1])
+        direction = np.divide(velocity, speed[:, None], out=np.zeros_like(velocity), where=speed[:, None] > 0)
+        delta = velocity * dt + 0.5 * cfg.ACCELERATION * dt ** 2 * direction
+        if targets is not None:
+            # The acceleration term would carry a car past its target on the last step, stop it on the target instead
+            remaining = np.hypot(*(targets - position).T)
+            length = np.hypot(delta[:, 0], delta[:, 1])
+            delta *= np.minimum(1.0, np.divide(remaining, length, out=np.ones_like(length), where=length > 0))[:, None]
+        position = position + delta
+
+        # Bounce off the edges of the field
+        low, high = position < 0, position > field
+        position = np.where(low, -position, np.where(high, 2 * field - position, position))
+        velocity = np.where(low | high, -velocity, velocity)
+        position = np.clip(position, 0, field)
+
+        # Heading and turn angle as update_pos works them out, in degrees from +x
+        moved = np.hypot(delta[:, 0], delta[:, 1]) > 0
+        new_heading = np.where(moved, np.degrees(np.arctan2(delta[:, 1], delta[:, 0])) % 360, heading)
+        turn_angle = (heading - new_heading + 180) % 360 - 180
+        heading = new_heading
+
+        trajectories.positions[step + 1] = position
+        trajectories.velocities[step] = velocity
+        trajectories.headings[step] = heading
+        trajectories.turn_angles[step] = turn_angle
+        trajectories.speeds[step] = np.minimum(speed, cfg.MAXVELOCITY)
+
+    return trajectories
+
+
+def targeted_vectors(positions, targets):
+    """
+    Vectorized gen_targeted_vector, heads straight for each target without overshooting it in one step
+
+    :param positions: <Array> (cars, 2) current positions
+    :param targets: <Array> (cars, 2) target positions
+    :return: <Array> (cars, 2) velocity vectors
+    """
+    difference = targets - positions
+    distance = np.hypot(difference[:, 0], difference[:, 1])
+    speed = np.minimum(cfg.MAXVELOCITY, distance / cfg.UPDATE_INTERVAL)
+    scale = np.divide(speed, distance, out=np.zeros_like(distance), where=distance > 0)
+    return difference * scale[:, None]
+
+
+def save_trajectories(path, trajectories):
+    """
+    :param path: <String> .npz file to write
+    :param trajectories: <Trajectories> output of simulate_cars
+    """
+    np.savez_compressed(path, **trajectories._asdict())
+
+
+def load_trajectories(path):
+    with np.load(path) as data:
+        return Trajectories(**{field: data[field] for field in Trajectories._fields})
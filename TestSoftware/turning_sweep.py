@@ -0,0 +1,141 @@
+"""
+Parameter sweep for tuning stepped turning. Every combination of turn angles, speed coefficients and heading tolerances
+flies the same set of missions in the discrete-event simulation, the combinations are spread over a process pool, and
+the settings that are Pareto-best for path error against time to target are reported.
+
+    front = pareto_front(sweep(parameter_grid()))
+"""
+
+import contextlib
+import io
+import itertools
+import math
+import multiprocessing
+
+from event_sim import Simulation
+
+# (x, y, heading) start and (x, y) waypoint of each mission, in field meters
+MISSIONS = [
+    ((10.0, 15.0, 0.0), (10.0, 60.0)),
+    ((10.0, 15.0, 0.0), (50.0, 55.0)),
+    ((60.0, 20.0, 90.0), (20.0, 70.0)),
+    ((45.0, 90.0, 180.0), (70.0, 30.0))
+]
+MISSION_SPEED = 3.0  # m/s asked of the car along the line to the waypoint
+MISSION_TIMEOUT = 120  # s, a mission that hasn't reached its waypoint by then is scored at this time
+WAYPOINT_RADIUS = 2.0  # m, the waypoint counts as reached inside this distance
+CHECK_INTERVAL = 1.0  # s of simulation between checks for arrival
+
+TURN_ANGLE_CHOICES = [(5, 10, 15), (5, 10, 20), (10, 15, 20), (5, 15, 25)]
+SPEED_COEFFICIENT_CHOICES = [(0.75, 0.50, 0.25), (1.0, 0.75, 0.50), (0.9, 0.6, 0.3)]
+SMALL_TOLERANCE_CHOICES = [2, 5, 10]
+LARGE_TOLERANCE_CHOICES = [30, 45, 60]
+
+
+def parameter_grid(turn_angles=TURN_ANGLE_CHOICES, speed_coefficients=SPEED_COEFFICIENT_CHOICES,
+                   small_tolerances=SMALL_TOLERANCE_CHOICES, large_tolerances=LARGE_TOLERANCE_CHOICES):
+    """
+    :return: <List> Turning keyword arguments for every combination of the choices
+    """
+    return [{"turn_angles": angles, "speed_coefficients": coefficients, "small_turn_tolerance": small,
+             "large_turn_tolerance": large}
+            for angles, coefficients, small, large in itertools.product(turn_angles, speed_coefficients,
+                                                                        small_tolerances, large_tolerances)
+            if small < large]
+
+
+def distance_from_line(point, start, end):
+    """
+    :return: <Float> distance in meters from point to the segment between start and end
+    """
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    length_squared = dx * dx + dy * dy
+    t = 0.0
+    if length_squared:
+        t = max(0.0, min(1.0, ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / length_squared))
+    return math.hypot(point[0] - start[0] - t * dx, point[1] - start[1] - t * dy)
+
+
+def fly_mission(turning_params, start, waypoint, seed=0):
+    """
+    Flies one car from start to the waypoint, its velocity vector always pointing straight at the waypoint
+
+    :param turning_params: <Dict> keyword arguments for Turning
+    :param start: <Tuple> x, y, heading the car starts at
+    :param waypoint: <Tuple> x, y to reach
+    :param seed: <Int> simulation seed
+    :return: <Tuple> mean distance from the straight line in meters, seconds to reach the waypoint
+    """
+    simulation = None
+
+    def toward_waypoint(now, slot):
+        car = simulation.cars[slot]
+        dx, dy = waypoint[0] - car.xpos, waypoint[1] - car.ypos
+        distance = math.hypot(dx, dy)
+        if distance < WAYPOINT_RADIUS:
+            return [0.0, 0.0]
+        return [MISSION_SPEED * dx / distance, MISSION_SPEED * dy / distance]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulation = Simulation(num_cars=1, seed=seed, velocity_script=toward_waypoint, starts=[start],
+                                turning_params=turning_params)
+    car = simulation.cars[0]
+    time_to_target = MISSION_TIMEOUT
+    while simulation.clock.now < MISSION_TIMEOUT:
+        simulation.run(CHECK_INTERVAL)
+        arrived = [fix[0] for fix in car.track if math.hypot(waypoint[0] - fix[1], waypoint[1] - fix[2]) <
+                   WAYPOINT_RADIUS]
+        if arrived:
+            time_to_target = arrived[0]
+            break
+
+    path = [fix[1:3] for fix in car.track if fix[0] <= time_to_target]
+    path_error = sum(distance_from_line(point, start[:2], waypoint) for point in path) / len(path) if path else 0.0
+    return path_error, time_to_target
+
+
+def score(turning_params, missions=MISSIONS):
+    """
+    :return: <Tuple> turning_params, mean path error and mean time to target over the missions
+    """
+    results = [fly_mission(turning_params, start, waypoint, seed) for seed, (start, waypoint) in enumerate(missions)]
+    return (turning_params, sum(result[0] for result in results) / len(results),
+            sum(result[1] for result in results) / len(results))
+
+
+def sweep(grid, processes=None):
+    """
+    :param grid: <List> Turning keyword arguments to score
+    :param processes: <Int> worker processes, one per CPU if None
+    :return: <List> (turning_params, path error, time to target) for each entry of the grid
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(score, grid)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def pareto_front(scores):
+    """
+    :param scores: <List> (turning_params, path error, time to target)
+    :return: <List> the scores no other score beats on both path error and time to target, fastest first
+    """
+    front = []
+    for entry in sorted(scores, key=lambda entry: (entry[2], entry[1])):
+        if not front or entry[1] < front[-1][1]:
+            front.append(entry)
+    return front
+
+
+if __name__ == "__main__":
+    grid = parameter_grid()
+    baseline, baseline_error, baseline_time = score({})
+    print("server_cfg settings: path error {:6.2f}m  time to target {:6.1f}s".format(baseline_error, baseline_time))
+    print("Scoring {} settings on {} missions".format(len(grid), len(MISSIONS)))
+    for turning_params, path_error, time_to_target in pareto_front(sweep(grid)):
+        print("path error {:6.2f}m  time to target {:6.1f}s  turn angles {} speed coefficients {} "
+              "tolerances {}/{}".format(path_error, time_to_target, turning_params["turn_angles"],
+                                        turning_params["speed_coefficients"], turning_params["small_turn_tolerance"],
+                                        turning_params["large_turn_tolerance"]))
@@ -1,9 +1,32 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
+import unittest.mock
 
+import Client.actuation as actuation
+import Client.async_client as async_client
+import Client.async_maestro as async_maestro
+import Client.autonomy as autonomy
+import Client.maestro as maestro
+import Client.navigation as navigation
+import Server.car_controller as car_controller
+import Server.dashboard as dashboard
 import Server.data_handling as server
+import Server.gps_ops as gps_ops
 import Server.stepped_turning as turn
+import Server.telemetry as telemetry
+import Server.traffic_log as traffic_log
+import Server.velocity_service as velocity_service
 import WebServer.joystick_input as joystick
+import WebServer.velocity_channel as channel
+import TestSoftware.event_sim as event_sim
+import TestSoftware.fake_devices as fake_devices
 import TestSoftware.mock_sim_inputs as mock
+import TestSoftware.turning_sweep as sweep
 from Client import client_cfg as cfg
 
 
@@ -18,6 +41,13 @@ class TestJoystickOutput(unittest.TestCase):
         self.assertAlmostEqual(joystick.gen_velocity_vector(0, -1)[1][1], -cfg.MAXVELOCITY)
         self.assertAlmostEqual(joystick.gen_velocity_vector(0, 1)[1][1], cfg.MAXVELOCITY)
 
+    def test_keyboard_profiles_dont_overlap(self):
+        joystick.check_keyboard_profiles(joystick.cfg.KEYBOARD_PROFILES)
+        shared_preset = [(0, 'K_LEFT', 'K_RIGHT', 'K_UP', 'K_DOWN', 'K_w', 'K_s', 'K_1', 'K_2', 'K_3', 'K_4'),
+                         (1, 'K_j', 'K_l', 'K_i', 'K_k', 'K_u', 'K_o', 'K_1', 'K_8', 'K_9', 'K_0')]
+        with self.assertRaises(ValueError):
+            joystick.check_keyboard_profiles(shared_preset)
+
 
 class TestServerFunctions(unittest.TestCase):
     def setUp(self):
@@ -70,6 +100,45 @@ class TestSteppedTurning(unittest.TestCase):
         self.assertEqual(turn.choose_wheel_turn_angle(90, 0, (5, 10, 15), (0.75, 0.50, 0.25)), (15, 0.25))
 
 
+class TestManualControl(unittest.TestCase):
+    def test_heading_comes_from_the_gps_track(self):
+        turning = turn.Turning(False)
+        cardata = server.CarData(False, 1)
+        self.assertAlmostEqual(turning.calculate_desired_heading(cardata, [1.0, 0.0]), 90.0)
+        self.assertEqual(turning.calculate_desired_heading(cardata, [0.0, 0.0]), cardata.HEADING)
+
+        # Too short a hop to tell GPS noise from driving
+        cardata.update_position(10.1, 15.0)
+        self.assertEqual(cardata.HEADING, 0.0)
+        cardata.update_position(10.0, 13.0)
+        self.assertAlmostEqual(cardata.HEADING, 180.0)
+
+        turn_data = turning.stepped_turning_algorithm(turning.initialize_turn_data(cardata, 90.0))
+        turning.apply_turn_to_cardata(cardata, turn_data)
+        self.assertNotEqual(cardata.TURNANGLE, 0)
+        self.assertAlmostEqual(cardata.HEADING, 180.0)
+
+
+class TestNavigation(unittest.TestCase):
+    def test_matches_server(self):
+        gps = gps_ops.GPSCalculations(False, True)
+        turning = turn.Turning(False)
+        for xpos, ypos in [(0, 0), (45, 60), (90, 120), (12.5, 101.25)]:
+            lat, lon = gps.xy_to_gps(xpos, ypos)
+            client_xy = navigation.gps_to_field(lat, lon)
+            server_xy = gps.scale_xy(gps.gps_to_xy(lat, lon))
+            self.assertAlmostEqual(client_xy[0], server_xy[0], places=6)
+            self.assertAlmostEqual(client_xy[1], server_xy[1], places=6)
+
+        for current_heading, desired_heading in [(0, 3), (0, 30), (0, 120), (350, 10), (90, 60), (10, 300)]:
+            self.assertEqual(navigation.choose_turn(current_heading, desired_heading),
+                             turning.choose_wheel_turn_angle_and_direction(current_heading, desired_heading))
+        for angle in [-180, -15, 0, 7.5, 180]:
+            self.assertEqual(navigation.turn_signal(angle), turning.gen_turn_signal(angle))
+        for speed in [0, 1.5, 13.4, 30]:
+            self.assertEqual(navigation.speed_signal(speed), turning.gen_spd_signal(speed))
+
+
 class TestMockSimInputs(unittest.TestCase):
     # def test_calc_xy(self): # TODO: This calculation is now invalid due to the continuous updates instead of fixed
     #     self.assertEqual(mock.calc_xy(1, 1, 0, 0, 0), [])
@@ -78,6 +147,534 @@ class TestMockSimInputs(unittest.TestCase):
         self.assertLessEqual(mock.gen_random_vector(), [cfg.MAXVELOCITY, cfg.MAXVELOCITY])
         self.assertGreaterEqual(mock.gen_random_vector(), [-cfg.MAXVELOCITY, -cfg.MAXVELOCITY])
 
+    def test_simulate_cars_stays_on_field(self):
+        trajectories = mock.simulate_cars(500, 200, seed=1)
+        self.assertEqual(trajectories.positions.shape, (201, 500, 2))
+        self.assertGreaterEqual(trajectories.positions.min(), 0)
+        self.assertLessEqual(trajectories.positions[:, :, 0].max(), cfg.LENGTH_X)
+        self.assertLessEqual(trajectories.positions[:, :, 1].max(), cfg.LENGTH_Y)
+        self.assertLessEqual(abs(trajectories.turn_angles).max(), 180)
+
+    def test_simulate_cars_reaches_target(self):
+        trajectories = mock.simulate_cars(100, 100, targets=[45, 60], seed=1)
+        distance = ((trajectories.positions[-1] - [45, 60]) ** 2).sum(axis=1) ** 0.5
+        self.assertLess(distance.max(), 1e-6)
+
+
+class TestFakeMaestro(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_devices.FakeMaestro(multi_target=True)
+        self.fake.start()
+        self.addCleanup(self.fake.close)
+
+    def open_device(self):
+        device = maestro.Device(self.fake.con_port, self.fake.ser_port, multi_target=True)
+        self.addCleanup(device.con.close)
+        self.addCleanup(device.ser.close)
+        self.assertTrue(device.isInitialized)
+        return device
+
+    def test_device(self):
+        device = self.open_device()
+        device.set_target(cfg.STEERING, 1600)
+        device.set_channel_targets({3: 1450, 4: 1550})
+        self.assertEqual(device.get_position(cfg.STEERING), 1600)
+        self.assertEqual(device.get_positions([3, 4]), [1450, 1550])
+        self.assertEqual(self.fake.targets[3:6], [1450 * 4, 1550 * 4, 1600 * 4])
+        self.assertEqual(self.fake.errors, 0)
+
+    def test_device_errors(self):
+        device = self.open_device()
+        device.set_target(9, 1500)
+        self.assertEqual(device.get_errors(), fake_devices.SERIAL_PROTOCOL_ERROR)
+        self.assertEqual(device.get_errors(), 0)
+
+    def test_device_reopens_the_port_after_a_write_error(self):
+        device = self.open_device()
+        device.set_target(cfg.STEERING, 1600)
+        with unittest.mock.patch.object(device.ser, 'write', side_effect=maestro.serial.SerialException('unplugged')):
+            device.set_target(cfg.STEERING, 1500)
+
+        self.assertTrue(device.ser.is_open)
+        # Nothing is known to have reached the Maestro, so the same target goes out again
+        device.set_target(cfg.STEERING, 1500)
+        device.get_errors()
+        self.assertEqual(self.fake.targets[cfg.STEERING], 1500 * 4)
+
+    def open_async_device(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        device = async_maestro.AsyncDevice(self.fake.con_port, self.fake.ser_port, multi_target=True, loop=loop)
+        self.addCleanup(device.con.close)
+        self.addCleanup(device.ser.close)
+        self.addCleanup(device.close)
+        self.assertTrue(device.isInitialized)
+        return loop, device
+
+    def test_async_device(self):
+        loop, device = self.open_async_device()
+        device.set_channel_targets({3: 1450, 4: 1550, 5: 1600})
+        positions = loop.run_until_complete(asyncio.wait_for(device.get_positions([3, 4, 5]), 1))
+        self.assertEqual(positions, [1450, 1550, 1600])
+        self.assertEqual(self.fake.position(5), 1600)
+        self.assertEqual(self.fake.errors, 0)
+
+    def test_async_late_response_is_discarded(self):
+        loop, device = self.open_async_device()
+        device.set_target(cfg.STEERING, 1600)
+        # The Maestro doesn't answer for a channel it doesn't have
+        with self.assertRaises(asyncio.TimeoutError):
+            loop.run_until_complete(device.query(2, bytes, 0x90, 9, timeout=0.05))
+
+        # The answer turns up after all, it mustn't be taken for the next query's
+        os.write(self.fake.ser_master, b'\x00\x00')
+        position = loop.run_until_complete(asyncio.wait_for(device.get_position(cfg.STEERING), 2))
+        self.assertEqual(position, 1600)
+
+    def test_async_read_error_closes_the_device(self):
+        loop, device = self.open_async_device()
+        loop.run_until_complete(asyncio.wait_for(device.get_position(cfg.STEERING), 1))
+        fd = device.ser.fileno()
+        unplugged = unittest.mock.Mock(read=unittest.mock.Mock(side_effect=OSError(5, 'Input/output error')))
+        position = device.get_position(cfg.STEERING)
+        with unittest.mock.patch.object(async_maestro, 'os', unplugged):
+            device.on_readable()
+
+        self.assertIsInstance(position.exception(), OSError)
+        self.assertFalse(device.isInitialized)
+        self.assertFalse(loop.remove_reader(fd))
+
+
+class TestVelocityChannel(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'velocity_vectors')
+
+    def test_publish_read(self):
+        writer = channel.VelocityChannel(self.path)
+        reader = channel.VelocityChannel(self.path)
+        version, vectors, timestamp, driven = reader.read()
+        self.assertEqual(version, 0)
+        self.assertEqual(vectors, [[0.0, 0.0]] * channel.SLOTS)
+        self.assertEqual(driven, set())
+
+        writer.publish({1: [1.5, -2.5]}, 10.0)
+        version, vectors, timestamp, driven = reader.read()
+        self.assertEqual(version, 2)
+        self.assertEqual(vectors[0], [0.0, 0.0])
+        self.assertEqual(vectors[1], [1.5, -2.5])
+        self.assertEqual(timestamp, 10.0)
+        self.assertEqual(driven, {1})
+
+    def test_half_written_record_is_not_returned(self):
+        writer = channel.VelocityChannel(self.path)
+        reader = channel.VelocityChannel(self.path)
+        writer.publish({0: [1.0, 1.0]}, 1.0)
+        reader.read()
+
+        # Writer died between marking the record busy and finishing it
+        channel.VERSION.pack_into(writer.map, 0, writer.version + 1)
+        self.assertEqual(reader.read()[1][0], [1.0, 1.0])
+
+    def test_joystick_only_overrides_the_slots_it_drives(self):
+        writer = channel.VelocityChannel(self.path)
+        store = velocity_service.VelocityStore()
+        message_passing = server.ServerMessagePassing(False, store, channel.VelocityChannel(self.path))
+        store.set_velocity(0, 1.0, 2.0)
+        store.set_velocity(1, 3.0, 4.0)
+        writer.publish({1: [-1.0, 0.5]})
+
+        self.assertEqual(message_passing.get_velocity_data(0), [1.0, 2.0])
+        self.assertEqual(message_passing.get_velocity_data(1), [-1.0, 0.5])
+        self.assertEqual(message_passing.get_velocity_data(2), [0.0, 0.0])
+
+        # A joystick that stopped publishing lets go of its slots
+        writer.publish({1: [-1.0, 0.5]}, time.time() - 2 * server.cfg.VELOCITY_CHANNEL_TIMEOUT)
+        self.assertEqual(message_passing.get_velocity_data(1), [3.0, 4.0])
+
+
+class TestVelocityStream(unittest.TestCase):
+    def test_lost_stream_stops_its_slots(self):
+        loop = asyncio.new_event_loop()
+        store = velocity_service.VelocityStore()
+        line = b'{"xvel": 1.0, "yvel": 2.0, "id": 3}\n'
+
+        async def source(reader, writer):
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n')
+            writer.write('{:x}\r\n'.format(len(line)).encode('latin-1') + line + b'\r\n')
+            await writer.drain()
+            writer.close()  # the source goes away mid stream
+
+        async def follow():
+            server = await asyncio.start_server(source, '127.0.0.1', 0)
+            subscriber = velocity_service.VelocitySubscriber(store, server.sockets[0].getsockname()[:2], False)
+            subscription = store.subscribe()
+            following = asyncio.ensure_future(subscriber.run())
+            streamed = await subscription.changes(5)
+            stopped = await subscription.changes(5)
+            following.cancel()
+            server.close()
+            return streamed, stopped
+
+        asyncio.set_event_loop(loop)
+        try:
+            streamed, stopped = loop.run_until_complete(follow())
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+        self.assertEqual(streamed, {3: [1.0, 2.0]})
+        self.assertEqual(stopped, {3: [0.0, 0.0]})
+
+    def test_bad_content_length_is_a_bad_request(self):
+        loop = asyncio.new_event_loop()
+        service = velocity_service.VelocityService(velocity_service.VelocityStore(), False)
+
+        async def post(content_length):
+            await service.start('127.0.0.1', 0)
+            reader, writer = await asyncio.open_connection(*service.server.sockets[0].getsockname()[:2])
+            writer.write('POST {} HTTP/1.1\r\nContent-Length: {}\r\n\r\n'.format(
+                velocity_service.cfg.SERVER_GET_ADDRESS, content_length).encode('latin-1'))
+            status_line = await reader.readline()
+            writer.close()
+            await service.close()
+            return status_line
+
+        asyncio.set_event_loop(loop)
+        try:
+            for content_length in ['ten', '-1']:
+                self.assertTrue(loop.run_until_complete(post(content_length)).startswith(b'HTTP/1.1 400'))
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+
+
+class TestTelemetry(unittest.TestCase):
+    def test_ring_buffer_wraps(self):
+        buffer = telemetry.TelemetryBuffer(capacity=4)
+        self.assertEqual(len(buffer.window()), 0)
+        self.assertIsNone(buffer.latest())
+        for tick in range(10):
+            buffer.append(tick, tick, 2 * tick, 90.0, 1.5, 5.0)
+
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(list(buffer.window()['time']), [6, 7, 8, 9])
+        self.assertEqual(list(buffer.window(last=2)['ypos']), [16, 18])
+        self.assertEqual(list(buffer.since(7.5)['time']), [8, 9])
+        self.assertEqual(buffer.latest()['xpos'], 9)
+
+    def test_file_backed_buffer_survives_reopen(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'slot_0.telemetry')
+        buffer = telemetry.TelemetryBuffer(capacity=8, path=path)
+        for tick in range(5):
+            buffer.append(tick, tick, tick, 0.0, 0.0, 0.0)
+        del buffer  # no close, as if the server had crashed
+
+        reopened = telemetry.TelemetryBuffer(capacity=8, path=path)
+        self.assertEqual(reopened.count, 5)
+        reopened.append(5, 5, 5, 0.0, 0.0, 0.0)
+        self.assertEqual(list(reopened.window()['time']), [0, 1, 2, 3, 4, 5])
+        reopened.close()
+        self.assertRaises(ValueError, telemetry.TelemetryBuffer, 16, path)
+
+    def test_each_drone_keeps_its_own_history(self):
+        telemetry_dir = server.cfg.TELEMETRY_DIR
+        server.cfg.TELEMETRY_DIR = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, server.cfg.TELEMETRY_DIR)
+        try:
+            store = velocity_service.VelocityStore()
+            first = server.Drone(False, False, 40001, traffic_log.ReplayTransport(40001), True, 0, store)
+            first.drone()
+            second = server.Drone(False, False, 40002, traffic_log.ReplayTransport(40002), True, 0, store)
+            second.telemetry = second.open_telemetry()
+        finally:
+            server.cfg.TELEMETRY_DIR = telemetry_dir
+
+        self.assertNotEqual(first.telemetry.path, second.telemetry.path)
+        self.assertEqual(len(first.telemetry), 1)
+        self.assertEqual(len(second.telemetry), 0)
+        self.assertAlmostEqual(first.telemetry.latest()['time'], time.time(), delta=60)
+
+
+class TestDashboard(unittest.TestCase):
+    def test_delta(self):
+        previous = {"1": {"xpos": 1.0, "ypos": 2.0}, "2": {"xpos": 5.0, "ypos": 5.0}, "3": {"xpos": 0.0, "ypos": 0.0}}
+        current = {"1": {"xpos": 1.5, "ypos": 2.0}, "3": {"xpos": 0.0, "ypos": 0.0}, "4": {"xpos": 9.0, "ypos": 8.0}}
+        self.assertEqual(dashboard.delta(previous, current),
+                         {"1": {"xpos": 1.5}, "2": None, "4": {"xpos": 9.0, "ypos": 8.0}})
+        self.assertEqual(dashboard.delta(current, current), {})
+
+    def test_expired_session_leaves_the_fleet(self):
+        loop = asyncio.new_event_loop()
+        fleet = dashboard.Fleet()
+        sessions = car_controller.SessionRegistry(loop, 0.01, on_expire=fleet.remove)
+        drone, old_owner, new_owner = unittest.mock.Mock(drone_id=7), object(), object()
+        fleet.attach(drone)
+        token = sessions.open(drone, old_owner)
+
+        # The car resumed elsewhere before its old connection was noticed dropping
+        sessions.resume(token, new_owner)
+        self.assertFalse(sessions.detach(token, old_owner))
+        self.assertTrue(sessions.detach(token, new_owner))
+        loop.call_later(0.05, loop.stop)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+        self.assertNotIn("7", fleet.drones)
+
+
+class TestActuationLoop(unittest.TestCase):
+    def test_step_is_slew_limited(self):
+        loop = actuation.ActuationLoop(lambda targets: None, False, rate=50)
+        loop.set_targets({cfg.STEERING: cfg.MAX_LEFT, cfg.ESC: cfg.MAX_SPEED})
+        steps = [{cfg.STEERING: cfg.CENTER, cfg.ESC: cfg.NEUTRAL}] + [loop.step() for _ in range(100)]
+
+        self.assertEqual(steps[1][cfg.STEERING], cfg.CENTER + cfg.STEERING_SLEW_RATE / 50)
+        for previous, current in zip(steps, steps[1:]):
+            self.assertLessEqual(abs(current[cfg.STEERING] - previous[cfg.STEERING]), cfg.STEERING_SLEW_RATE / 50 + 1)
+            self.assertLessEqual(abs(current[cfg.ESC] - previous[cfg.ESC]), cfg.THROTTLE_SLEW_RATE / 50 + 1)
+        self.assertEqual(steps[-1], {cfg.STEERING: cfg.MAX_LEFT, cfg.ESC: cfg.MAX_SPEED})
+
+    def test_immediate_targets_skip_the_ramp(self):
+        written = []
+        loop = actuation.ActuationLoop(written.append, False)
+        loop.set_targets({cfg.STEERING: cfg.MAX_LEFT, cfg.ESC: cfg.MAX_SPEED}, immediate=True)
+        self.assertEqual(written, [{cfg.STEERING: cfg.MAX_LEFT, cfg.ESC: cfg.MAX_SPEED}])
+
+    def test_tick_rate(self):
+        ticks = []
+        loop = actuation.ActuationLoop(lambda targets: ticks.append(time.perf_counter()), False, rate=100)
+        loop.start()
+        time.sleep(0.5)
+        loop.stop()
+        loop.join()
+
+        self.assertAlmostEqual(len(ticks), 50, delta=10)
+        self.assertLess(loop.jitter()[0], loop.period)
+
+
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+
+    def test_malformed_messages_are_dropped(self):
+        client = async_client.AsyncClient(False, False, False)
+        client.running = True
+        for message in ['seq:7', '51600', 'junk', 'seq', 'seq:', 'kill']:
+            client.commands.put_nowait(message)
+        self.loop.run_until_complete(asyncio.wait_for(client.execute_commands(), 1))
+
+        self.assertFalse(client.running)
+        ack = client.outgoing.get_nowait().split(':')
+        self.assertEqual((ack[0], ack[1], ack[3]), ('ack', '7', '1600'))
+
+    def test_ack_reports_the_ramped_targets(self):
+        client = async_client.AsyncClient(False, True, False)
+        client.running = True
+        for message in ['seq:7', str(cfg.STEERING) + str(cfg.MAX_LEFT)]:
+            self.loop.run_until_complete(client.execute_data(message))
+        client.apply_pending_targets()
+        self.assertTrue(client.outgoing.empty())
+
+        # Acked once the actuation loop's first step towards the command is on the Maestro
+        client.actuate(client.actuation.step())
+        ack = client.outgoing.get_nowait().split(':')
+        self.assertEqual(ack[1], '7')
+        self.assertEqual(int(ack[3]), cfg.CENTER + cfg.STEERING_SLEW_RATE / cfg.ACTUATION_RATE)
+
+    def test_overrun_is_a_framing_error(self):
+        client = async_client.AsyncClient(False, False, False)
+        client.running = True
+        client.reader = asyncio.StreamReader(limit=16)
+        client.reader.feed_data(b'x' * 64)
+        client.writer = unittest.mock.Mock(drain=lambda: asyncio.sleep(0))
+        self.loop.run_until_complete(asyncio.wait_for(client.serve_connection([]), 1))
+        client.writer.close.assert_called_once_with()
+
+    def test_interrupt_stops_the_car_on_the_loop(self):
+        client = async_client.AsyncClient(False, True, False)
+        client.write_targets = unittest.mock.Mock()
+        client.drive({cfg.STEERING: cfg.MAX_LEFT, cfg.ESC: cfg.MAX_SPEED})
+
+        async def never_connects():
+            await asyncio.sleep(3600)
+
+        def interrupt():
+            raise KeyboardInterrupt
+
+        client.connect_to_server = never_connects
+        self.loop.call_later(0.1, interrupt)
+        self.assertEqual(client.main(), 0)
+        self.assertFalse(client.actuation.is_alive())
+        client.write_targets.assert_called_with({cfg.ESC: cfg.NEUTRAL, cfg.STEERING: cfg.CENTER})
+
+
+class TestServerProtocol(unittest.TestCase):
+    def test_message_split_across_reads(self):
+        protocol = car_controller.ServerClientProtocol(False, False, True,
+                                                       velocity_store=velocity_service.VelocityStore())
+        protocol.connection_made(traffic_log.ReplayTransport(40001))
+        acks = protocol.drone_instance.connection.acks
+        seq = acks.next_sequence()
+
+        protocol.data_received('ack:{}:1700000000.1'.format(seq).encode('utf-8'))
+        self.assertEqual(acks.acked, 0)
+        protocol.data_received(b'25:1500:6000\\ack:bad\\ack:')
+        self.assertEqual(acks.acked, 1)
+        self.assertEqual(acks.last_applied, (1700000000.125, 1500, 6000))
+        self.assertEqual(protocol.rx_buffer, 'ack:')
+
+
+class TestTrafficLog(unittest.TestCase):
+    def test_record_and_replay(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'traffic.log')
+        telemetry_dir = server.cfg.TELEMETRY_DIR
+        server.cfg.TELEMETRY_DIR = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, server.cfg.TELEMETRY_DIR)
+        try:
+            recorder = traffic_log.TrafficRecorder(path)
+            store = velocity_service.VelocityStore()
+            store.set_velocity(0, 3.0, 0.0)
+            protocol = car_controller.ServerClientProtocol(False, False, True, velocity_store=store, recorder=recorder)
+            protocol.connection_made(traffic_log.ReplayTransport(40001))
+            fix = b'gps:$GPGGA,172814.0,3723.46587704,N,12202.26957864,W,2,6,1.2,18.893,M,-25.669,M,2.0,0031*4F\\'
+            protocol.data_received(fix + b'request:velocity\\')
+            store.set_velocity(0, 0.0, -2.0)
+            protocol.data_received(b'request:velocity\\')
+            protocol.connection_lost(None)
+            recorder.close()
+            # A crash part way through writing a record
+            with open(path, 'ab') as log:
+                log.write(traffic_log.RECORD.pack(time.time(), 40001, traffic_log.INBOUND, 10) + b'gps:')
+
+            records = list(traffic_log.read_log(path))
+            self.assertEqual(records[-1][2], traffic_log.DISCONNECT)
+            vectors = [traffic_log.VECTOR.unpack(payload) for _, _, kind, payload in records
+                       if kind == traffic_log.VELOCITY]
+            self.assertEqual(vectors, [(3.0, 0.0), (0.0, -2.0)])
+
+            result = traffic_log.replay(path, speed=None)[40001]
+        finally:
+            server.cfg.TELEMETRY_DIR = telemetry_dir
+        self.assertEqual(result["inbound"], 2)
+        self.assertTrue(result["recorded"])
+        self.assertTrue(result["matches"])
+
+    def test_replay_resumes_sessions(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'traffic.log')
+        telemetry_dir = server.cfg.TELEMETRY_DIR
+        server.cfg.TELEMETRY_DIR = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, server.cfg.TELEMETRY_DIR)
+        event_loop = asyncio.new_event_loop()
+        try:
+            recorder = traffic_log.TrafficRecorder(path)
+            store = velocity_service.VelocityStore()
+            store.set_velocity(0, 3.0, 0.0)
+            sessions = car_controller.SessionRegistry(event_loop, server.cfg.SESSION_GRACE_PERIOD)
+            first = car_controller.ServerClientProtocol(False, False, True, sessions, velocity_store=store,
+                                                        recorder=recorder)
+            first.connection_made(traffic_log.ReplayTransport(40001))
+            fix = b'gps:$GPGGA,172814.0,3723.46587704,N,12202.26957864,W,2,6,1.2,18.893,M,-25.669,M,2.0,0031*4F\\'
+            first.data_received(fix + b'request:velocity\\')
+            first.connection_lost(None)
+
+            # The car reconnects and carries on with the drone, and its GPS fix, it had before
+            second = car_controller.ServerClientProtocol(False, False, True, sessions, velocity_store=store,
+                                                         recorder=recorder)
+            second.connection_made(traffic_log.ReplayTransport(40002))
+            second.data_received(b'resume:' + first.session_token.encode('ascii') + b'\\request:velocity\\')
+            self.assertIs(second.drone_instance, first.drone_instance)
+            recorder.close()
+
+            results = traffic_log.replay(path, speed=None)
+        finally:
+            event_loop.close()
+            server.cfg.TELEMETRY_DIR = telemetry_dir
+        self.assertTrue(results[40002]["recorded"])
+        self.assertTrue(results[40002]["matches"])
+
+
+class TestAutonomy(unittest.TestCase):
+    def test_route_round_trip(self):
+        fleet = dashboard.Fleet()
+        store = velocity_service.VelocityStore()
+        protocol = car_controller.ServerClientProtocol(False, False, True, velocity_store=store, fleet=fleet)
+        protocol.connection_made(traffic_log.ReplayTransport(40001))
+        service = velocity_service.VelocityService(store, False, fleet)
+        route = json.dumps({"id": 40001, "speed": 1.5, "waypoints": [[20, 30], [40, 50]]}).encode('utf-8')
+        self.assertEqual(service.route('POST', velocity_service.cfg.AUTONOMY_ADDRESS, route)[0], 200)
+        self.assertEqual(service.route('POST', velocity_service.cfg.AUTONOMY_ADDRESS, b'{"id": 1, "manual": true}')[0],
+                         404)
+
+        sent = []
+        pilot = autonomy.Autopilot(sent.append, lambda targets: None, False, True)
+        for message in b''.join(protocol.transport.written).decode('utf-8').split('\\'):
+            if message.startswith('waypoints:'):
+                pilot.load_waypoints(message)
+        self.assertEqual(list(pilot.waypoints), [[20.0, 30.0], [40.0, 50.0]])
+        self.assertEqual(pilot.speed, 1.5)
+
+        # The car reaches the first waypoint and reports back
+        pilot.cardata.XPOS, pilot.cardata.YPOS = 20.0, 30.0
+        pilot.choose_heading()
+        protocol.data_received(''.join(message + '\\' for message in sent).encode('utf-8'))
+        self.assertTrue(protocol.drone_instance.autonomous)
+        self.assertEqual(protocol.drone_instance.waypoints_left, 1)
+
+
+class TestEventSimulation(unittest.TestCase):
+    def test_virtual_clock_order(self):
+        clock = event_sim.VirtualClock()
+        order = []
+        clock.schedule(2.0, order.append, 'late')
+        clock.schedule(1.0, order.append, 'first')
+        clock.schedule(1.0, order.append, 'second')
+        clock.run(1.5)
+        self.assertEqual(order, ['first', 'second'])
+        self.assertEqual(clock.now, 1.5)
+        self.assertEqual(clock.time(), clock.time())
+
+    def test_simulation_is_deterministic(self):
+        first = event_sim.Simulation(num_cars=2, seed=3).run(120)
+        second = event_sim.Simulation(num_cars=2, seed=3).run(120)
+        self.assertEqual(first['events'], second['events'])
+        for car, repeat in zip(first['cars'], second['cars']):
+            self.assertEqual(car['position'], repeat['position'])
+            self.assertEqual(car['acked'], car['commands'])
+            self.assertEqual(car['dropped'], 0)
+
+    def test_cars_follow_their_velocity_on_the_field(self):
+        results = event_sim.Simulation(num_cars=2, seed=1).run(300)
+        round_trip = event_sim.COMPUTE_TIME + 2 * (event_sim.LINK_LATENCY + event_sim.LINK_JITTER)
+        margin = 15.0  # m, a car turning back at the edge swings out by about its turning circle
+        for car in results['cars']:
+            self.assertLessEqual(car['max_latency'], round_trip)
+            for _, xpos, ypos, _ in car['track']:
+                self.assertTrue(-margin <= xpos <= cfg.LENGTH_X + margin and -margin <= ypos <= cfg.LENGTH_Y + margin)
+
+
+class TestTurningSweep(unittest.TestCase):
+    def test_default_parameters_reach_the_waypoint(self):
+        for start, waypoint in sweep.MISSIONS:
+            path_error, time_to_target = sweep.fly_mission({}, start, waypoint)
+            self.assertLess(time_to_target, sweep.MISSION_TIMEOUT)
+            self.assertLess(path_error, sweep.WAYPOINT_RADIUS)
+
+    def test_pareto_front(self):
+        scores = [('slow', 1.0, 30.0), ('fast', 3.0, 10.0), ('worse', 3.5, 20.0), ('best', 0.5, 25.0)]
+        self.assertEqual([entry[0] for entry in sweep.pareto_front(scores)], ['fast', 'best'])
+
 
 if __name__ == '__main__':
     unittest.main()
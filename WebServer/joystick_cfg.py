@@ -1,2 +1,16 @@
 MAXVELOCITY = 13.4  # m/s
+SAMPLE_RATE = 120  # Hz, input sampling and velocity publishing
+DISPLAY_RATE = 20  # Hz, redraws of the input readout
 
+VELOCITY_CHANNEL_PATH = '/dev/shm/velocity_vectors'  # tmpfs, shared with the server
+VELOCITY_SERVICE_ADDRESS = None  # ('host', port) of a remote server's velocity service to also post vectors to
+VELOCITY_SERVICE_PATH = '/get_velocity_vector.cgi'  # server_cfg.SERVER_GET_ADDRESS
+
+# Which drone each input device drives. A drone's slot is the index of the server port it connected on.
+JOYSTICK_SLOTS = [0, 1, 2]  # by joystick number
+# No key may appear in more than one profile, joystick_input refuses to start otherwise
+KEYBOARD_PROFILES = [
+    # slot, left, right, up, down, faster, slower, then speed presets 0.25, 0.5, 0.75, 1
+    (0, 'K_LEFT', 'K_RIGHT', 'K_UP', 'K_DOWN', 'K_w', 'K_s', 'K_1', 'K_2', 'K_3', 'K_4'),
+    (1, 'K_j', 'K_l', 'K_i', 'K_k', 'K_u', 'K_o', 'K_7', 'K_8', 'K_9', 'K_0'),
+]
@@ -1,9 +1,13 @@
+import http.client
+import json
 import math
+import threading
 import pygame
 import joystick_cfg as cfg
+from velocity_channel import VelocityChannel
 
 # Globals
-velocity_vector = [0, 0]
+velocity_vectors = {}  # drone slot: [xvel, yvel]
 
 # Define some colors
 BLACK = (0, 0, 0)
@@ -13,19 +17,45 @@ WHITE = (255, 255, 255)
 # This is a simple class that will help us print to the screen
 # It has nothing to do with the joysticks, just outputting the
 # information.
+# Each character is rendered once and kept, lines are composed from the cached glyphs and only lines whose text changed
+# since the last frame are redrawn. Every redrawn area is recorded in dirty so just those parts of the window need
+# updating.
 class TextPrint:
     def __init__(self):
         self.reset()
         self.font = pygame.font.Font(None, 20)
-        self.x = 10
-        self.y = 10
-        self.line_height = 15
+        self.glyphs = {}
+        self.lines = {}  # y: (x, text) currently drawn
+        self.dirty = []
 
     def print(self, window, text_string):
-        text_bitmap = self.font.render(text_string, True, BLACK)
-        window.blit(text_bitmap, [self.x, self.y])
+        if self.lines.get(self.y) != (self.x, text_string):
+            rect = self.clear_line(window, self.y)
+            x = self.x
+            for char in text_string:
+                glyph = self.glyph(char)
+                window.blit(glyph, [x, self.y])
+                x += glyph.get_width()
+            self.lines[self.y] = (self.x, text_string)
+            self.dirty.append(rect)
         self.y += self.line_height
 
+    def glyph(self, char):
+        if char not in self.glyphs:
+            self.glyphs[char] = self.font.render(char, True, BLACK, WHITE)
+        return self.glyphs[char]
+
+    def clear_line(self, window, y):
+        rect = pygame.Rect(0, y, window.get_width(), self.line_height)
+        window.fill(WHITE, rect)
+        return rect
+
+    def finish(self, window):
+        # Wipe lines left over from a longer frame, e.g. after a joystick was unplugged
+        for y in [y for y in self.lines if y >= self.y]:
+            self.dirty.append(self.clear_line(window, y))
+            del self.lines[y]
+
     def reset(self):
         self.x = 10
         self.y = 10
@@ -38,15 +68,212 @@ class TextPrint:
         self.x -= 10
 
 
+class Display(threading.Thread):
+    """
+    Draws the input readout on its own thread at DISPLAY_RATE, so rendering never holds up input sampling. Text is
+    drawn into an off screen canvas, the sampling thread only copies the changed areas onto the window.
+    """
+
+    def __init__(self, screen):
+        threading.Thread.__init__(self, daemon=True)
+        self.screen = screen
+        self.canvas = pygame.Surface(screen.get_size())
+        self.canvas.fill(WHITE)
+        self.text_print = TextPrint()
+        self.lock = threading.Lock()
+        self.canvas_lock = threading.Lock()
+        self.lines = []
+        self.drawn_lines = None
+        self.dirty = [self.canvas.get_rect()]
+        self.running = False
+
+    def show(self, lines):
+        """
+        :param lines: <List> (indent level, text) to display, replaces the previous lines
+        """
+        with self.lock:
+            self.lines = lines
+
+    def run(self):
+        self.running = True
+        clock = pygame.time.Clock()
+        while self.running:
+            with self.lock:
+                lines = self.lines
+            if lines != self.drawn_lines:
+                self.draw(lines)
+            clock.tick(cfg.DISPLAY_RATE)
+
+    def draw(self, lines):
+        text_print = self.text_print
+        with self.canvas_lock:
+            text_print.reset()
+            for indent, text in lines:
+                text_print.x = 10 + 10 * indent
+                text_print.print(self.canvas, text)
+            text_print.finish(self.canvas)
+            with self.lock:
+                self.dirty.extend(text_print.dirty)
+            text_print.dirty = []
+        self.drawn_lines = lines
+
+    def present(self):
+        """
+        Copies whatever was redrawn since the last call onto the window. Called from the thread that owns the window,
+        never waits for a frame that is still being drawn.
+        """
+        if not self.canvas_lock.acquire(False):
+            return
+        try:
+            with self.lock:
+                dirty, self.dirty = self.dirty, []
+            for rect in dirty:
+                self.screen.blit(self.canvas, rect, rect)
+        finally:
+            self.canvas_lock.release()
+        if dirty:
+            pygame.display.update(dirty)
+
+
+class VelocityPoster(threading.Thread):
+    """
+    Posts the velocity table to a server's velocity service over one keep-alive connection, on its own thread so a slow
+    network never holds up sampling. Only the newest table is sent, tables that were replaced before going out are
+    skipped.
+    """
+
+    def __init__(self, address):
+        threading.Thread.__init__(self, daemon=True)
+        self.address = address
+        self.connection = None
+        self.vectors = None
+        self.new_vectors = threading.Event()
+        self.lock = threading.Lock()
+        self.running = False
+
+    def post(self, velocity_vectors):
+        with self.lock:
+            self.vectors = velocity_vectors
+        self.new_vectors.set()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.new_vectors.wait()
+            self.new_vectors.clear()
+            with self.lock:
+                vectors = self.vectors
+            body = json.dumps([{"id": slot, "xvel": vector[0], "yvel": vector[1]} for slot, vector in vectors.items()])
+            try:
+                if self.connection is None:
+                    self.connection = http.client.HTTPConnection(*self.address, timeout=1)
+                self.connection.request('POST', cfg.VELOCITY_SERVICE_PATH, body, {"Content-Type": "application/json"})
+                self.connection.getresponse().read()
+            except (OSError, http.client.HTTPException) as e:
+                print("Velocity service: ", e)
+                self.connection.close()
+                self.connection = None
+
+
+def open_joysticks():
+    joysticks = []
+    for i in range(pygame.joystick.get_count()):
+        joystick = pygame.joystick.Joystick(i)
+        joystick.init()
+        joysticks.append(joystick)
+    return joysticks
+
+
+def joystick_slot(index):
+    """
+    :param index: <Int> joystick number as pygame counts them
+    :return: <Int> drone slot the joystick drives, None if it isn't mapped to one
+    """
+    if index < len(cfg.JOYSTICK_SLOTS):
+        return cfg.JOYSTICK_SLOTS[index]
+    return None
+
+
+def check_keyboard_profiles(profiles):
+    """
+    :param profiles: <List> keyboard profiles (see joystick_cfg)
+    :return: <Exception> ValueError if two profiles drive the same slot or share a key, one key press would move both
+    """
+    slots = set()
+    bound = {}  # key name: slot
+    for profile in profiles:
+        if profile[0] in slots:
+            raise ValueError('more than one keyboard profile drives slot ' + str(profile[0]))
+        slots.add(profile[0])
+        for key in profile[1:]:
+            if key in bound:
+                raise ValueError('{} is bound for both slot {} and slot {}'.format(key, bound[key], profile[0]))
+            bound[key] = profile[0]
+
+
+def keyboard_vector(keys, profile, speed_factor):
+    """
+    Velocity vector from one keyboard profile
+
+    :param keys: <List> pygame.key.get_pressed()
+    :param profile: <Tuple> slot and key names for left, right, up, down, faster, slower and the four speed presets
+        (see joystick_cfg)
+    :param speed_factor: <Float> [0,1] speed factor from the last sample
+    :return: <Tuple> x axis, y axis, new speed factor, velocity vector (x,y)
+    """
+    left, right, up, down, faster, slower, quarter, half, three_quarters, full = [getattr(pygame, key)
+                                                                                  for key in profile[1:]]
+
+    # Arrow Key Input
+    x_axis = 0
+    y_axis = 0
+
+    if keys[left]:
+        x_axis = -1
+
+    if keys[right]:
+        x_axis = 1
+
+    if keys[up]:
+        y_axis = 1
+
+    if keys[down]:
+        y_axis = -1
+
+    if keys[faster] and speed_factor < 1.0:
+        speed_factor = speed_factor + 0.005
+    elif keys[slower] and speed_factor > 0.0:
+        speed_factor = speed_factor - 0.005
+    elif keys[quarter]:
+        speed_factor = 0.25
+    elif keys[half]:
+        speed_factor = 0.5
+    elif keys[three_quarters]:
+        speed_factor = 0.75
+    elif keys[full]:
+        speed_factor = 1
+
+    if speed_factor < 0.0:
+        speed_factor = 0.0
+
+    angle, velocity_vector = gen_velocity_vector(x_axis, y_axis)
+    velocity_vector = [speed_factor * n for n in velocity_vector]
+
+    return x_axis, y_axis, speed_factor, velocity_vector
+
+
 def init_joystick():
     """
-    Initialize joystick/keyboard for use and input
+    Initialize joystick/keyboard for use and input. Inputs are sampled and the velocity vector published at SAMPLE_RATE
+    on this thread, which has to be the one that owns the window for SDL to deliver input. Drawing happens separately
+    at DISPLAY_RATE.
 
     :return: <Exception> KeyboardInterrupt upon completion
     """
-    global velocity_vector
+    global velocity_vectors
 
-    speed_factor = 0.0
+    check_keyboard_profiles(cfg.KEYBOARD_PROFILES)
+    speed_factors = {}  # drone slot: keyboard speed factor
 
     pygame.init()
 
@@ -59,14 +286,23 @@ def init_joystick():
     # Loop until the user clicks the close button.
     done = False
 
-    # Used to manage how fast the screen updates
+    # Used to manage how fast inputs are sampled
     clock = pygame.time.Clock()
 
-    # Initialize the joysticks
+    # Initialize the joysticks, only opened again when one is plugged in or removed
     pygame.joystick.init()
+    joysticks = open_joysticks()
 
     # Get ready to print
-    text_print = TextPrint()
+    display = Display(screen)
+    display.start()
+
+    # Shared with the server, which reads the latest vector straight out of memory
+    channel = VelocityChannel(cfg.VELOCITY_CHANNEL_PATH)
+    poster = None
+    if cfg.VELOCITY_SERVICE_ADDRESS:
+        poster = VelocityPoster(cfg.VELOCITY_SERVICE_ADDRESS)
+        poster.start()
 
     try:
         # -------- Main Program Loop -----------
@@ -83,150 +319,111 @@ def init_joystick():
                 if event.type == pygame.JOYBUTTONUP:
                     print("Joystick button released.")
 
-            # DRAWING STEP
-            # First, clear the screen to white. Don't put other drawing commands
-            # above this, or they will be erased with this command.
-            screen.fill(WHITE)
-            text_print.reset()
+            # SAMPLING STEP
+            # Only text is gathered here, the display thread turns it into pixels.
+            lines = []
 
             # Get count of joysticks
             joystick_count = pygame.joystick.get_count()
+            if joystick_count != len(joysticks):
+                joysticks = open_joysticks()
+
+            lines.append((0, "Number of joysticks: {}".format(joystick_count)))
 
-            text_print.print(screen, "Number of joysticks: {}".format(joystick_count))
+            vectors = {}
 
             # For each joystick:
-            for i in range(joystick_count):
-                joystick = pygame.joystick.Joystick(i)
-                joystick.init()
-                text_print.indent()
-                text_print.print(screen, "Joystick {}".format(i))
+            for i, joystick in enumerate(joysticks):
+                slot = joystick_slot(i)
+                lines.append((1, "Joystick {}".format(i)))
 
                 # Get the name from the OS for the controller/joystick
                 name = joystick.get_name()
-                text_print.print(screen, "Joystick name: {}".format(name))
+                lines.append((1, "Joystick name: {}".format(name)))
+                lines.append((1, "Drives drone slot: {}".format(slot)))
 
                 # Usually axis run in pairs, up/down for one, and left/right for
                 # the other.
                 axes = joystick.get_numaxes()
-                text_print.print(screen, "Number of axes: {}".format(axes))
+                lines.append((1, "Number of axes: {}".format(axes)))
 
-                text_print.indent()
                 for j in range(axes):
                     axis = joystick.get_axis(j)
-                    text_print.print(screen, "Axis {} value: {:>6.3f}".format(j, axis))
-                text_print.unindent()
+                    lines.append((2, "Axis {} value: {:>6.3f}".format(j, axis)))
 
                 # Print the outputted velocity vector
                 y_axis = -joystick.get_axis(1)
                 x_axis = joystick.get_axis(0)
 
                 deg_angle, velocity_vector = gen_velocity_vector(x_axis, y_axis)
+                if slot is not None and slot not in vectors:
+                    vectors[slot] = velocity_vector
 
-                text_print.print(screen, "Joystick angle: {:>6.3f}".format(deg_angle))
+                lines.append((1, "Joystick angle: {:>6.3f}".format(deg_angle)))
 
                 buttons = joystick.get_numbuttons()
-                text_print.print(screen, "Number of buttons: {}".format(buttons))
+                lines.append((1, "Number of buttons: {}".format(buttons)))
 
-                text_print.indent()
                 for k in range(buttons):
                     button = joystick.get_button(k)
-                    text_print.print(screen, "Button {:>2} value: {}".format(k, button))
-                text_print.unindent()
+                    lines.append((2, "Button {:>2} value: {}".format(k, button)))
 
                 # Hat switch. All or nothing for direction, not like joysticks.
                 # Value comes back in an array.
                 hats = joystick.get_numhats()
-                text_print.print(screen, "Number of hats: {}".format(hats))
+                lines.append((1, "Number of hats: {}".format(hats)))
 
-                text_print.indent()
                 for n in range(hats):
                     hat = joystick.get_hat(n)
-                    text_print.print(screen, "Hat {} value: {}".format(n, str(hat)))
-                text_print.unindent()
-
-            if joystick_count == 0:
-                text_print.indent()
-                text_print.print(screen, "Arrow Key Input")
-
-                # Arrow Key Input
-                x_axis = 0
-                y_axis = 0
-
-                keys = pygame.key.get_pressed()
-
-                if keys[pygame.K_LEFT]:
-                    # velocity_vector[0] = -cfg.MAXVELOCITY
-                    x_axis = -1
-
-                if keys[pygame.K_RIGHT]:
-                    # velocity_vector[0] = cfg.MAXVELOCITY
-                    x_axis = 1
-
-                if keys[pygame.K_UP]:
-                    # velocity_vector[1] = cfg.MAXVELOCITY
-                    y_axis = 1
-
-                if keys[pygame.K_DOWN]:
-                    # velocity_vector[1] = -cfg.MAXVELOCITY
-                    y_axis = -1
-
-                if keys[pygame.K_UP] is False and keys[pygame.K_DOWN] is False:
-                    # velocity_vector[1] = 0
-                    y_axis = 0
-
-                if keys[pygame.K_LEFT] is False and keys[pygame.K_RIGHT] is False:
-                    # velocity_vector[0] = 0
-                    x_axis = 0
-
-                if keys[pygame.K_w] and speed_factor < 1.0:
-                    speed_factor = speed_factor + 0.005
-                elif keys[pygame.K_s] and speed_factor > 0.0:
-                    speed_factor = speed_factor - 0.005
-                elif keys[pygame.K_1]:
-                    speed_factor = 0.25
-                elif keys[pygame.K_2]:
-                    speed_factor = 0.5
-                elif keys[pygame.K_3]:
-                    speed_factor = 0.75
-                elif keys[pygame.K_4]:
-                    speed_factor = 1
-
-                if speed_factor < 0.0:
-                    speed_factor = 0.0
-
-                angle, velocity_vector = gen_velocity_vector(x_axis, y_axis)
-                velocity_vector = [speed_factor * n for n in velocity_vector]
-
-                text_print.indent()
-                text_print.print(screen, "X-Axis: {:>d}".format(x_axis))
-                text_print.print(screen, "Y-Axis: {:>d}".format(y_axis))
-                text_print.print(screen, "Speed factor: {:>6.3f}x".format(speed_factor))
+                    lines.append((2, "Hat {} value: {}".format(n, str(hat))))
 
-            # Velocity vector input to simulation
-            with open("/var/www/cgi-bin/velocity_vectors", "w") as velocity_vector_file:
-                velocity_vector_file.write(str(velocity_vector))
+            # Keyboard profiles drive any slot no joystick has taken
+            keys = pygame.key.get_pressed()
+            for profile in cfg.KEYBOARD_PROFILES:
+                slot = profile[0]
+                if slot in vectors:
+                    continue
+                x_axis, y_axis, speed_factors[slot], vectors[slot] = keyboard_vector(keys, profile,
+                                                                                    speed_factors.get(slot, 0.0))
+
+                lines.append((1, "Key Input, drone slot {}".format(slot)))
+                lines.append((2, "X-Axis: {:>d}".format(x_axis)))
+                lines.append((2, "Y-Axis: {:>d}".format(y_axis)))
+                lines.append((2, "Speed factor: {:>6.3f}x".format(speed_factors[slot])))
 
-            # ALL CODE TO DRAW SHOULD GO ABOVE THIS COMMENT
+            velocity_vectors = vectors
 
-            # Go ahead and update the screen with what we've drawn.
-            pygame.display.flip()
+            # Velocity vector input to simulation
+            channel.publish(velocity_vectors)
+            if poster:
+                poster.post(velocity_vectors)
 
-            # Limit to 20 frames per second
-            clock.tick(120)
+            # Hand the readout to the display thread and put up whatever it has finished drawing
+            display.show(lines)
+            display.present()
+
+            # Sample at a fixed rate, independent of how fast the display redraws
+            clock.tick(cfg.SAMPLE_RATE)
 
     except KeyboardInterrupt:
-        # Close the window and quit.
-        # If you forget this line, the program will 'hang'
-        # on exit if running from IDLE.
-        pygame.quit()
+        pass
+
+    # Close the window and quit.
+    # If you forget this line, the program will 'hang'
+    # on exit if running from IDLE.
+    display.running = False
+    display.join()
+    pygame.quit()
 
 
-def get_vector():
+def get_vector(slot=0):
     """
     Gets the vector from keyboard/joystick
 
+    :param slot: <Int> drone slot
     :return: <Vector> The generated vector created by input x,y
     """
+    velocity_vector = velocity_vectors.get(slot, [0, 0])
     print(velocity_vector)
     return velocity_vector
 
@@ -261,4 +458,5 @@ def start():
     init_joystick()
 
 
-start()
+if __name__ == "__main__":
+    start()
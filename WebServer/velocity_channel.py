@@ -0,0 +1,91 @@
+"""
+Shared memory channel for the joystick's velocity vectors, one per drone slot. The joystick publishes into a small memory
+mapped table on a RAM backed file and the server maps the same file and reads every drone's vector at once, with no file
+rewriting, parsing or HTTP in between.
+
+The record is a seqlock: a version counter followed by fixed width fields. The single writer makes the version odd before
+touching the fields and even again afterwards, readers retry until they see the same even version on both sides of
+their copy, so a half written vector is never returned and neither side ever blocks the other.
+
+Layout (little endian): version <uint64>, timestamp <double>, driven <uint64>, then xvel <double>, yvel <double> for each
+of SLOTS slots. A drone's slot is the index of the port it connected on (car_controller). Bit n of driven is set while a
+joystick or keyboard profile drives slot n; the other slots read as stopped and the server takes their vectors from its
+other sources.
+"""
+
+import mmap
+import os
+import struct
+import time
+
+SLOTS = 8
+RECORD = struct.Struct('<QdQ' + 'dd' * SLOTS)
+VERSION = struct.Struct('<Q')
+MAX_READ_ATTEMPTS = 1000
+
+
+class VelocityChannel:
+    def __init__(self, path):
+        """
+        Maps the channel file, creating it (zeroed) if the other side hasn't yet
+
+        :param path: <String> file backing the channel, should live on a tmpfs such as /dev/shm
+        """
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if os.fstat(fd).st_size < RECORD.size:
+                os.ftruncate(fd, RECORD.size)
+            self.map = mmap.mmap(fd, RECORD.size)
+        finally:
+            os.close(fd)
+        self.version = VERSION.unpack_from(self.map)[0]
+        self.last_read = (0, [[0.0, 0.0] for _ in range(SLOTS)], 0.0, set())
+
+    def publish(self, velocity_vectors, timestamp=None):
+        """
+        Writes a new table. Only one process may publish into a channel.
+
+        :param velocity_vectors: <Dict> slot: [xvel, yvel] in m/s for the slots an input device drives, slots left out
+            are published as stopped and not driven
+        :param timestamp: <Float> time.time() the vectors were sampled, now if not given
+        :return: <Int> version of the record written
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        values = [0.0] * (2 * SLOTS)
+        driven = 0
+        for slot, velocity_vector in velocity_vectors.items():
+            values[2 * slot:2 * slot + 2] = velocity_vector
+            driven |= 1 << slot
+        if self.version % 2:
+            self.version += 1  # a previous writer died halfway through, start from a clean even version
+
+        VERSION.pack_into(self.map, 0, self.version + 1)
+        RECORD.pack_into(self.map, 0, self.version + 1, timestamp, driven, *values)
+        self.version += 2
+        VERSION.pack_into(self.map, 0, self.version)
+
+        return self.version
+
+    def read(self):
+        """
+        :return: <Tuple> version, [xvel, yvel] for every slot, timestamp of the latest consistent record and the set of
+            slots an input device drives. Version 0 means nothing has been published yet.
+        """
+        for _ in range(MAX_READ_ATTEMPTS):
+            before = VERSION.unpack_from(self.map)[0]
+            if before % 2:
+                continue
+            record = RECORD.unpack_from(self.map)
+            if record[0] == before and VERSION.unpack_from(self.map)[0] == before:
+                values = record[3:]
+                driven = {slot for slot in range(SLOTS) if record[2] & (1 << slot)}
+                self.last_read = (before, [list(values[i:i + 2]) for i in range(0, len(values), 2)], record[1], driven)
+                break
+
+        # Only reached without a fresh record if the writer died mid update, repeat the last good table
+        return self.last_read
+
+    def close(self):
+        self.map.close()